@@ -0,0 +1,479 @@
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from run_metrics import get_run_metrics
+
+DEFAULT_COMPRESSLEVEL = 6
+# Already compressed formats, deflating them again costs CPU for no size gain, so they are stored as is
+INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".whl", ".jar", ".apk", ".h5", ".npz",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".aac", ".ogg", ".flac", ".m4a",
+    ".mp4", ".mkv", ".avi", ".mov", ".webm", ".docx", ".xlsx", ".pptx", ".odt", ".pdf",
+})
+PARALLEL_MEMBER_SIZE_LIMIT = 32 << 20  # larger files are compressed chunk by chunk on the writing thread instead
+# Bytes of files submitted to the process pool and not yet written to the zip, whose compressed data is held in memory
+MAX_PENDING_BYTES = 256 << 20
+# Compression workers are never forked from this process, whose other threads (copies, uploads, other zips) may hold
+# locks at that moment, which would stay locked forever in the child
+MP_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+SAMPLE_MIN_FILE_SIZE = 1 << 20  # smaller files of unknown type are always deflated
+SAMPLE_SIZE = 64 << 10
+INCOMPRESSIBLE_RATIO = 0.9  # a sample that doesn't shrink below this ratio marks the file as incompressible
+CHUNK_SIZE = 1 << 20
+# Rough compressed/original size ratios at the default level, used to estimate the zip size from metadata alone
+TEXT_EXTENSIONS = frozenset({
+    ".txt", ".md", ".rst", ".csv", ".tsv", ".json", ".xml", ".html", ".css", ".js", ".ts", ".py", ".ipynb", ".c",
+    ".h", ".cpp", ".hpp", ".java", ".go", ".rs", ".sh", ".yaml", ".yml", ".toml", ".ini", ".cfg", ".log", ".sql",
+    ".tex", ".svg",
+})
+TEXT_COMPRESSION_RATIO = 0.3
+DEFAULT_COMPRESSION_RATIO = 0.6
+ZIP_MEMBER_OVERHEAD = 30 + 46  # local file header and central directory record, excluding the name twice
+ZIP_INDEX_VERSION = 2  # version 2 added the md5 of every member
+ZIP_INDEX_SUFFIX = ".index.json.gz"
+
+
+def estimate_compressed_size(arcname, file_size, compresslevel=DEFAULT_COMPRESSLEVEL):
+    """
+    Estimated number of bytes arcname adds to the zip, from its extension and size only
+    """
+    extension = os.path.splitext(arcname)[1].lower()
+    if compresslevel == 0 or extension in INCOMPRESSIBLE_EXTENSIONS:
+        ratio = 1.0
+    elif extension in TEXT_EXTENSIONS:
+        ratio = TEXT_COMPRESSION_RATIO
+    else:
+        ratio = DEFAULT_COMPRESSION_RATIO
+    return int(file_size * ratio) + ZIP_MEMBER_OVERHEAD + 2 * len(arcname.encode())
+
+
+def _is_sample_incompressible(src_filepath):
+    with open(src_filepath, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) > INCOMPRESSIBLE_RATIO * len(sample)
+
+
+def _compress_member(src_filepath, compresslevel):
+    """
+    Runs in a worker process. Returns (compress_type, CRC, file size, raw member data, md5) of src_filepath, the data
+    is stored uncompressed if deflating doesn't make it smaller. Only the compressed data is kept while compressing,
+    the file is read again in that case, which is rare since most incompressible files are recognised by their
+    extension and never sent to the pool.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    md5 = hashlib.md5()
+    crc, file_size = 0, 0
+    compressed_chunks = []
+    with open(src_filepath, 'rb') as f:
+        while True:
+            buf = f.read(CHUNK_SIZE)
+            if not buf:
+                break
+            crc = zlib.crc32(buf, crc)
+            md5.update(buf)
+            file_size += len(buf)
+            compressed_chunks.append(compressor.compress(buf))
+    compressed_chunks.append(compressor.flush())
+    compressed = b"".join(compressed_chunks)
+    del compressed_chunks
+    if len(compressed) >= file_size:
+        with open(src_filepath, 'rb') as f:
+            raw = f.read(file_size + 1)
+        # if the file changed in the meantime, the deflated data is still a valid member of what was hashed
+        if len(raw) == file_size and zlib.crc32(raw) == crc:
+            return zipfile.ZIP_STORED, crc, file_size, raw, md5.hexdigest()
+    return zipfile.ZIP_DEFLATED, crc, file_size, compressed, md5.hexdigest()
+
+
+def _open_member(zf, src_filepath, arcname, compress_type):
+    """
+    Opens src_filepath to be written by _write_member, returns (file object, ZipInfo). Raises OSError if the file
+    can't be read, before anything is written to zf.
+    """
+    zinfo = zipfile.ZipInfo.from_file(src_filepath, arcname)
+    zinfo.compress_type = compress_type
+    zinfo._compresslevel = zf.compresslevel
+    return open(src_filepath, 'rb'), zinfo
+
+
+def _write_member(zf, src, zinfo):
+    """
+    Same as zf.write() of the file opened by _open_member, except that the data is hashed as it is written, returns
+    its md5
+    """
+    md5 = hashlib.md5()
+    with src, zf.open(zinfo, 'w') as dest:
+        while True:
+            buf = src.read(CHUNK_SIZE)
+            if not buf:
+                break
+            md5.update(buf)
+            dest.write(buf)
+    return md5.hexdigest()
+
+
+def _write_compressed_member(zf, zinfo, compress_type, crc, file_size, data, md5):
+    """
+    Appends a member whose data was already compressed by _compress_member, zinfo being the ZipInfo.from_file of its
+    file. Since sizes and CRC are known up front, the local header is written with them and no data descriptor is
+    needed, even on a non-seekable zip. Returns the md5 hashed by _compress_member.
+    """
+    zinfo.compress_type = compress_type
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zip64 = file_size > zipfile.ZIP64_LIMIT or len(data) > zipfile.ZIP64_LIMIT
+    # Mirrors ZipFile._open_to_write and _ZipWriteFile.close, which only support compressing on the calling thread
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    if zf._seekable:
+        zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    return md5
+
+
+def zip_index(zf, md5s=None):
+    """
+    Compact index of a zip written or read by zipfile.ZipFile zf: the central directory offset and, for every member,
+    [name, local header offset, compress type, compressed size, size, CRC-32, date_time, md5]. Members are stored one
+    after the other, so a member's bytes end where the next one (or the central directory) starts, and any member can
+    be read with a single range request without reading the central directory first. The md5 of a member, hashed
+    while it was written, is taken from md5s {name: md5}, it is None for members of a zip which was only read.
+    """
+    md5s = md5s or {}
+    return {
+        "version": ZIP_INDEX_VERSION,
+        "central_directory_offset": zf.start_dir,
+        "members": [[zinfo.filename, zinfo.header_offset, zinfo.compress_type, zinfo.compress_size, zinfo.file_size,
+                     zinfo.CRC, list(zinfo.date_time), md5s.get(zinfo.filename)] for zinfo in zf.infolist()],
+    }
+
+
+def read_zip_index(zip_file):
+    """
+    Index of an existing zip, zip_file being a path or a seekable file object
+    """
+    with zipfile.ZipFile(zip_file) as zf:
+        return zip_index(zf)
+
+
+def save_zip_index(index, filepath):
+    with gzip.open(filepath, 'wt') as f:
+        json.dump(index, f)
+
+
+def load_zip_index(filepath):
+    """
+    Reads an index saved by save_zip_index, filepath being a path or a binary file object. Members of an index saved
+    before md5s were recorded have None as their md5.
+    """
+    with gzip.open(filepath, 'rt') as f:
+        index = json.load(f)
+    if index.get("version") == 1:
+        index["version"] = ZIP_INDEX_VERSION
+        for member in index["members"]:
+            member.append(None)
+    elif index.get("version") != ZIP_INDEX_VERSION:
+        raise ValueError(f"Unsupported zip index version in {filepath}")
+    return index
+
+
+def write_zip(zip_file, members, extra_members=(), compresslevel=DEFAULT_COMPRESSLEVEL, workers=1, failed=None):
+    """
+    Writes files straight from the work folder into a zip, without staging a copy of them first. Files with an
+    INCOMPRESSIBLE_EXTENSIONS extension, or larger files whose first bytes don't compress, are stored without
+    compression. With several workers, smaller files are deflated in parallel by a process pool and the compressed
+    members are appended in the order of members, so the zip is the same no matter which worker finishes first.
+    Files of at most MAX_PENDING_BYTES in total are handed to the pool ahead of the writer. Every member is hashed on
+    its way into the zip, without reading it again. Returns the zip_index of the zip, with the md5 of every member.
+
+    Parameters
+    ----------
+    zip_file: Path of the zip file, or a writable file object which doesn't have to be seekable (e.g. a pipe)
+    members: Iterable of (src_filepath, arcname)
+    extra_members: Iterable of (arcname, str or bytes) written after the files, e.g. the list of deleted files
+    compresslevel: zlib compression level from 0 (every file is stored) to 9
+    workers: Number of processes compressing files, 1 compresses on the calling thread
+    failed: If given, files that can't be read (e.g. deleted since they were planned) are left out of the zip and
+            (src_filepath, OSError) is appended to this list for each of them, instead of raising the error
+    """
+    metrics = get_run_metrics()
+    with metrics.phase("zip"), zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED,
+                                                compresslevel=compresslevel) as zf:
+        executor = (ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_START_METHOD))
+                    if workers > 1 and compresslevel > 0 else None)
+        # (src_filepath, arcname, future or compress_type, bytes submitted to the pool), bounded in number and bytes to
+        # keep memory use capped
+        pending = deque()
+        pending_bytes = 0
+        md5s = {}
+
+        def skip_member(src_filepath, error):
+            if failed is None:
+                raise error
+            failed.append((src_filepath, error))
+
+        def write_next_pending():
+            nonlocal pending_bytes
+            src_filepath, arcname, job, submitted_bytes = pending.popleft()
+            pending_bytes -= submitted_bytes
+            # a file that can't be read is skipped before anything of it is written, so the zip stays consistent
+            if isinstance(job, int):
+                start = time.perf_counter()
+                try:
+                    src, zinfo = _open_member(zf, src_filepath, arcname, job)
+                except OSError as e:
+                    skip_member(src_filepath, e)
+                    return
+                md5s[arcname] = _write_member(zf, src, zinfo)
+                # members compressed by the pool are only waited for here, so only these are timed per file
+                metrics.record_file("zip", src_filepath, time.perf_counter() - start, zf.filelist[-1].file_size)
+            else:
+                try:
+                    compressed_member = job.result()
+                    # the file may have been deleted since it was compressed
+                    zinfo = zipfile.ZipInfo.from_file(src_filepath, arcname)
+                except OSError as e:
+                    skip_member(src_filepath, e)
+                    return
+                md5s[arcname] = _write_compressed_member(zf, zinfo, *compressed_member)
+            metrics.add("zip", 1, zf.filelist[-1].file_size)
+
+        try:
+            for src_filepath, arcname in members:
+                if compresslevel == 0 or os.path.splitext(src_filepath)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+                    pending.append((src_filepath, arcname, zipfile.ZIP_STORED, 0))
+                else:
+                    try:
+                        file_size = os.path.getsize(src_filepath)
+                        is_incompressible = (file_size >= SAMPLE_MIN_FILE_SIZE
+                                             and (executor is None or file_size > PARALLEL_MEMBER_SIZE_LIMIT)
+                                             and _is_sample_incompressible(src_filepath))
+                    except OSError as e:
+                        skip_member(src_filepath, e)
+                        continue
+                    if executor is not None and file_size <= PARALLEL_MEMBER_SIZE_LIMIT:
+                        pending.append((src_filepath, arcname,
+                                        executor.submit(_compress_member, src_filepath, compresslevel), file_size))
+                        pending_bytes += file_size
+                    elif is_incompressible:
+                        pending.append((src_filepath, arcname, zipfile.ZIP_STORED, 0))
+                    else:
+                        pending.append((src_filepath, arcname, zipfile.ZIP_DEFLATED, 0))
+                while len(pending) > 4 * workers or pending and pending_bytes > MAX_PENDING_BYTES:
+                    write_next_pending()
+            while pending:
+                write_next_pending()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        for arcname, data in extra_members:
+            zf.writestr(arcname, data)
+            md5s[arcname] = hashlib.md5(data.encode() if isinstance(data, str) else data).hexdigest()
+    return zip_index(zf, md5s)
+
+
+class ZipStream:
+    """
+    Readable, non-seekable stream of a zip file which is written by a background thread through a pipe, so that the
+    zip can be uploaded while it is being built without ever being stored on disk. Memory use is bounded by the pipe
+    buffer. If writing the zip fails, read() raises the error instead of returning a truncated zip. Once the zip has
+    been read completely, index is its zip_index and failed lists the files left out of it, see write_zip.
+    """
+
+    def __init__(self, members, extra_members=(), compresslevel=DEFAULT_COMPRESSLEVEL, workers=1):
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, 'rb')
+        self._error = None
+        self.index = None
+        self.failed = []
+        self._thread = threading.Thread(target=self._write, args=(os.fdopen(write_fd, 'wb'), members, extra_members,
+                                                                  compresslevel, workers), daemon=True)
+        self._thread.start()
+
+    def _write(self, writer, members, extra_members, compresslevel, workers):
+        try:
+            with writer:
+                self.index = write_zip(writer, members, extra_members, compresslevel, workers, self.failed)
+        except BrokenPipeError:
+            # reader was closed before the zip was completely read
+            pass
+        except Exception as e:
+            self._error = e
+
+    def read(self, size=-1):
+        data = self._reader.read(size)
+        if not data:
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        return data
+
+    def close(self):
+        self._reader.close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _SegmentWriter:
+    """
+    Writable, non-seekable file object which splits everything written to it into consecutive segment files of
+    segment_size bytes named <filepath_prefix>.001, <filepath_prefix>.002, etc. on_segment(filepath, offset, length)
+    is called for every completed segment.
+    """
+
+    def __init__(self, filepath_prefix, segment_size, on_segment, max_size=None):
+        self._filepath_prefix = filepath_prefix
+        self._segment_size = segment_size
+        self._on_segment = on_segment
+        self._max_size = max_size
+        self._file = None
+        self._segment_offset = 0
+        self._segment_count = 0
+        self._offset = 0
+
+    def _finish_segment(self):
+        self._file.close()
+        filepath, segment_offset = self._file.name, self._segment_offset
+        self._file = None
+        self._segment_offset = self._offset
+        self._on_segment(filepath, segment_offset, self._offset - segment_offset)
+
+    def write(self, data):
+        data = memoryview(data)
+        if self._max_size is not None and self._offset + len(data) > self._max_size:
+            raise ValueError(f"Zip exceeds {round(self._max_size / (1 << 20), 2)} MB")
+        written = 0
+        while written < len(data):
+            if self._file is None:
+                self._segment_count += 1
+                self._file = open(f"{self._filepath_prefix}.{self._segment_count:03d}", 'wb')
+            n = min(len(data) - written, self._segment_offset + self._segment_size - self._offset)
+            self._file.write(data[written:written + n])
+            written += n
+            self._offset += n
+            if self._offset - self._segment_offset == self._segment_size:
+                self._finish_segment()
+        return written
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None or self._segment_count == 0:
+            if self._file is None:
+                self._segment_count += 1
+                self._file = open(f"{self._filepath_prefix}.{self._segment_count:03d}", 'wb')
+            self._finish_segment()
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._file.name)
+            self._file = None
+
+
+class ZipSegments:
+    """
+    Iterable of the consecutive segments of a zip file, which is written by a background thread into segment files of
+    segment_size bytes. Each segment is yielded as (filepath, offset in the zip, length) as soon as it is complete, so
+    that it can be uploaded while the rest of the zip is still being written, and the consumer deletes its file once
+    done with it. At most max_pending completed segments wait to be consumed, the writer blocks meanwhile, so memory
+    and disk use stay bounded no matter how large the zip is. If writing the zip fails, or it exceeds max_size bytes,
+    iterating raises the error. Once every segment has been yielded, index is the zip_index of the zip and failed lists
+    the files left out of it, see write_zip.
+    """
+
+    def __init__(self, filepath_prefix, segment_size, members, extra_members=(), compresslevel=DEFAULT_COMPRESSLEVEL,
+                 workers=1, max_pending=2, max_size=None):
+        self.index = None
+        self.failed = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._cancelled = threading.Event()
+        self._writer = _SegmentWriter(filepath_prefix, segment_size, lambda *segment: self._put(segment), max_size)
+        self._thread = threading.Thread(target=self._write, args=(members, extra_members, compresslevel, workers),
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        if isinstance(item, tuple):
+            os.remove(item[0])
+        raise BrokenPipeError("Zip segments are no longer consumed")
+
+    def _write(self, members, extra_members, compresslevel, workers):
+        try:
+            self.index = write_zip(self._writer, members, extra_members, compresslevel, workers, self.failed)
+            self._writer.close()
+        except BrokenPipeError:
+            self._writer.abort()
+            return
+        except Exception as e:
+            self._writer.abort()
+            try:
+                self._put(e)
+            except BrokenPipeError:
+                pass
+            return
+        try:
+            self._put(None)
+        except BrokenPipeError:
+            pass
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """
+        Stops the writer if the segments weren't all consumed and deletes the files of unconsumed segments
+        """
+        self._cancelled.set()
+        self._thread.join()
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple):
+                os.remove(item[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,13 +1,46 @@
 import shutil
 import os
 import argparse
+import cProfile
+import signal
+import threading
+import re
 import stat
 from datetime import datetime
 from pathlib import Path
 import time
+import gzip
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from typing import List, NamedTuple
 
-from common_utils import custom_copy, get_file_size_mb, move_folder_with_sandwiched_timestamp
-from upload_drive import upload_file, check_and_fetch_env_vars
+from archive import DEFAULT_COMPRESSLEVEL, ZIP_INDEX_SUFFIX, ZipSegments, ZipStream, estimate_compressed_size, \
+    read_zip_index, save_zip_index, write_zip
+from chunk_store import ChunkStore
+from common_utils import CopyJob, copy_files, get_file_size_mb, move_folder_with_sandwiched_timestamp, \
+    shared_copy_pool
+from exclusion_rules import ExclusionRules
+from manifest import DELETIONS_FILENAME, PENDING_SUFFIX, commit_pending_manifest, get_deleted_files, \
+    get_manifest_path, has_file_changed, load_manifest, save_manifest
+from run_metrics import get_run_metrics, reset_run_metrics
+from scanner import FileRecord, build_dir_size_index, scan_dir, scan_tree
+from snapshots import create_link_snapshot, prune_snapshots
+from upload_drive import upload_file, upload_segments, upload_stream, upload_volumes, check_and_fetch_env_vars, \
+    get_pending_uploads, set_bandwidth_limit, shared_upload_queue
+from watcher import ChangeJournal, get_journal_path, start_watcher
+
+
+ZIP_STAGED = 0  # copy online files into the online backup folder, then zip it
+ZIP_STREAMED = 1  # write online files straight into the zip
+ZIP_STREAMED_UPLOAD = 2  # upload the zip while it is written, without storing it on disk
+INDEX_FOLDER = "backup_indexes"
+OFFLINE_LIST_SUFFIX = "_offline_backup_files.txt"
+FILE_HASHES_SUFFIX = "_file_hashes.json.gz"
+FILE_HASHES_VERSION = 1
+DT_FORMAT = "%d_%m_%Y_%H_%M_%S"  # date of a run in the names of its zips, indexes and file hashes
+LEGACY_DT_FORMAT = "%d_%m_%Y_%H_%M"  # used by older runs
 
 
 def validate_folder(folder):
@@ -24,10 +57,13 @@ def remove_readonly(func, path, excinfo):
 
 
 def backup_folder(folder, file_size_limit, overall_online_limit, max_files_per_dir, skip_offline_backup,
-                  restrict_certain_file_sizes):
+                  restrict_certain_file_sizes, incremental=0, use_hash=0, workers=1, zip_mode=ZIP_STAGED,
+                  compresslevel=DEFAULT_COMPRESSLEVEL, compress_workers=1, auto_tighten=0, link_snapshots=0,
+                  keep_snapshots=0, volume_size_mb=0, upload_workers=4, chunk_store=0, changed_dirs=None,
+                  integrity_hashes=0):
     """
-        1. Use os walk to traverse every file in work dir
-        2. If file is too big or belongs to a folder containing too many files, the filename is logged to offline_backup_files.txt (gitignored)
+        1. Scan every file in work dir once with os.scandir
+        2. If file is too big or belongs to a folder containing too many files, the filename is logged to <folder name>_offline_backup_files.txt (gitignored)
            Maintaining the same folder structure, this file is copied into offline backup folder, sibling to WORK_DIR
         3. Else copy to online backup folder which will later be zipped and uploaded to google drive
         4. Copy bashrc into online backup folder.
@@ -35,7 +71,42 @@ def backup_folder(folder, file_size_limit, overall_online_limit, max_files_per_d
         6. Check if online zip exceeds file size limit, default 3 gb. If so throw an error that this program needs to be modified to become more selective.
         7. Upload zip file. Change folder id to that of new folder created in drive. Delete pre existing backup folders. Check for drive free space
         8. Remove files and folders created by the program on the local system.
+        In incremental mode, only files that are new or changed since the manifest saved by the previous incremental
+        run are copied, and the online zip additionally lists the files deleted since then. The manifest is only
+        updated once the upload has succeeded.
+        With zip_mode ZIP_STREAMED, online files are written straight from the work folder into the zip instead of
+        being staged in the online backup folder first, and with ZIP_STREAMED_UPLOAD the zip is also never written to
+        disk, it is uploaded while it is being built.
+        In every zip_mode, already compressed file types are stored as is and the remaining files are deflated at
+        compresslevel by compress_workers processes.
+        Files are segregated into a plan from their metadata before anything is copied, so that an online zip which is
+        estimated to exceed overall_online_limit is caught early. With auto_tighten the largest online files are then
+        moved to the offline backup instead of raising an error.
+        With link_snapshots, offline files are written straight into a new timestamped snapshot under WORK_BACKUP,
+        where files unchanged since the previous snapshot are hard-linked to it instead of being copied again. With
+        keep_snapshots, only that many of the most recent offline snapshots of this folder are kept. It can't be
+        combined with incremental, whose offline backups only hold the files changed since the previous run.
+        With volume_size_mb, the online zip is uploaded as volumes of that size by upload_workers threads, along with a
+        manifest listing them in order with their checksums. With ZIP_STREAMED_UPLOAD, every volume is uploaded as
+        soon as it has been written, while the zip writer is held back once upload_workers volumes are waiting.
+        With ZIP_STREAMED_UPLOAD or chunk_store, the offline backup runs in a background thread while the online
+        backup is being built and uploaded.
+        With chunk_store, online files are backed up to a deduplicated chunk store in the drive folder instead of a
+        zip: only chunks of their content that were never uploaded before are uploaded, along with a snapshot
+        manifest of this run.
+        If the upload of a previous run's online zip was interrupted, that zip is kept and the run only resumes its
+        upload, without scanning or zipping the folder again.
+        The time, files and bytes of every phase of the run are added to run_metrics.get_run_metrics().
+        In incremental mode, changed_dirs (e.g. journaled by watch_folder) limits the scan to the files directly inside
+        these folders, relative to folder. It is ignored if there is no manifest of a previous run.
+        Every file written into the online zip is hashed on its way in, and with integrity_hashes every copied file
+        too (through Python instead of a kernel copy). Each uploaded file is checked against the md5 Drive computed,
+        and the md5 of every backed up file is uploaded as <date>_<folder name>_file_hashes.json.gz and recorded in
+        the manifest, so that they never have to be read again to be compared or verified.
     """
+    if keep_snapshots and incremental:
+        raise ValueError("Incremental offline backups only hold changed files, so older ones can't be deleted")
+    metrics = get_run_metrics()
     folder = os.path.abspath(folder)
     validate_folder(folder)
     dst_folder_id, offline_backup_dst_folder = check_and_fetch_env_vars(strict=True)[1:]
@@ -43,155 +114,658 @@ def backup_folder(folder, file_size_limit, overall_online_limit, max_files_per_d
         validate_folder(offline_backup_dst_folder)
 
     parent_folder = Path(folder).resolve().parent
-    dt_string = datetime.now().strftime("%d_%m_%Y_%H_%M")  # append to both zips
+    manifest_path = get_manifest_path(folder)
+    interrupted_zip = find_interrupted_upload(folder)
+    if interrupted_zip is not None:
+        print(f"Resuming the interrupted upload of {interrupted_zip}...")
+        if volume_size_mb:
+            upload_volumes(interrupted_zip, volume_size_mb, dst_folder_id, upload_workers, report_free_space=True)
+        else:
+            upload_file(interrupted_zip, 0, dst_folder_id, report_free_space=True)
+        # whether the interrupted run was the first of an incremental chain is unknown, restore.py then falls back
+        # to the older incremental zips
+        upload_zip_index(read_zip_index(interrupted_zip), os.path.basename(interrupted_zip), dst_folder_id,
+                         full=not interrupted_zip.endswith("_incremental.zip"))
+        commit_pending_manifest(manifest_path)
+        Path(interrupted_zip).unlink()
+        print("Program completed successfully. Run it again to take a new backup.")
+        return
+
+    dt_string = new_dt_string(folder)  # append to both zips
     online_backup_folder = os.path.join(parent_folder, f"{os.path.basename(folder)}_online_backup")
-    online_backup_zip = os.path.join(parent_folder, f"{dt_string}_{os.path.basename(folder)}_online_backup.zip")
+    zip_suffix = "_incremental" if incremental else ""
+    online_backup_zip = os.path.join(parent_folder,
+                                     f"{dt_string}_{os.path.basename(folder)}_online_backup{zip_suffix}.zip")
     offline_backup_folder = os.path.join(parent_folder, f"{os.path.basename(folder)}_offline_backup")
     print(f"Deleting pre-existing backup folders...{online_backup_folder} and {offline_backup_folder}")
-    shutil.rmtree(online_backup_folder, ignore_errors=True, onerror=remove_readonly)
-    shutil.rmtree(offline_backup_folder, ignore_errors=True)
+    with metrics.phase("delete"):
+        shutil.rmtree(online_backup_folder, ignore_errors=True, onerror=remove_readonly)
+        shutil.rmtree(offline_backup_folder, ignore_errors=True)
     print("Successfully removed!")
 
-    offline_backed_up_files, count = segregate_files_into_online_offline_backup(folder, file_size_limit,
-                                                                                max_files_per_dir, skip_offline_backup,
-                                                                                offline_backup_folder,
-                                                                                online_backup_folder,
-                                                                                restrict_certain_file_sizes)
-    print(f"Totally {count} files have been segregated.")
-
-    print("Moving offline backup folder...")
-    if not skip_offline_backup and validate_folder(offline_backup_folder):
-        list_offline_files = open(os.path.join(Path(__file__).resolve().parent, "offline_backup_files.txt"), 'w')
-        for f in offline_backed_up_files:
-            list_offline_files.write(f + '\n')
-        list_offline_files.close()
-        move_folder_with_sandwiched_timestamp(offline_backup_folder, offline_backup_dst_folder)
-        upload_file(list_offline_files.name, 1, dst_folder_id, report_free_space=True)
-    print("Entire offline backup process completed.")
-
-    print("Zipping online backup...")
-    shutil.make_archive(online_backup_zip.split(".")[-2], 'zip', online_backup_folder)
-    print("Zipping completed")
-    if get_file_size_mb(online_backup_zip) > overall_online_limit:
-        raise ValueError(f"Online backup zip file is too large ({os.path.getsize(online_backup_zip) / (1 << 20)} MB) to be uploaded. \
-            Please tighten online backup criteria")
-    upload_file(online_backup_zip, 0, dst_folder_id, report_free_space=True)
+    previous_manifest = load_manifest(manifest_path, folder) if incremental else None
+    current_manifest = {} if incremental else None
+    # an incremental run without a manifest backs up every file and starts a new chain of incremental zips
+    full_zip = not previous_manifest
+    online_backup_files = [] if zip_mode != ZIP_STAGED or chunk_store else None
+    plan = plan_backup(folder, file_size_limit, max_files_per_dir, skip_offline_backup, restrict_certain_file_sizes,
+                       previous_manifest, current_manifest, use_hash, changed_dirs if previous_manifest else None)
+    print(f"Totally {plan.count} files have been segregated.")
+    plan = enforce_online_limit(plan, overall_online_limit, compresslevel, auto_tighten, skip_offline_backup,
+                                previous_manifest, current_manifest)
+    # with link_snapshots the offline files skip the staging folder and go straight into the snapshot
+    staged_plan = plan._replace(offline_files=[]) if link_snapshots else plan
+    # With the chunk store or a streamed upload the online backup never reads the staging folders, so the offline
+    # backup runs alongside it and its disk-bound copies overlap with compressing and uploading online files
+    pipelined = zip_mode == ZIP_STREAMED_UPLOAD or chunk_store
+    if pipelined:
+        online_backup_files.extend((f.record.path, f.rel_filepath) for f in plan.online_files)
+        staged_plan = staged_plan._replace(online_files=[])
+    file_hashes = {"online": {}, "offline": {}}
+    copy_hashes = {} if integrity_hashes else None
+
+    def record_hashes(kind, hashes):
+        file_hashes[kind].update(hashes)
+        if current_manifest is not None:
+            for rel_filepath, md5 in hashes.items():
+                entry = current_manifest.get(rel_filepath)
+                if entry is not None and entry[2] is None:
+                    entry[2] = md5
+
+    def record_zip_hashes(index):
+        record_hashes("online", {member[0]: member[7] for member in index["members"]
+                                 if member[7] is not None and member[0] != DELETIONS_FILENAME})
+
+    zip_failures = []  # online files which could no longer be read when they were zipped while streaming
+    extra_zip_members = []
+    if incremental:
+        deleted_files = get_deleted_files(previous_manifest, current_manifest)
+        extra_zip_members.append((DELETIONS_FILENAME, "".join(f + '\n' for f in deleted_files)))
+        print(f"{len(deleted_files)} files deleted since the last incremental backup")
+
+    def backup_offline():
+        offline_backed_up_files = execute_backup_plan(staged_plan, folder, offline_backup_folder,
+                                                      online_backup_folder, workers, online_backup_files,
+                                                      current_manifest, copy_hashes)
+        if link_snapshots and plan.offline_files:
+            print("Creating offline backup snapshot...")
+            failed_copies = create_link_snapshot(plan.offline_files, offline_backup_dst_folder,
+                                                 os.path.basename(offline_backup_folder), workers, copy_hashes)
+            offline_backed_up_files = report_failed_copies(failed_copies, folder,
+                                                           [f.record.path for f in plan.offline_files],
+                                                           current_manifest)
+
+        print("Moving offline backup folder...")
+        if not skip_offline_backup and (os.path.isdir(offline_backup_folder) or link_snapshots and plan.offline_files):
+            list_offline_files = open(get_offline_list_path(folder), 'w')
+            for f in offline_backed_up_files:
+                list_offline_files.write(f + '\n')
+            list_offline_files.close()
+            if not link_snapshots:
+                move_folder_with_sandwiched_timestamp(offline_backup_folder, offline_backup_dst_folder)
+            upload_file(list_offline_files.name, 1, dst_folder_id, report_free_space=True)
+        if not skip_offline_backup and keep_snapshots:
+            with metrics.phase("delete"):
+                prune_snapshots(offline_backup_dst_folder, os.path.basename(offline_backup_folder), keep_snapshots)
+        print("Entire offline backup process completed.")
+        if copy_hashes:
+            record_hashes("offline", {f.rel_filepath: copy_hashes[f.record.path] for f in plan.offline_files
+                                      if f.record.path in copy_hashes})
+        if incremental:
+            # only replaces the manifest once the upload has completed, possibly in a later run resuming it
+            save_manifest(manifest_path + PENDING_SUFFIX, folder, current_manifest)
+
+    def backup_online():
+        if chunk_store:
+            print("Backing up online files to the chunk store...")
+            # the pack folder is a sibling of the work folder, like the backup folders
+            pack_folder = os.path.join(parent_folder, f"{os.path.basename(folder)}_chunk_packs")
+            with ChunkStore(dst_folder_id, pack_folder, compresslevel) as store:
+                store.backup(plan.online_files, f"{dt_string}_{os.path.basename(folder)}", folder)
+        elif zip_mode == ZIP_STREAMED_UPLOAD and volume_size_mb:
+            print("Zipping and uploading online backup...")
+            # at most upload_workers volumes are uploading and as many are waiting on disk while the zip is written
+            with ZipSegments(online_backup_zip, volume_size_mb << 20, online_backup_files, extra_zip_members,
+                             compresslevel, compress_workers, max_pending=upload_workers,
+                             max_size=overall_online_limit << 20) as zip_segments:
+                upload_segments(zip_segments, os.path.basename(online_backup_zip), volume_size_mb << 20,
+                                dst_folder_id, upload_workers, report_free_space=True)
+            upload_zip_index(zip_segments.index, os.path.basename(online_backup_zip), dst_folder_id, full_zip)
+            record_zip_hashes(zip_segments.index)
+            zip_failures.extend(zip_segments.failed)
+        elif zip_mode == ZIP_STREAMED_UPLOAD:
+            print("Zipping and uploading online backup...")
+            with ZipStream(online_backup_files, extra_zip_members, compresslevel, compress_workers) as zip_stream:
+                upload_stream(zip_stream, os.path.basename(online_backup_zip), 0, dst_folder_id,
+                              max_size_mb=overall_online_limit, report_free_space=True)
+            upload_zip_index(zip_stream.index, os.path.basename(online_backup_zip), dst_folder_id, full_zip)
+            record_zip_hashes(zip_stream.index)
+            zip_failures.extend(zip_stream.failed)
+        else:
+            print("Zipping online backup...")
+            if zip_mode == ZIP_STREAMED:
+                failed_members = []
+                index = write_zip(online_backup_zip, online_backup_files, extra_zip_members, compresslevel,
+                                  compress_workers, failed_members)
+                report_failed_copies(failed_members, folder, [], current_manifest, action="zipped")
+                if incremental and failed_members:
+                    # a later run resuming an interrupted upload commits the pending manifest as it is
+                    save_manifest(manifest_path + PENDING_SUFFIX, folder, current_manifest)
+            else:
+                staged_files = [(os.path.join(path, filename),
+                                 os.path.relpath(os.path.join(path, filename), online_backup_folder))
+                                for path, _, filenames in os.walk(online_backup_folder) for filename in filenames]
+                index = write_zip(online_backup_zip, staged_files, compresslevel=compresslevel,
+                                  workers=compress_workers)
+            print("Zipping completed")
+            if get_file_size_mb(online_backup_zip) > overall_online_limit:
+                raise ValueError(f"Online backup zip file is too large ({os.path.getsize(online_backup_zip) / (1 << 20)} MB) to be uploaded. \
+                    Please tighten online backup criteria")
+            if volume_size_mb:
+                upload_volumes(online_backup_zip, volume_size_mb, dst_folder_id, upload_workers, report_free_space=True)
+            else:
+                upload_file(online_backup_zip, 0, dst_folder_id, report_free_space=True)
+            upload_zip_index(index, os.path.basename(online_backup_zip), dst_folder_id, full_zip)
+            record_zip_hashes(index)
+
+    with ThreadPoolExecutor(max_workers=1) as offline_executor:
+        if pipelined:
+            offline_future = offline_executor.submit(backup_offline)
+        else:
+            backup_offline()
+            if zip_mode == ZIP_STAGED and not chunk_store:
+                os.makedirs(online_backup_folder, exist_ok=True)
+                for arcname, data in extra_zip_members:
+                    with open(os.path.join(online_backup_folder, arcname), 'w') as f:
+                        f.write(data)
+        backup_online()
+        if pipelined:
+            offline_future.result()
+    # reported once the offline backup is done, since it may still be saving current_manifest until then
+    report_failed_copies(zip_failures, folder, [], current_manifest, action="zipped")
+    if file_hashes["online"] or file_hashes["offline"]:
+        upload_file_hashes(file_hashes, f"{dt_string}_{os.path.basename(folder)}", folder, dst_folder_id)
+    if incremental:
+        # saved again since the hashes of the online files are only known once they have been zipped
+        save_manifest(manifest_path + PENDING_SUFFIX, folder, current_manifest)
+        commit_pending_manifest(manifest_path)
 
     print("Removing backup zip file and folders")
-    Path(online_backup_zip).unlink(missing_ok=True)
-    shutil.rmtree(online_backup_folder, ignore_errors=True, onerror=remove_readonly)
-    shutil.rmtree(offline_backup_folder, ignore_errors=True)
+    with metrics.phase("delete"):
+        Path(online_backup_zip).unlink(missing_ok=True)
+        shutil.rmtree(online_backup_folder, ignore_errors=True, onerror=remove_readonly)
+        shutil.rmtree(offline_backup_folder, ignore_errors=True)
     print("Program completed successfully. Reminder to delete the older zip file in your google drive (and offline backup).")
 
 
-def belongs_to(path, excluded_full_path):
+class BackupRoot(NamedTuple):
+    folder: str
+    file_size_limit: int
+    overall_online_limit: int
+    max_files_per_dir: int
+
+
+def load_backup_roots(folders, config_file, file_size_limit, overall_online_limit, max_files_per_dir):
     """
-    Returns true if path equals to or is a subdirectory of excluded_full_path
+    Returns a BackupRoot for every work folder in folders and in config_file, a JSON file like
+    {"roots": ["/path/to/work", {"d": "/path/to/other", "fl": 100, "ol": 5000, "m": 500}]}
+    where a root can override the -fl, -ol and -m limits given on the command line. Relative paths in config_file are
+    relative to the folder of config_file. Every root must have a different folder name, since the manifest, offline
+    list, zips and offline backups of a root are named after it.
     """
-    if path == excluded_full_path or Path(excluded_full_path).resolve() in Path(path).resolve().parents:
-        return True
-    return False
+    roots = [BackupRoot(os.path.abspath(folder), file_size_limit, overall_online_limit, max_files_per_dir)
+             for folder in folders]
+    if config_file:
+        with open(config_file) as f:
+            config = json.load(f)
+        config_folder = os.path.dirname(os.path.abspath(config_file))
+        for root in config.get("roots", []):
+            if isinstance(root, str):
+                root = {"d": root}
+            roots.append(BackupRoot(os.path.abspath(os.path.join(config_folder, root["d"])),
+                                    root.get("fl", file_size_limit), root.get("ol", overall_online_limit),
+                                    root.get("m", max_files_per_dir)))
+    if not roots:
+        raise ValueError("No work folder to back up")
+    names = [os.path.basename(root.folder) for root in roots]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Work folders must have different names, found several named {', '.join(duplicates)}")
+    return roots
 
 
-def segregate_files_into_online_offline_backup(input_folder: str, file_size_limit: int, max_files_per_dir: int,
-                                               skip_offline_backup: int, offline_backup_folder: str,
-                                               online_backup_folder: str, restrict_certain_file_sizes: int):
+def backup_roots(roots, root_workers, workers=1, upload_workers=4, **options):
     """
-    Segregate files into online and offline backups, refer README for conditions that can be specified on cmd line
+    Backs up several work folders with backup_folder, root_workers of them at a time, each with its own limits, zips,
+    manifest and offline list. Their copies share a single pool of workers threads and their uploads a single queue
+    of upload_workers slots, so backing up more folders at once doesn't multiply the load on the disk and the network.
+    A folder whose backup fails doesn't stop the others, the failures are raised together once all are done.
+
     Parameters
     ----------
-    input_folder: Work Folder to be backed up
-    file_size_limit: (MB) Each individual file or sum of nested sizes in git or virtualenv folders
-    max_files_per_dir: Maximum number of files allowed in each directory for online backup
-    skip_offline_backup
-    offline_backup_folder: Temporary folder for offline backup files before moving to the location defined in .env
-    online_backup_folder: Temporary folder for online backup files before being zipped and uploaded to drive
-    restrict_certain_file_sizes
+    roots: List of BackupRoot
+    root_workers: Number of folders scanned and archived concurrently
+    options: Other keyword arguments of backup_folder, the same for every folder
     """
+    failed = []
+    with shared_copy_pool(workers), shared_upload_queue(upload_workers), \
+            ThreadPoolExecutor(max_workers=root_workers) as executor:
+        futures = {executor.submit(backup_folder, root.folder, root.file_size_limit, root.overall_online_limit,
+                                   root.max_files_per_dir, workers=workers, upload_workers=upload_workers,
+                                   **options): root.folder
+                   for root in roots}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Backup of {futures[future]} failed: {e!r}")
+                failed.append((futures[future], e))
+    if failed:
+        raise RuntimeError(f"Backup of {len(failed)} of {len(roots)} work folders failed: "
+                           + ", ".join(f"{folder} ({e!r})" for folder, e in failed)) from failed[0][1]
+    print(f"All {len(roots)} work folders were backed up")
+
+
+def watch_folder(folder, interval_minutes, run_backup):
+    """
+    Runs until interrupted: changes in folder are journaled (see watcher.ChangeJournal) and every interval_minutes, or
+    as soon as the process receives SIGUSR1, run_backup(changed_dirs) takes an incremental backup of the folders that
+    changed since the previous backup. The first backup, and any backup after the journal overflowed, scans the whole
+    folder (changed_dirs is None). No backup is taken if nothing changed, and no two backups start within the same
+    second, which names their files (see new_dt_string).
+    """
+    folder = os.path.abspath(folder)
+    validate_folder(folder)
+    journal = ChangeJournal(get_journal_path(folder))
+    # started before the first backup scans the folder, so that no change made during that scan is missed
+    watcher = start_watcher(folder, ExclusionRules.load(folder), journal)
+    backup_now = threading.Event()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: backup_now.set())
+    print(f"Watching {folder} for changes, backing up every {interval_minutes} minutes (or on SIGUSR1 to process "
+          f"{os.getpid()})")
+    previous_end = 0
     try:
-        from secret_constants import excluded_dirs, restricted_extensions, restricted_max_file_size_mb
-    except ImportError:
-        # default values if secret_constants.py isn't in the project's root dir
-        excluded_dirs = [".git"]
-        restricted_extensions = [".mp4", ".mkv", ".h5", ".weights"]
-        restricted_max_file_size_mb = 20
-
-    excluded_dir_full_paths = [] # stores abspath of folders excluded, to prevent running glob on their subfolders
-    count = 0
-    offline_backed_up_files = []
-    files_per_path = {}  # stores no. of files in each path in input_folder, key is slash separated
+        while True:
+            if not watcher.is_alive():
+                watcher = start_watcher(folder, ExclusionRules.load(folder), journal)
+                journal.mark_overflow()
+            changes = journal.take()
+            if find_interrupted_upload(folder) is None and not changes.rescan and not changes.dirs:
+                print("Nothing changed since the previous backup")
+                journal.commit()
+            else:
+                if int(time.time()) == int(previous_end):
+                    # an on-demand backup right after the previous one must not reuse the names of its files
+                    time.sleep(1 - time.time() % 1)
+                try:
+                    if find_interrupted_upload(folder) is not None:
+                        run_backup(None)  # only resumes the interrupted upload
+                    run_backup(None if changes.rescan else changes.dirs)
+                except Exception as e:
+                    print(f"Backup failed, the changes will be backed up by the next one: {e!r}")
+                else:
+                    journal.commit()
+                finally:
+                    previous_end = time.time()
+            backup_now.wait(interval_minutes * 60)
+            backup_now.clear()
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.stop()
+        journal.close()
+
+
+def get_offline_list_path(folder):
+    """
+    List of the files of a work folder that went to the offline backup, stored in the project's root dir (gitignored)
+    and uploaded to the drive folder
+    """
+    return os.path.join(Path(__file__).resolve().parent, f"{os.path.basename(os.path.abspath(folder))}"
+                                                         f"{OFFLINE_LIST_SUFFIX}")
+
+
+def get_index_folder():
+    """
+    Folder of the project's root dir (gitignored) where the zip indexes and file hashes of every run are kept
+    """
+    return os.path.join(Path(__file__).resolve().parent, INDEX_FOLDER)
+
+
+def get_zip_index_path(zip_name):
+    """
+    Indexes of the online zips are kept in the backup_indexes folder, so that restore.py doesn't even have to download
+    them
+    """
+    return os.path.join(get_index_folder(), zip_name + ZIP_INDEX_SUFFIX)
+
+
+def upload_zip_index(index, zip_name, dst_folder_id, full=True):
+    """
+    Saves the archive.zip_index of an uploaded online zip and uploads it next to the zip as <zip name>.index.json.gz.
+    full tells restore.py whether the zip contains every online file, or only the changes since an earlier
+    incremental zip.
+    """
+    index = dict(index, full=bool(full))
+    index_path = get_zip_index_path(zip_name)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    save_zip_index(index, index_path)
+    upload_file(index_path, 0, dst_folder_id)
+
+
+def upload_file_hashes(file_hashes, name, folder, dst_folder_id):
+    """
+    Saves the md5 of every file backed up by a run, {"online": {rel_filepath: md5}, "offline": {...}}, to the
+    backup_indexes folder as <name>_file_hashes.json.gz and uploads it, so that the backup can later be verified
+    without reading the work folder
+    """
+    hashes_path = os.path.join(get_index_folder(), name + FILE_HASHES_SUFFIX)
+    os.makedirs(os.path.dirname(hashes_path), exist_ok=True)
+    with gzip.open(hashes_path, 'wt') as f:
+        json.dump(dict(file_hashes, version=FILE_HASHES_VERSION, root=folder), f)
+    upload_file(hashes_path, 0, dst_folder_id)
+
+
+def new_dt_string(folder):
+    """
+    Returns the date of a new run of folder, appended to the names of its files. A run starting within the same second
+    as an earlier run of folder whose index or file hashes are in the backup_indexes folder waits for the next second,
+    so that the files of two runs never share a name in the drive folder
+    """
+    index_folder = get_index_folder()
+    while True:
+        dt_string = datetime.now().strftime(DT_FORMAT)
+        prefix = f"{dt_string}_{os.path.basename(folder)}_"
+        if not os.path.isdir(index_folder) or not any(f.startswith(prefix) for f in os.listdir(index_folder)):
+            return dt_string
+        time.sleep(1 - datetime.now().microsecond / 1e6)
+
+
+def find_interrupted_upload(folder):
+    """
+    Returns the online zip of folder left behind by a run whose upload was interrupted, or None
+    """
+    zip_pattern = re.compile(r"\d{2}_\d{2}_\d{4}_\d{2}_\d{2}(_\d{2})?_" + re.escape(os.path.basename(folder))
+                             + r"_online_backup(_incremental)?\.zip\Z")
+    parent_folder = str(Path(folder).resolve().parent)
+    for filepath in get_pending_uploads():
+        if os.path.dirname(filepath) == parent_folder and zip_pattern.match(os.path.basename(filepath)):
+            return filepath
+    return None
+
+
+class PlannedFile(NamedTuple):
+    record: FileRecord
+    rel_filepath: str
 
-    for path, dirnames, filenames in os.walk(input_folder):
-        for src_filename in filenames:
-            src_filepath = os.path.join(path, src_filename)
-            if not os.path.isfile(src_filepath):
-                continue
 
-            subfolder_wrt_input_root = os.path.dirname(os.path.relpath(src_filepath, input_folder))
-            file_size_mb = get_file_size_mb(src_filepath)
+class BackupPlan(NamedTuple):
+    online_files: List[PlannedFile]
+    offline_files: List[PlannedFile]  # empty if offline backup is skipped
+    count: int  # number of files segregated, including the ones unchanged since the previous incremental run
 
-            if path not in files_per_path:
-                files_per_path[path] = len(os.listdir(path))
 
+def plan_backup(input_folder: str, file_size_limit: int, max_files_per_dir: int, skip_offline_backup: int,
+                restrict_certain_file_sizes: int, previous_manifest: dict = None, current_manifest: dict = None,
+                use_hash: int = 0, changed_dirs=None):
+    """
+    Decide from file metadata alone which files are backed up online and which offline, without copying anything.
+    Parameters are the same as segregate_files_into_online_offline_backup, and if changed_dirs (folders relative to
+    input_folder, "." being input_folder itself) is given along with previous_manifest, only the files directly inside
+    these folders are scanned, all the others are known to be unchanged since the previous run.
+    """
+    metrics = get_run_metrics()
+    rules = ExclusionRules.load(input_folder)
+    count = 0
+    online_files = []
+    offline_files = []
+    # single scandir pass, every file is stat'ed once and the records are reused by all checks and copies
+    with metrics.phase("scan"):
+        if changed_dirs is not None and previous_manifest is not None:
+            for rel_filepath, entry in previous_manifest.items():
+                if (os.path.dirname(rel_filepath) or os.curdir) not in changed_dirs:
+                    current_manifest[rel_filepath] = entry
+            # deleted folders can't be scanned, their files are simply left out of current_manifest
+            dir_records = [dir_record for dir_record in (scan_dir(os.path.normpath(os.path.join(input_folder, d)),
+                                                                  rules.prune_dirnames)
+                                                         for d in sorted(changed_dirs)) if dir_record is not None]
+            print(f"Scanned the {len(dir_records)} folders changed since the previous backup")
+        else:
+            dir_records = scan_tree(input_folder, rules.prune_dirnames)
+    metrics.add("scan", sum(len(d.files) for d in dir_records), sum(f.size for d in dir_records for f in d.files))
+    with metrics.phase("exclusion_check"):
+        # total nested size of every dir, for the excluded_dirs check. Sizes of a partial scan would be wrong, they are
+        # then computed by recursive_file_size_check for the excluded dirs that are actually checked.
+        dir_sizes = build_dir_size_index(dir_records) if changed_dirs is None else {}
+        for dir_record in dir_records:
+            path = dir_record.path
             # If the total size of all files recursively in the git dir is greater than the normal individual file_size_limit, skip it
-            is_excluded_dir = False
-            if any(belongs_to(path, excluded_full_path) for excluded_full_path in excluded_dir_full_paths):
-                # if path is the subdir of a full path already excluded via glob, directly exclude this file
-                is_excluded_dir = True
-            else:
-                for excluded_dir in excluded_dirs:
-                    is_excluded_dir = recursive_file_size_check(path, file_size_limit, excluded_dir)
-                    if is_excluded_dir:
-                        excluded_dir_full_paths.append(path)
-                        print(f"Files under {path} excluded from online backup")
-                        break
-
-            is_restricted_file = False
-            # Files ending in restricted_extensions are subject to the lower restricted_max_file_size_mb limit,
-            # instead of file_size_limit
-            if restrict_certain_file_sizes == 1 and any(
-                    x in src_filename for x in restricted_extensions) and file_size_mb > restricted_max_file_size_mb:
-                is_restricted_file = True
-
-            if file_size_mb > file_size_limit or files_per_path[
-                path] > max_files_per_dir or is_excluded_dir or is_restricted_file:
-                offline_backed_up_files.append(src_filepath)
-                os.makedirs(os.path.join(offline_backup_folder, subfolder_wrt_input_root), exist_ok=True)
-                custom_copy(src_filepath, os.path.join(offline_backup_folder, subfolder_wrt_input_root, src_filename))
+            is_excluded_dir = rules.is_excluded_dir(path, file_size_limit, dir_sizes)
+            if is_excluded_dir and skip_offline_backup and previous_manifest is None:
+                # its files would only have been backed up offline, so they can be skipped
+                continue
+            is_crowded_dir = dir_record.entry_count > max_files_per_dir
+            subfolder_wrt_input_root = os.path.relpath(path, input_folder)
+            if subfolder_wrt_input_root == os.curdir:
+                subfolder_wrt_input_root = ""
+
+            for file_record in dir_record.files:
+                src_filename = file_record.name
+                rel_filepath = os.path.join(subfolder_wrt_input_root, src_filename)
+                if rules.has_ignore_patterns and rules.is_ignored(rel_filepath):
+                    continue
+                file_size_mb = file_record.size / (1 << 20)
+
+                is_restricted_file = restrict_certain_file_sizes == 1 and rules.is_restricted_file(src_filename,
+                                                                                                   file_size_mb)
+
+                is_unchanged = False
+                if previous_manifest is not None:
+                    is_unchanged = not has_file_changed(rel_filepath, file_record, previous_manifest,
+                                                        current_manifest, use_hash)
+
+                if is_unchanged:
+                    # Already backed up by a previous incremental run
+                    pass
+
+                elif file_size_mb > file_size_limit or is_crowded_dir or is_excluded_dir or is_restricted_file:
+                    if not skip_offline_backup:
+                        offline_files.append(PlannedFile(file_record, rel_filepath))
+
+                else:
+                    online_files.append(PlannedFile(file_record, rel_filepath))
 
+                count += 1
+                if count in [1, 2, 100, 200, 500] or count % 1000 == 0:
+                    print(f"{count} files processed")
+    metrics.add("exclusion_check", count, sum(f.record.size for f in online_files + offline_files))
+    return BackupPlan(online_files, offline_files, count)
+
+
+def estimate_online_zip_size_mb(plan: BackupPlan, compresslevel=DEFAULT_COMPRESSLEVEL):
+    return sum(estimate_compressed_size(f.rel_filepath, f.record.size, compresslevel)
+               for f in plan.online_files) / (1 << 20)
+
+
+def enforce_online_limit(plan: BackupPlan, overall_online_limit, compresslevel=DEFAULT_COMPRESSLEVEL,
+                         auto_tighten=0, skip_offline_backup=0, previous_manifest: dict = None,
+                         current_manifest: dict = None):
+    """
+    Checks the estimated size of the online zip before anything is copied. If it exceeds overall_online_limit, either
+    raise a ValueError or, with auto_tighten, move the largest online files to the offline backup until it fits.
+    Returns the plan that should be executed. If the offline backup is skipped, the moved files aren't backed up at
+    all, so their entries in current_manifest are reverted to previous_manifest (or removed, for new files) and the
+    next incremental run tries to back them up again.
+    """
+    estimated_size_mb = estimate_online_zip_size_mb(plan, compresslevel)
+    print(f"Estimated online backup zip size: {round(estimated_size_mb, 2)} MB")
+    if estimated_size_mb <= overall_online_limit:
+        return plan
+    if not auto_tighten:
+        raise ValueError(f"Online backup zip file is estimated to be too large ({round(estimated_size_mb, 2)} MB) to be "
+                         f"uploaded. Please tighten online backup criteria")
+
+    online_files = sorted(plan.online_files, key=lambda f: estimate_compressed_size(f.rel_filepath, f.record.size,
+                                                                                    compresslevel))
+    moved_files = []
+    while online_files and estimated_size_mb > overall_online_limit:
+        f = online_files.pop()
+        estimated_size_mb -= estimate_compressed_size(f.rel_filepath, f.record.size, compresslevel) / (1 << 20)
+        moved_files.append(f)
+    print(f"Moved the {len(moved_files)} largest files out of the online backup to fit within {overall_online_limit} MB"
+          + (", they are not backed up since offline backup is skipped" if skip_offline_backup else ""))
+    if skip_offline_backup and current_manifest is not None:
+        for f in moved_files:
+            # reverted rather than removed, so that they aren't listed as deleted by this run's incremental zip
+            if f.rel_filepath in (previous_manifest or {}):
+                current_manifest[f.rel_filepath] = previous_manifest[f.rel_filepath]
             else:
-                if not skip_offline_backup:
-                    os.makedirs(os.path.join(online_backup_folder, subfolder_wrt_input_root), exist_ok=True)
-                    custom_copy(src_filepath,
-                                os.path.join(online_backup_folder, subfolder_wrt_input_root, src_filename))
+                current_manifest.pop(f.rel_filepath, None)
+    moved_filepaths = {f.record.path for f in moved_files}
+    online_files = [f for f in plan.online_files if f.record.path not in moved_filepaths]
+    offline_files = plan.offline_files if skip_offline_backup else plan.offline_files + moved_files
+    return BackupPlan(online_files, offline_files, plan.count)
+
+
+def plan_to_json(plan: BackupPlan, input_folder, overall_online_limit, compresslevel=DEFAULT_COMPRESSLEVEL):
+    """
+    Summary of a plan for --dry-run, with the online and offline bytes of every directory including its subfolders
+    """
+    directories = {}
+    for kind, planned_files in (("online", plan.online_files), ("offline", plan.offline_files)):
+        for f in planned_files:
+            rel_dir = os.path.dirname(f.rel_filepath)
+            while True:
+                totals = directories.setdefault(rel_dir or os.curdir, {"online_files": 0, "online_bytes": 0,
+                                                                       "offline_files": 0, "offline_bytes": 0})
+                totals[f"{kind}_files"] += 1
+                totals[f"{kind}_bytes"] += f.record.size
+                if not rel_dir:
+                    break
+                rel_dir = os.path.dirname(rel_dir)
+
+    estimated_size_mb = estimate_online_zip_size_mb(plan, compresslevel)
+    return {
+        "folder": os.path.abspath(input_folder),
+        "file_count": plan.count,
+        "online": {
+            "file_count": len(plan.online_files),
+            "bytes": sum(f.record.size for f in plan.online_files),
+            "estimated_zip_mb": round(estimated_size_mb, 2),
+            "within_online_limit": estimated_size_mb <= overall_online_limit,
+            "files": [f.rel_filepath for f in plan.online_files],
+        },
+        "offline": {
+            "file_count": len(plan.offline_files),
+            "bytes": sum(f.record.size for f in plan.offline_files),
+            "files": [f.rel_filepath for f in plan.offline_files],
+        },
+        "directories": dict(sorted(directories.items())),
+    }
+
+
+def execute_backup_plan(plan: BackupPlan, input_folder: str, offline_backup_folder: str, online_backup_folder: str,
+                        workers: int = 1, online_backup_files: list = None, current_manifest: dict = None,
+                        hashes: dict = None):
+    """
+    Copy the files of a plan into the backup folders. Parameters are the same as
+    segregate_files_into_online_offline_backup, returns the list of files backed up offline. If hashes is given, every
+    copied file is hashed on the way and hashes[src_filepath] is set to its md5.
+    """
+    # the offline file list follows the plan, so it doesn't depend on copy completion order
+    offline_backed_up_files = [f.record.path for f in plan.offline_files]
+    copy_jobs = [CopyJob(f.record.path, os.path.join(offline_backup_folder, f.rel_filepath), f.record.size,
+                         f.record.mode) for f in plan.offline_files]
+    if online_backup_files is not None:
+        online_backup_files.extend((f.record.path, f.rel_filepath) for f in plan.online_files)
+    else:
+        copy_jobs.extend(CopyJob(f.record.path, os.path.join(online_backup_folder, f.rel_filepath), f.record.size,
+                                 f.record.mode) for f in plan.online_files)
+
+    print(f"Copying {len(copy_jobs)} files using {workers} worker(s)...")
+    failed_copies = copy_files(copy_jobs, workers, hashes)
+    return report_failed_copies(failed_copies, input_folder, offline_backed_up_files, current_manifest)
 
-            count += 1
-            if count in [1, 2, 100, 200, 500] or count % 1000 == 0:
-                print(f"{count} files processed")
-    return offline_backed_up_files, count
 
-def recursive_file_size_check(path, file_size_limit, delimiter):
+def report_failed_copies(failed_copies, input_folder, offline_backed_up_files, current_manifest=None,
+                         action="copied"):
     """
-    If the total size of all files recursively in the git dir is greater than the normal individual file_size_limit,
-    return True to tell the caller that the folder should be skipped
+    Prints the files that could not be copied (or zipped, etc. as told by action) and leaves them out of this backup.
+    Returns offline_backed_up_files without them.
+    """
+    if not failed_copies:
+        return offline_backed_up_files
+    print(f"{len(failed_copies)} files could not be {action} and are left out of this backup:")
+    for src_filepath, error in failed_copies:
+        print(f"{src_filepath}: {error}")
+    failed_filepaths = {src_filepath for src_filepath, _ in failed_copies}
+    if current_manifest is not None:
+        # so that the next incremental run tries to back them up again
+        for src_filepath in failed_filepaths:
+            current_manifest.pop(os.path.relpath(src_filepath, input_folder), None)
+    return [f for f in offline_backed_up_files if f not in failed_filepaths]
+
 
+def segregate_files_into_online_offline_backup(input_folder: str, file_size_limit: int, max_files_per_dir: int,
+                                               skip_offline_backup: int, offline_backup_folder: str,
+                                               online_backup_folder: str, restrict_certain_file_sizes: int,
+                                               previous_manifest: dict = None, current_manifest: dict = None,
+                                               use_hash: int = 0, workers: int = 1,
+                                               online_backup_files: list = None):
+    """
+    Segregate files into online and offline backups, refer README for conditions that can be specified on cmd line
     Parameters
     ----------
-    path: Full path to be checked, part of this path contains the delimiter
-    file_size_limit: Normal individual file size limit
-    delimiter: .git or venv (virtualenv folder name defiled in .env, fetched by caller)
+    input_folder: Work Folder to be backed up
+    file_size_limit: (MB) Each individual file or sum of nested sizes in git or virtualenv folders
+    max_files_per_dir: Maximum number of files allowed in each directory for online backup
+    skip_offline_backup
+    offline_backup_folder: Temporary folder for offline backup files before moving to the location defined in .env
+    online_backup_folder: Temporary folder for online backup files before being zipped and uploaded to drive
+    restrict_certain_file_sizes
+    previous_manifest: Manifest entries of the previous incremental run, if given unchanged files are not copied
+    current_manifest: Dict filled in with the manifest entries of every file seen in this run, if previous_manifest
+                      is given
+    use_hash: Compare content hashes of files whose size or mtime changed (incremental mode)
+    workers: Number of files copied concurrently into the backup folders
+    online_backup_files: If given, (src_filepath, arcname) of online files are appended to it instead of copying them
+                         into online_backup_folder
     """
-    if delimiter in path:
-        path_upto_git = path.partition(delimiter)[0]
-        if sum(f.stat().st_size for f in Path(path_upto_git).glob('**/*') if f.is_file()) / (
-                1 << 20) > file_size_limit:
-            return True
-    return False
+    plan = plan_backup(input_folder, file_size_limit, max_files_per_dir, skip_offline_backup,
+                       restrict_certain_file_sizes, previous_manifest, current_manifest, use_hash)
+    offline_backed_up_files = execute_backup_plan(plan, input_folder, offline_backup_folder, online_backup_folder,
+                                                  workers, online_backup_files, current_manifest)
+    return offline_backed_up_files, plan.count
+
+
+def dry_run(folder, file_size_limit, overall_online_limit, max_files_per_dir, skip_offline_backup,
+            restrict_certain_file_sizes, incremental=0, use_hash=0, compresslevel=DEFAULT_COMPRESSLEVEL,
+            auto_tighten=0):
+    """
+    Returns the plan that backup_folder would execute, as a JSON serialisable dict. Nothing is copied, uploaded or
+    saved, and progress messages go to stderr so that stdout only contains the plan.
+    """
+    folder = os.path.abspath(folder)
+    validate_folder(folder)
+    with redirect_stdout(sys.stderr):
+        previous_manifest = load_manifest(get_manifest_path(folder), folder) if incremental else None
+        plan = plan_backup(folder, file_size_limit, max_files_per_dir, skip_offline_backup,
+                           restrict_certain_file_sizes, previous_manifest, {} if incremental else None, use_hash)
+        if auto_tighten:
+            plan = enforce_online_limit(plan, overall_online_limit, compresslevel, auto_tighten, skip_offline_backup)
+    return plan_to_json(plan, folder, overall_online_limit, compresslevel)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", required=True, help="Relative or absolute path to work folder to be backed up")
+    parser.add_argument("-d", nargs="+", default=[],
+                        help="Relative or absolute path to work folder to be backed up, several work folders are "
+                             "backed up concurrently")
+    parser.add_argument("-cf", help="JSON file listing work folders to be backed up along with the -d ones, "
+                                    "optionally with their own -fl, -ol and -m limits, see the README")
+    parser.add_argument("-rw", type=int, default=None,
+                        help="Number of work folders backed up concurrently, default: all of them")
     parser.add_argument("-fl", type=int, default=300,
                         help="Maximum size of file in MB that is allowed to be backed up online, default:%(default)s")
     parser.add_argument("-ol", type=int, default=3000,
@@ -202,12 +776,155 @@ def main():
                         help="Specify whether to skip offline backup, default:%(default)s")
     parser.add_argument("-r", type=int, choices=[0, 1], default=1,
                         help="Specify whether to restrict file sizes for certain file types to 20 MB, default:%(default)s")
+    parser.add_argument("-i", type=int, choices=[0, 1], default=0,
+                        help="Specify whether to only back up files that are new or changed since the previous "
+                             "incremental run, default:%(default)s")
+    parser.add_argument("-hc", type=int, choices=[0, 1], default=0,
+                        help="Specify whether to compare content hashes of files whose size or modification time "
+                             "changed, in incremental mode, default:%(default)s")
+    parser.add_argument("-z", type=int, choices=[ZIP_STAGED, ZIP_STREAMED, ZIP_STREAMED_UPLOAD], default=ZIP_STAGED,
+                        help="Specify how the online zip is built: 0 copies files into a staging folder first, 1 "
+                             "writes them straight into the zip, 2 also uploads the zip while it is being written "
+                             "instead of storing it on disk, default:%(default)s")
+    parser.add_argument("-cl", type=int, choices=range(10), default=DEFAULT_COMPRESSLEVEL, metavar="{0-9}",
+                        help="Compression level of the online zip, 0 stores files without compression, "
+                             "default:%(default)s")
+    parser.add_argument("-cw", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes compressing files into the online zip, default: number of CPUs "
+                             "(%(default)s)")
+    parser.add_argument("-at", type=int, choices=[0, 1], default=0,
+                        help="Specify whether to move the largest files to the offline backup when the online zip is "
+                             "estimated to exceed -ol, instead of stopping, default:%(default)s")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the backup plan and per-directory sizes as JSON without copying or uploading "
+                             "anything")
+    parser.add_argument("-ls", type=int, choices=[0, 1], default=0,
+                        help="Specify whether offline backups are snapshots where files unchanged since the previous "
+                             "snapshot are hard-linked to it instead of being copied, default:%(default)s")
+    parser.add_argument("-ks", type=int, default=0,
+                        help="Number of most recent offline backups of this folder to keep in WORK_BACKUP, older ones "
+                             "are deleted, 0 keeps all of them, default:%(default)s")
+    parser.add_argument("-vs", type=int, default=0,
+                        help="Size in MB of the volumes the online zip is split into and uploaded concurrently, 0 "
+                             "uploads it as a single file, default:%(default)s")
+    parser.add_argument("-uw", type=int, default=4,
+                        help="Number of files or volumes uploaded concurrently, smaller files first, "
+                             "default:%(default)s")
+    parser.add_argument("-bw", default=None,
+                        help="Upload bandwidth limit in MB/s, or limits by time of day like \"09:00-18:00=1.5,5\" "
+                             "(1.5 MB/s during working hours, 5 MB/s otherwise, 0 is unlimited), default: unlimited")
+    parser.add_argument("-cs", type=int, choices=[0, 1], default=0,
+                        help="Specify whether online files are backed up to a deduplicated chunk store on drive, "
+                             "uploading only content that was never uploaded before, instead of a zip, "
+                             "default:%(default)s")
+    parser.add_argument("-w", type=int, default=4,
+                        help="Number of files copied concurrently into the backup folders, default:%(default)s")
+    parser.add_argument("-ih", type=int, choices=[0, 1], default=0,
+                        help="Specify whether copied files are hashed while they are copied, so that the md5 of "
+                             "offline files is recorded too (online files are always hashed while they are zipped). "
+                             "Copies then go through Python instead of the kernel, default:%(default)s")
+    parser.add_argument("-mf", help="Write the time, files and bytes of every phase of the run, with its slowest files "
+                                    "and directories, as JSON to this file. If it is a folder, a "
+                                    "<date>_<work folder name>_metrics.json file is created in it on every run")
+    parser.add_argument("-pf", help="Profile the run with cProfile and save the stats to this file, which can be "
+                                    "read with python -m pstats")
+    parser.add_argument("-wt", type=int, default=0,
+                        help="Keep running and watch the work folder for changes, taking an incremental backup of the "
+                             "changed folders every this many minutes, 0 takes a single backup, default:%(default)s")
     args = vars(parser.parse_args())
-    start_time = time.time()
-    backup_folder(args["d"], args["fl"], args["ol"], args["m"], args["s"], args["r"])
-    minutes, seconds = divmod(time.time() - start_time, 60)
-    execution_time = f"{minutes:.0f} minutes and {seconds:.2f} seconds"
-    print(f"Execution time: {execution_time}")
+    if args["w"] < 1 or args["cw"] < 1:
+        parser.error("-w and -cw must be at least 1")
+    if args["ks"] < 0:
+        parser.error("-ks can't be negative")
+    if args["ks"] and args["i"]:
+        parser.error("-ks can't be used with -i 1, incremental offline backups only hold the files changed since the "
+                     "previous run, so deleting older ones would lose the only offline copy of the other files")
+    if args["vs"] < 0 or args["uw"] < 1:
+        parser.error("-vs can't be negative and -uw must be at least 1")
+    if args["cs"] and (args["i"] or args["vs"]):
+        parser.error("-cs snapshots are already deduplicated against every previous run, so they can't be used with "
+                     "-i or -vs")
+    if args["wt"] < 0 or args["wt"] and not args["i"]:
+        parser.error("-wt can't be negative and requires -i 1")
+    if args["rw"] is not None and args["rw"] < 1:
+        parser.error("-rw must be at least 1")
+    try:
+        set_bandwidth_limit(args["bw"])
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        roots = load_backup_roots(args["d"], args["cf"], args["fl"], args["ol"], args["m"])
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"Invalid work folders: {e}")
+    if args["wt"] and len(roots) > 1:
+        parser.error("-wt watches a single work folder")
+    if args["dry_run"]:
+        plans = {root.folder: dry_run(root.folder, root.file_size_limit, root.overall_online_limit,
+                                      root.max_files_per_dir, args["s"], args["r"], args["i"], args["hc"], args["cl"],
+                                      args["at"])
+                 for root in roots}
+        print(json.dumps(plans[roots[0].folder] if len(roots) == 1 else plans, indent=2))
+        return
+
+    def run_backup(changed_dirs=None):
+        start_time = time.time()
+        reset_run_metrics()
+        profiler = cProfile.Profile() if args["pf"] else None
+        error = None
+        try:
+            if profiler is not None:
+                # only the main thread is profiled, not copy, compression or upload workers (nor other work folders)
+                profiler.enable()
+            if len(roots) == 1:
+                root = roots[0]
+                with shared_upload_queue(args["uw"]):
+                    backup_folder(root.folder, root.file_size_limit, root.overall_online_limit,
+                                  root.max_files_per_dir, args["s"], args["r"], args["i"], args["hc"], args["w"],
+                                  args["z"], args["cl"], args["cw"], args["at"], args["ls"], args["ks"], args["vs"],
+                                  args["uw"], args["cs"], changed_dirs, args["ih"])
+            else:
+                backup_roots(roots, args["rw"] or len(roots), args["w"], args["uw"], skip_offline_backup=args["s"],
+                             restrict_certain_file_sizes=args["r"], incremental=args["i"], use_hash=args["hc"],
+                             zip_mode=args["z"], compresslevel=args["cl"], compress_workers=args["cw"],
+                             auto_tighten=args["at"], link_snapshots=args["ls"], keep_snapshots=args["ks"],
+                             volume_size_mb=args["vs"], chunk_store=args["cs"], integrity_hashes=args["ih"])
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args["pf"])
+            save_run_metrics(args, roots, error)
+        minutes, seconds = divmod(time.time() - start_time, 60)
+        execution_time = f"{minutes:.0f} minutes and {seconds:.2f} seconds"
+        print(f"Execution time: {execution_time}")
+
+    if args["wt"]:
+        watch_folder(roots[0].folder, args["wt"], run_backup)
+    else:
+        run_backup()
+
+
+def save_run_metrics(args, roots, error=None):
+    """
+    Prints the phases of the run and writes its metrics to the -mf file, if given. Metrics of a failed run are saved
+    too, with its error, so that a monitor can tell a failed nightly backup from a slow one.
+    """
+    metrics = get_run_metrics()
+    metrics.print_summary()
+    if not args["mf"]:
+        return
+    metrics_file = args["mf"]
+    if os.path.isdir(metrics_file):
+        metrics_file = os.path.join(metrics_file, f"{metrics.started_at.strftime('%d_%m_%Y_%H_%M')}_"
+                                                  f"{'_'.join(os.path.basename(root.folder) for root in roots)}"
+                                                  f"_metrics.json")
+    options = {k: v for k, v in args.items() if k not in ("d", "cf", "dry_run", "mf", "pf", "wt")}
+    folders = [root.folder for root in roots]
+    metrics.save(metrics_file, folder=folders[0] if len(folders) == 1 else folders, options=options,
+                 status="completed" if error is None else "failed", error=None if error is None else repr(error))
+    print(f"Run metrics written to {metrics_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+"""
+Local stand-in for the parts of the Drive v3 API used by upload_drive.py: resumable uploads (including querying an
+interrupted session), files.list by name or parent folder, files.update to trash, batch requests, about.get and
+ranged media downloads. Unless keep_data is set, uploaded data isn't kept, only its size and md5, so that multi-GB
+benchmarks don't need that much memory.
+"""
+import email.parser
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+import upload_drive
+
+
+class _UploadSession:
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.received = 0
+        self.md5 = hashlib.md5()
+        self.data = []  # received chunks, if the server keeps data
+        self.file = None  # set once the upload is complete
+
+
+class FakeDriveServer:
+    """
+    Serves the fake Drive API on 127.0.0.1 from a background thread.
+
+    Parameters
+    ----------
+    port: Port to listen on, 0 picks a free one
+    bandwidth_mb_s: If set, every upload request is slowed down to this throughput, to benchmark against a network
+                    link instead of the loopback interface
+    latency_ms: Delay added to every request, like the round trip to Drive
+    keep_data: Keep uploaded files in memory so that they can be downloaded, e.g. to benchmark restores
+    """
+
+    def __init__(self, port=0, bandwidth_mb_s=None, latency_ms=0, keep_data=False):
+        self.bandwidth_mb_s = bandwidth_mb_s
+        self.latency_ms = latency_ms
+        self.keep_data = keep_data
+        self.files = {}  # id -> {'id', 'name', 'parents', 'size', 'md5Checksum', 'trashed'}
+        self.data = {}  # id -> bytes, if keep_data
+        self.sessions = {}
+        self.request_count = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(_Handler):
+            fake = server
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def new_id(self):
+        with self._lock:
+            return f"fake{next(self._ids)}"
+
+    def build_service(self):
+        """
+        Drive service whose requests all go to this server
+        """
+        document = json.loads(get_static_doc("drive", "v3"))
+        document["rootUrl"] = self.url
+        document["mtlsRootUrl"] = self.url
+        return build_from_document(document, credentials=AnonymousCredentials())
+
+    def install(self):
+        """
+        Points upload_drive at this server instead of Google Drive, no credentials are needed. Environment variables
+        still have to be set (or a .env file present) for check_and_fetch_env_vars.
+        """
+        upload_drive.get_credentials = AnonymousCredentials
+        upload_drive.build = lambda *args, **kwargs: self.build_service()
+        upload_drive._credentials = None
+        upload_drive._thread_local = threading.local()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like Drive
+    fake = None  # FakeDriveServer, set by a subclass
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.fake.bandwidth_mb_s:
+            time.sleep(length / (self.fake.bandwidth_mb_s * (1 << 20)))
+        return body
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif self.fake.bandwidth_mb_s and content_type == "application/octet-stream":
+            time.sleep(len(body) / (self.fake.bandwidth_mb_s * (1 << 20)))
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        with self.fake._lock:
+            self.fake.request_count += 1
+        if self.fake.latency_ms:
+            time.sleep(self.fake.latency_ms / 1000)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = self._read_body()
+        status, response, headers = self.fake_dispatch(method, url.path, query, body, self.headers)
+        if isinstance(response, tuple):
+            content_type, response = response
+            self._send(status, response, headers, content_type)
+        else:
+            self._send(status, response, headers)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+    def fake_dispatch(self, method, path, query, body, headers):
+        """
+        Returns (status, dict or (content type, bytes), response headers)
+        """
+        fake = self.fake
+        if path == "/upload/drive/v3/files" and method == "POST":
+            session_id = fake.new_id()
+            fake.sessions[session_id] = _UploadSession(json.loads(body or b"{}"))
+            location = f"{fake.url}upload/drive/v3/files?uploadType=resumable&upload_id={session_id}"
+            return 200, {}, {"Location": location}
+        if path == "/upload/drive/v3/files" and method == "PUT":
+            return self._upload_chunk(fake.sessions.get(query.get("upload_id")), body, headers)
+        if path == "/drive/v3/files" and method == "GET":
+            return 200, {"files": self._list(query.get("q", ""))}, None
+        match = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+        if match and method == "PATCH":
+            return self._update(match.group(1), json.loads(body or b"{}"))
+        if match and method == "GET" and query.get("alt") == "media":
+            return self._download(match.group(1), headers.get("Range"))
+        if path == "/drive/v3/about" and method == "GET":
+            usage = sum(f["size"] for f in fake.files.values())
+            return 200, {"storageQuota": {"usageInDrive": str(usage), "usage": str(usage)}}, None
+        if path == "/batch/drive/v3" and method == "POST":
+            return self._batch(body, headers)
+        return 404, {"error": {"code": 404, "message": f"{method} {path} is not implemented by the fake server"}}, None
+
+    def _upload_chunk(self, session, body, headers):
+        if session is None:
+            return 404, {"error": {"code": 404, "message": "Upload session not found"}}, None
+        content_range = headers.get("Content-Range")
+        if session.file is not None:
+            return 200, session.file, None
+        if content_range is None:
+            # whole upload in one request
+            start, total = 0, str(len(body))
+        else:
+            match = re.fullmatch(r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)", content_range)
+            start = int(match.group(1)) if match.group(1) is not None else None
+            total = match.group(2)
+        if start is not None:
+            if start != session.received:
+                return 400, {"error": {"code": 400, "message": "Chunk doesn't start at the committed offset"}}, None
+            session.md5.update(body)
+            session.received += len(body)
+            if self.fake.keep_data:
+                session.data.append(body)
+        if total != "*" and session.received == int(total):
+            file_id = self.fake.new_id()
+            session.file = {"id": file_id, "name": session.metadata.get("name"),
+                            "parents": session.metadata.get("parents", []), "size": session.received,
+                            "md5Checksum": session.md5.hexdigest(), "trashed": False}
+            self.fake.files[file_id] = session.file
+            if self.fake.keep_data:
+                self.fake.data[file_id] = b"".join(session.data)
+                session.data = []
+            return 200, session.file, None
+        headers = {"Range": f"bytes=0-{session.received - 1}"} if session.received else {}
+        return 308, b"", headers
+
+    def _list(self, q):
+        match = re.search(r"name='((?:[^'\\]|\\.)*)'", q)
+        name = re.sub(r"\\(.)", r"\1", match.group(1)) if match else None
+        match = re.search(r"'([^']*)' in parents", q)
+        parent = match.group(1) if match else None
+        return [{"id": f["id"], "name": f["name"], "size": str(f["size"])} for f in self.fake.files.values()
+                if (name is None or f["name"] == name) and (parent is None or parent in f["parents"])
+                and not ("trashed=false" in q and f["trashed"])]
+
+    def _download(self, file_id, range_header):
+        data = self.fake.data.get(file_id)
+        if data is None:
+            return 404, {"error": {"code": 404, "message": f"No data kept for file {file_id}"}}, None
+        if range_header is None:
+            return 200, ("application/octet-stream", data), None
+        start, end = re.fullmatch(r"bytes=(\d+)-(\d+)", range_header).groups()
+        return 206, ("application/octet-stream", data[int(start):int(end) + 1]), None
+
+    def _update(self, file_id, metadata):
+        file = self.fake.files.get(file_id)
+        if file is None:
+            return 404, {"error": {"code": 404, "message": f"File not found: {file_id}"}}, None
+        file.update({k: v for k, v in metadata.items() if k in ("name", "trashed")})
+        return 200, {"id": file_id}, None
+
+    def _batch(self, body, headers):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+        boundary = "fake_batch_boundary"
+        parts = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().replace("\r\n", "\n").partition("\n")
+            method, target = request_line.split()[:2]
+            inner_body = rest.split("\n\n", 1)[1] if "\n\n" in rest else ""
+            url = urllib.parse.urlsplit(target)
+            status, response, _ = self.fake_dispatch(method, url.path, dict(urllib.parse.parse_qsl(url.query)),
+                                                     inner_body.encode(), {})
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n"
+                         f"\r\nHTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                         f"{json.dumps(response)}\r\n")
+        content = ("".join(parts) + f"--{boundary}--\r\n").encode()
+        return 200, (f"multipart/mixed; boundary={boundary}", content), None
+
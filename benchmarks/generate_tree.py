@@ -0,0 +1,128 @@
+"""
+Generates reproducible synthetic work folders for benchmarks: the same profile and seed always give the same tree,
+with the same file contents.
+"""
+import argparse
+import math
+import os
+import random
+import shutil
+
+TEXT_WORDS = ("def", "return", "import", "self", "value", "data", "model", "train", "for", "in", "if", "else",
+              "print", "result", "config", "path", "loss", "batch", "epoch", "None", "True", "(", ")", ":", "=")
+TEXT_EXTENSIONS = (".py", ".txt", ".md", ".json", ".csv")
+BINARY_EXTENSIONS = (".bin", ".npy", ".pkl", ".jpg", ".zip")
+
+# Keyword arguments of generate_tree
+PROFILES = {
+    "small": dict(files=500, median_size_kb=8, large_files=2, large_file_size_mb=30, git_repos=2, git_repo_size_mb=20,
+                  venvs=1, venv_files=300, huge_dirs=1, huge_dir_files=400),
+    "default": dict(files=3000, median_size_kb=16, large_files=4, large_file_size_mb=150, git_repos=4,
+                    git_repo_size_mb=60, venvs=2, venv_files=1500, huge_dirs=2, huge_dir_files=1000),
+    "large": dict(files=20000, median_size_kb=24, large_files=8, large_file_size_mb=400, git_repos=8,
+                  git_repo_size_mb=200, venvs=4, venv_files=4000, huge_dirs=4, huge_dir_files=5000),
+}
+
+
+def _write_file(filepath, size, rng, text):
+    with open(filepath, 'wb') as f:
+        if text:
+            # text compresses like source code, a block of generated lines is repeated up to size
+            block = "\n".join(" ".join(rng.choice(TEXT_WORDS) for _ in range(rng.randint(3, 12)))
+                              for _ in range(256)).encode() + b"\n"
+            while size > 0:
+                f.write(block[:size])
+                size -= len(block)
+        else:
+            while size > 0:
+                n = min(size, 1 << 20)
+                f.write(rng.randbytes(n))
+                size -= n
+
+
+def _lognormal_size(rng, median_size_kb, size_sigma, max_size_mb):
+    return min(int(rng.lognormvariate(math.log(median_size_kb * 1024), size_sigma)), max_size_mb << 20)
+
+
+def generate_tree(root, files=3000, median_size_kb=16, size_sigma=1.5, max_file_size_mb=64, text_ratio=0.6,
+                  depth=4, large_files=4, large_file_size_mb=150, git_repos=4, git_repo_size_mb=60, venvs=2,
+                  venv_files=1500, huge_dirs=2, huge_dir_files=1000, seed=0):
+    """
+    Creates a work folder at root (replacing it if it exists) and returns (number of files, total bytes).
+
+    Parameters
+    ----------
+    files: Number of regular files spread over nested project folders
+    median_size_kb, size_sigma, max_file_size_mb: Sizes of regular files follow a log-normal distribution with this
+                                                  median and sigma, capped at max_file_size_mb
+    text_ratio: Fraction of regular files that are compressible text, the others are random binary data
+    depth: Maximum nesting depth of project folders
+    large_files, large_file_size_mb: Files larger than the default online limits (-fl), which go to offline backup
+    git_repos, git_repo_size_mb: Projects with a .git folder of about git_repo_size_mb of object packs and loose objects
+    venvs, venv_files: Virtualenv folders named venv with many small files
+    huge_dirs, huge_dir_files: Dataset folders with more files than the default -m, each a few KB
+    seed: Seed of the random generator, the tree only depends on the parameters and the seed
+    """
+    rng = random.Random(seed)
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    count, total_size = 0, 0
+
+    def add_file(filepath, size, text):
+        nonlocal count, total_size
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        _write_file(filepath, size, rng, text)
+        count += 1
+        total_size += size
+
+    projects = [os.path.join(root, f"project_{i}") for i in range(max(git_repos, 1) * 2)]
+    folders = list(projects)
+    for _ in range(max(files // 20, 1)):
+        parent = rng.choice(folders)
+        if parent.count(os.sep) - root.count(os.sep) < depth:
+            folders.append(os.path.join(parent, f"dir_{len(folders)}"))
+    for i in range(files):
+        text = rng.random() < text_ratio
+        extension = rng.choice(TEXT_EXTENSIONS if text else BINARY_EXTENSIONS)
+        add_file(os.path.join(rng.choice(folders), f"file_{i}{extension}"),
+                 _lognormal_size(rng, median_size_kb, size_sigma, max_file_size_mb), text)
+
+    for i in range(large_files):
+        add_file(os.path.join(rng.choice(projects), "outputs", f"weights_{i}.h5"), large_file_size_mb << 20, False)
+
+    for i, project in enumerate(projects[:git_repos]):
+        git_folder = os.path.join(project, ".git")
+        add_file(os.path.join(git_folder, "objects", "pack", f"pack-{i}.pack"), (git_repo_size_mb << 20) // 2,
+                 False)
+        loose_size = (git_repo_size_mb << 20) // 2
+        for j in range(200):
+            add_file(os.path.join(git_folder, "objects", f"{j % 256:02x}", f"{i:04d}{j:034x}"), loose_size // 200,
+                     False)
+        add_file(os.path.join(git_folder, "HEAD"), 23, True)
+
+    for i in range(venvs):
+        venv_folder = os.path.join(rng.choice(projects), "venv" if i < len(projects) else f"venv_{i}")
+        for j in range(venv_files):
+            package = f"package_{j % 50}"
+            add_file(os.path.join(venv_folder, "lib", "site-packages", package, f"module_{j}.py"),
+                     _lognormal_size(rng, 4, 1.0, 1), True)
+
+    for i in range(huge_dirs):
+        dataset_folder = os.path.join(root, "datasets", f"dataset_{i}", "train")
+        for j in range(huge_dir_files):
+            add_file(os.path.join(dataset_folder, f"sample_{j:06d}.jpg"), rng.randint(2 << 10, 8 << 10), False)
+    return count, total_size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", required=True, help="Folder to generate, it is deleted first if it exists")
+    parser.add_argument("-p", choices=sorted(PROFILES), default="default", help="Tree profile, default:%(default)s")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator, default:%(default)s")
+    args = vars(parser.parse_args())
+    count, total_size = generate_tree(args["d"], seed=args["seed"], **PROFILES[args["p"]])
+    print(f"Generated {count} files, {round(total_size / (1 << 20), 2)} MB in {args['d']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Benchmarks every phase of a backup on a synthetic work folder, uploading to a local fake Drive server, so that it
+runs offline and never touches Google Drive. Run from the project's root dir:
+
+    python -m benchmarks.run_benchmarks -p small -o results.json
+    python -m benchmarks.run_benchmarks -p small -c results.json  # after a change, compares with the saved results
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from archive import DEFAULT_COMPRESSLEVEL, write_zip
+from backup_work_folder import backup_folder, enforce_online_limit, execute_backup_plan, get_index_folder, \
+    get_offline_list_path, plan_backup
+from benchmarks.fake_drive import FakeDriveServer
+from benchmarks.generate_tree import PROFILES, generate_tree
+from upload_drive import upload_file
+
+PHASES = ("scan", "copy", "zip", "upload", "backup")
+# backup_work_folder defaults
+FILE_SIZE_LIMIT = 300
+ONLINE_LIMIT = 100000  # MB, so that the online limit never stops a benchmark
+MAX_FILES_PER_DIR = 200
+
+
+def _git_commit():
+    project_dir = Path(__file__).resolve().parent.parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_dir, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=project_dir,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def _result(seconds, files, size):
+    return {"seconds": round(seconds, 3), "files": files, "bytes": size,
+            "files_per_s": round(files / seconds, 1) if seconds else None,
+            "mb_per_s": round(size / (1 << 20) / seconds, 2) if seconds else None}
+
+
+def _timed(func, repeat, setup=None):
+    """
+    Returns the fastest of repeat runs of func, in seconds, and the return value of the last one
+    """
+    best, value = None, None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def run_benchmarks(work_folder, scratch_folder, phases=PHASES, repeat=1, workers=4, compress_workers=1,
+                   bandwidth_mb_s=None, latency_ms=0, verbose=False):
+    """
+    Runs the phases on work_folder, using scratch_folder for backup folders, zips and the offline backup, and returns
+    {phase: {seconds, files, bytes, files_per_s, mb_per_s}}. Phases:
+
+    scan: plan_backup, i.e. walking the work folder and deciding which files go online or offline (bytes are those
+          of all the files seen)
+    copy: execute_backup_plan, copying online and offline files into the staging folders
+    zip: write_zip of the online files straight from the work folder
+    upload: upload_file of that zip to the fake Drive server
+    backup: a whole backup_folder run with default options
+    """
+    results = {}
+    online_folder = os.path.join(scratch_folder, "online")
+    offline_folder = os.path.join(scratch_folder, "offline")
+    zip_file = os.path.join(scratch_folder, "benchmark_online_backup.zip")
+    offline_destination = os.path.join(scratch_folder, "offline_destination")
+    os.makedirs(offline_destination, exist_ok=True)
+    os.environ.update({"WORK_DIR": scratch_folder, "DEFAULT_DRIVE_FOLDER_ID": "benchmark_folder",
+                       "WORK_BACKUP": offline_destination})
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    with FakeDriveServer(bandwidth_mb_s=bandwidth_mb_s, latency_ms=latency_ms) as server, output:
+        server.install()
+
+        def scan():
+            return enforce_online_limit(plan_backup(work_folder, FILE_SIZE_LIMIT, MAX_FILES_PER_DIR, 0, 1),
+                                        ONLINE_LIMIT)
+
+        seconds, plan = _timed(scan, repeat)
+        all_files = [f for dir_files in (plan.online_files, plan.offline_files) for f in dir_files]
+        results["scan"] = _result(seconds, plan.count, sum(f.record.size for f in all_files))
+        online_members = [(f.record.path, f.rel_filepath) for f in plan.online_files]
+        online_size = sum(f.record.size for f in plan.online_files)
+
+        if "copy" in phases:
+            def clean_staging_folders():
+                shutil.rmtree(online_folder, ignore_errors=True)
+                shutil.rmtree(offline_folder, ignore_errors=True)
+
+            seconds, _ = _timed(lambda: execute_backup_plan(plan, work_folder, offline_folder, online_folder, workers),
+                                repeat, clean_staging_folders)
+            results["copy"] = _result(seconds, len(all_files), sum(f.record.size for f in all_files))
+            clean_staging_folders()
+
+        if "zip" in phases or "upload" in phases:
+            seconds, _ = _timed(lambda: write_zip(zip_file, online_members, compresslevel=DEFAULT_COMPRESSLEVEL,
+                                                  workers=compress_workers), repeat)
+            results["zip"] = _result(seconds, len(online_members), online_size)
+
+        if "upload" in phases:
+            seconds, _ = _timed(lambda: upload_file(zip_file, 0, "benchmark_folder"), repeat)
+            results["upload"] = _result(seconds, 1, os.path.getsize(zip_file))
+        Path(zip_file).unlink(missing_ok=True)
+
+        if "backup" in phases:
+            def clean_offline_destination():
+                shutil.rmtree(offline_destination, ignore_errors=True)
+                os.makedirs(offline_destination)
+
+            seconds, _ = _timed(lambda: backup_folder(work_folder, FILE_SIZE_LIMIT, ONLINE_LIMIT, MAX_FILES_PER_DIR,
+                                                      0, 1, workers=workers, compress_workers=compress_workers),
+                                repeat, clean_offline_destination)
+            results["backup"] = _result(seconds, plan.count, sum(f.record.size for f in all_files))
+    return {phase: results[phase] for phase in PHASES if phase in results and (phase == "scan" or phase in phases)}
+
+
+def print_results(results, previous=None):
+    print(f"{'phase':<8}{'seconds':>10}{'files/s':>12}{'MB/s':>10}" + (f"{'previous MB/s':>16}{'change':>9}"
+                                                                       if previous else ""))
+    for phase, result in results["phases"].items():
+        line = f"{phase:<8}{result['seconds']:>10}{result['files_per_s']:>12}{result['mb_per_s']:>10}"
+        previous_result = (previous or {}).get("phases", {}).get(phase)
+        if previous_result:
+            change = previous_result["seconds"] / result["seconds"] - 1 if result["seconds"] else 0
+            line += f"{previous_result['mb_per_s']:>16}{change:>+9.1%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", choices=sorted(PROFILES), default="small",
+                        help="Synthetic work folder profile, default:%(default)s")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic work folder, default:%(default)s")
+    parser.add_argument("-d", help="Benchmark this existing folder instead of generating one, the backup phase "
+                                   "creates its backup folders next to it like a real run")
+    parser.add_argument("--phases", nargs="+", choices=PHASES, default=list(PHASES),
+                        help="Phases to run, scan always runs since the others depend on it, default: all")
+    parser.add_argument("-n", type=int, default=1, help="Runs of each phase, the fastest is reported, "
+                                                        "default:%(default)s")
+    parser.add_argument("-w", type=int, default=4, help="Copy workers (-w of backup_work_folder), "
+                                                        "default:%(default)s")
+    parser.add_argument("-cw", type=int, default=1, help="Compression processes (-cw of backup_work_folder), "
+                                                         "default:%(default)s")
+    parser.add_argument("-b", type=float, default=None,
+                        help="Simulated upload bandwidth of the fake Drive server in MB/s, default: unlimited")
+    parser.add_argument("-l", type=float, default=0,
+                        help="Latency added to every fake Drive request in ms, default:%(default)s")
+    parser.add_argument("-o", help="Write the results to this JSON file")
+    parser.add_argument("-c", help="Compare with the results saved in this JSON file by a previous run")
+    parser.add_argument("-v", action="store_true", help="Show the output of the backup functions")
+    args = vars(parser.parse_args())
+
+    scratch_folder = tempfile.mkdtemp(prefix="backup_benchmark_")
+    work_folder = os.path.abspath(args["d"]) if args["d"] else os.path.join(scratch_folder, "work")
+    # the backup phase overwrites the offline file list in the project's root dir, it is put back afterwards
+    offline_list = Path(get_offline_list_path(work_folder))
+    original_offline_list = offline_list.read_bytes() if offline_list.is_file() else None
+    # and writes the zip index and file hashes of each run to backup_indexes, only the ones it adds are removed
+    index_folder = Path(get_index_folder())
+    original_indexes = set(os.listdir(index_folder)) if index_folder.is_dir() else None
+    try:
+        if args["d"]:
+            tree = {"folder": work_folder}
+        else:
+            start = time.perf_counter()
+            count, total_size = generate_tree(work_folder, seed=args["seed"], **PROFILES[args["p"]])
+            print(f"Generated {count} files, {round(total_size / (1 << 20), 2)} MB in "
+                  f"{round(time.perf_counter() - start, 1)} seconds")
+            tree = {"profile": args["p"], "seed": args["seed"], "files": count, "bytes": total_size}
+        phases = run_benchmarks(work_folder, scratch_folder, args["phases"], args["n"], args["w"], args["cw"],
+                                args["b"], args["l"], args["v"])
+    finally:
+        shutil.rmtree(scratch_folder, ignore_errors=True)
+        if original_offline_list is not None:
+            offline_list.write_bytes(original_offline_list)
+        else:
+            offline_list.unlink(missing_ok=True)
+        if original_indexes is None:
+            shutil.rmtree(index_folder, ignore_errors=True)
+        elif index_folder.is_dir():
+            for filename in set(os.listdir(index_folder)) - original_indexes:
+                (index_folder / filename).unlink()
+
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "tree": tree,
+        "options": {"repeat": args["n"], "workers": args["w"], "compress_workers": args["cw"],
+                    "bandwidth_mb_s": args["b"], "latency_ms": args["l"]},
+        "phases": phases,
+    }
+    previous = None
+    if args["c"]:
+        with open(args["c"]) as f:
+            previous = json.load(f)
+        print(f"Compared with {previous.get('commit')} (change is the speedup in wall time)")
+    print_results(results, previous)
+    if args["o"]:
+        with open(args["o"], 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import zlib
+from pathlib import Path
+
+from archive import DEFAULT_COMPRESSLEVEL, INCOMPRESSIBLE_EXTENSIONS
+from run_metrics import get_run_metrics
+from upload_drive import upload_file
+
+CHUNK_INDEX_VERSION = 1
+CHUNK_INDEX_FILENAME = "chunk_index.json"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = "_snapshot.json.gz"
+PACK_PREFIX = "pack_"
+PACK_SIZE = 64 << 20  # new chunks are collected into pack files of about this size before being uploaded
+MIN_CHUNK_SIZE = 512 << 10
+MAX_CHUNK_SIZE = 8 << 20
+READ_SIZE = 4 * MAX_CHUNK_SIZE
+# A chunk ends after a CANDIDATE_BYTE where the crc32 of the last BOUNDARY_WINDOW bytes has no BOUNDARY_MASK bit. Only
+# hashing at candidate bytes (found by bytes.find) keeps chunking fast in pure Python: about 1 byte in 256 of binary
+# data, or every line end of text. Chunks average about 1.5 MB of binary data and 700 KB of text.
+CANDIDATE_BYTE = b"\n"
+BOUNDARY_WINDOW = 48
+BOUNDARY_MASK = (1 << 12) - 1
+_index_lock = threading.Lock()  # held by the open ChunkStore, whose index would be overwritten by another one
+
+
+def get_chunk_index_path():
+    """
+    The chunk index is stored in the project's root dir (gitignored), it is shared by all work folders backed up to
+    the same drive folder so that their common chunks are only uploaded once
+    """
+    return os.path.join(Path(__file__).resolve().parent, CHUNK_INDEX_FILENAME)
+
+
+def find_chunk_end(data, start, end):
+    """
+    Returns the offset in data where the content-defined chunk starting at start ends, looking no further than end.
+    Boundaries only depend on the bytes just before them, so inserting data into a file only changes the chunks
+    around the insertion.
+    """
+    limit = min(start + MAX_CHUNK_SIZE, end)
+    view = memoryview(data)
+    pos = start + MIN_CHUNK_SIZE
+    while pos < limit:
+        i = data.find(CANDIDATE_BYTE, pos, limit)
+        if i == -1:
+            break
+        if zlib.crc32(view[i - BOUNDARY_WINDOW:i + 1]) & BOUNDARY_MASK == 0:
+            return i + 1
+        pos = i + 1
+    return limit
+
+
+def iter_chunks(fileobj):
+    """
+    Yields the content-defined chunks of a binary file object, reading it in READ_SIZE blocks
+    """
+    buf = b""
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - start < MAX_CHUNK_SIZE:
+            data = fileobj.read(READ_SIZE)
+            if data:
+                buf = buf[start:] + data
+                start = 0
+            else:
+                eof = True
+            continue
+        if start == len(buf):
+            return
+        end = find_chunk_end(buf, start, len(buf))
+        yield buf[start:end]
+        start = end
+
+
+class ChunkStore:
+    """
+    Deduplicated backup of files to a drive folder. Files are split into content-defined chunks identified by their
+    sha256, and only chunks that were never uploaded before are compressed, packed into pack files and uploaded.
+    Every run uploads a snapshot manifest listing the chunks of each file, along with where each chunk is stored, so
+    that a snapshot can be restored from the drive folder alone.
+
+    The local index maps chunk hashes to their location (pack file, offset, stored length, whether it is compressed)
+    and remembers the chunks of every file by size and mtime, so that unchanged files aren't even read again. Chunks
+    are only added to the index once their pack has been uploaded, so an interrupted run never leaves references to
+    missing chunks behind. If the index is lost, the next run uploads everything again. Only one ChunkStore can be
+    open at a time, work folders backed up concurrently wait for each other's chunk store backup to complete.
+    """
+
+    def __init__(self, destination_drive_folder_id, pack_folder, compresslevel=DEFAULT_COMPRESSLEVEL,
+                 index_path=None):
+        self.destination_drive_folder_id = destination_drive_folder_id
+        self.pack_folder = pack_folder
+        self.compresslevel = compresslevel
+        self.index_path = index_path or get_chunk_index_path()
+        _index_lock.acquire()
+        try:
+            self.chunks, self.packs, self.files = self._load_index()
+        except BaseException:
+            _index_lock.release()
+            raise
+        self._locked = True
+        self.new_chunk_count = 0
+        self.uploaded_bytes = 0
+        self._pack = None  # open pack file being filled
+        self._pack_name = None
+        self._pack_chunks = {}  # chunks written into the open pack, added to the index once it is uploaded
+
+    def _load_index(self):
+        if not os.path.isfile(self.index_path):
+            return {}, {}, {}
+        with open(self.index_path) as f:
+            index = json.load(f)
+        if index.get("version") != CHUNK_INDEX_VERSION or index.get("folder_id") != self.destination_drive_folder_id:
+            print(f"Chunk index {self.index_path} belongs to a different drive folder, uploading every chunk again")
+            return {}, {}, {}
+        return index["chunks"], index["packs"], index["files"]
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": CHUNK_INDEX_VERSION, "folder_id": self.destination_drive_folder_id,
+                       "chunks": self.chunks, "packs": self.packs, "files": self.files}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _lookup(self, chunk_hash):
+        return self.chunks.get(chunk_hash) or self._pack_chunks.get(chunk_hash)
+
+    def _add_chunk(self, chunk, compress):
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        if self._lookup(chunk_hash) is not None:
+            return chunk_hash
+        compressed = 0
+        if compress:
+            data = zlib.compress(chunk, self.compresslevel)
+            if len(data) < len(chunk):
+                chunk, compressed = data, 1
+        if self._pack is None:
+            self._pack_name = f"{PACK_PREFIX}{uuid.uuid4().hex}.bin"
+            self._pack = open(os.path.join(self.pack_folder, self._pack_name), 'wb')
+        self._pack_chunks[chunk_hash] = [self._pack_name, self._pack.tell(), len(chunk), compressed]
+        self._pack.write(chunk)
+        self.new_chunk_count += 1
+        if self._pack.tell() >= PACK_SIZE:
+            self._flush_pack()
+        return chunk_hash
+
+    def _flush_pack(self):
+        if self._pack is None:
+            return
+        pack_filepath = self._pack.name
+        self._pack.close()
+        self._pack = None
+        response = upload_file(pack_filepath, 0, self.destination_drive_folder_id)
+        self.uploaded_bytes += os.path.getsize(pack_filepath)
+        os.remove(pack_filepath)
+        self.packs[self._pack_name] = response.get('id')
+        self.chunks.update(self._pack_chunks)
+        self._pack_chunks = {}
+        self._save_index()
+
+    def add_file(self, file_record):
+        """
+        Returns the hashes of the chunks of a scanner.FileRecord, storing the chunks that are new
+        """
+        cached = self.files.get(file_record.path)
+        if cached is not None and cached[0] == file_record.size and cached[1] == file_record.mtime_ns and all(
+                self._lookup(chunk_hash) is not None for chunk_hash in cached[2]):
+            return cached[2]
+        compress = self.compresslevel > 0 and os.path.splitext(file_record.name)[1].lower() \
+            not in INCOMPRESSIBLE_EXTENSIONS
+        with open(file_record.path, 'rb') as f:
+            chunk_hashes = [self._add_chunk(chunk, compress) for chunk in iter_chunks(f)]
+        self.files[file_record.path] = [file_record.size, file_record.mtime_ns, chunk_hashes]
+        return chunk_hashes
+
+    def backup(self, planned_files, snapshot_name, root):
+        """
+        Stores planned_files (list of backup_work_folder.PlannedFile) and uploads the snapshot manifest of this run as
+        <snapshot_name>_snapshot.json.gz. Files that can't be read are left out of the snapshot. Returns the snapshot.
+        """
+        os.makedirs(self.pack_folder, exist_ok=True)
+        metrics = get_run_metrics()
+        snapshot_files = []
+        # chunking and compressing files is recorded as the zip phase of the run, it includes uploading full packs
+        with metrics.phase("zip"):
+            for f in planned_files:
+                start = time.perf_counter()
+                try:
+                    chunk_hashes = self.add_file(f.record)
+                except OSError as e:
+                    print(f"{f.record.path} could not be read and is left out of this backup: {e}")
+                    continue
+                metrics.add("zip", 1, f.record.size)
+                metrics.record_file("zip", f.record.path, time.perf_counter() - start, f.record.size)
+                snapshot_files.append([f.rel_filepath, f.record.size, f.record.mtime_ns, f.record.mode,
+                                       chunk_hashes])
+        self._flush_pack()
+        # files of this work folder that no longer exist or aren't backed up online anymore
+        backed_up_filepaths = {f.record.path for f in planned_files}
+        root_prefix = os.path.join(os.path.abspath(root), "")
+        for filepath in [p for p in self.files if p.startswith(root_prefix) and p not in backed_up_filepaths]:
+            del self.files[filepath]
+        self._save_index()
+
+        referenced_chunks = {h for file_entry in snapshot_files for h in file_entry[4]}
+        chunk_locations = {h: self.chunks[h] for h in sorted(referenced_chunks)}
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "root": os.path.abspath(root),
+            "files": snapshot_files,
+            "chunks": chunk_locations,
+            "packs": {pack: self.packs[pack]
+                      for pack in sorted({location[0] for location in chunk_locations.values()})},
+        }
+        snapshot_filepath = os.path.join(self.pack_folder, snapshot_name + SNAPSHOT_SUFFIX)
+        with gzip.open(snapshot_filepath, 'wt') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        upload_file(snapshot_filepath, 0, self.destination_drive_folder_id)
+        self.uploaded_bytes += os.path.getsize(snapshot_filepath)
+        print(f"Chunk store: {len(snapshot_files)} files in {len(referenced_chunks)} chunks, {self.new_chunk_count} "
+              f"new chunks, uploaded {round(self.uploaded_bytes / (1 << 20), 2)} MB")
+        return snapshot
+
+    def close(self):
+        """
+        Deletes the local pack folder, chunks of a pack that wasn't uploaded are simply stored again by the next run
+        """
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+        shutil.rmtree(self.pack_folder, ignore_errors=True)
+        if self._locked:
+            self._locked = False
+            _index_lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
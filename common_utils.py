@@ -1,8 +1,33 @@
+import errno
+import hashlib
 import os
 import shutil
+import stat
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple
+
+from run_metrics import get_run_metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # ioctl from linux/fs.h, clones (reflinks) a whole file on btrfs, xfs, etc.
+MIN_KERNEL_COPY_BLOCK = 8 * 1024 * 1024
+MAX_KERNEL_COPY_BLOCK = 256 * 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.2  # seconds between progress bar redraws
+# errors meaning a kernel copy function can't be used for this pair of files, so the next method should be tried
+KERNEL_COPY_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                                  errno.EBADF, errno.ETXTBSY, errno.EPERM}
+_shared_copy_executor = None  # set by shared_copy_pool
 
 
 def progress_percentage(perc, width=None):
@@ -58,11 +83,29 @@ def copy_progress(copied, total):
     print('\r' + progress_percentage(100 * copied / total, width=30), end='')
 
 
-def copyfile(src, dst, *, follow_symlinks=True):
+def throttle_progress(callback, interval=PROGRESS_INTERVAL):
+    """
+    Returns a wrapper of callback(copied, total) which only calls it once every interval seconds, and always for the
+    final update, so that the progress bar isn't redrawn after every block that is copied
+    """
+    last_call = [float("-inf")]
+
+    def throttled_callback(copied, total):
+        now = time.monotonic()
+        if copied >= total or now - last_call[0] >= interval:
+            last_call[0] = now
+            callback(copied, total=total)
+
+    return throttled_callback
+
+
+def copyfile(src, dst, *, follow_symlinks=True, md5=None):
     """Copy data from src to dst.
 
     If follow_symlinks is not set and src is a symbolic link, a new
     symlink will be created instead of copying the file it points to.
+    If md5 (a hashlib object) is given, the data is copied through Python
+    instead of by the kernel, and md5 is updated with it on the way.
 
     """
     if shutil._samefile(src, dst):
@@ -83,33 +126,87 @@ def copyfile(src, dst, *, follow_symlinks=True):
         os.symlink(os.readlink(src), dst)
     else:
         size = os.stat(src).st_size
+        callback = throttle_progress(copy_progress)
         with open(src, 'rb') as fsrc:
             with open(dst, 'wb') as fdst:
-                copyfileobj(fsrc, fdst, callback=copy_progress, total=size)
+                if md5 is not None or not kernel_copyfileobj(fsrc, fdst, callback=callback, total=size):
+                    copyfileobj(fsrc, fdst, callback=callback, total=size, md5=md5)
     return dst
 
 
-def copyfileobj(fsrc, fdst, callback, total, length=16 * 1024):
+def kernel_copyfileobj(fsrc, fdst, callback, total):
+    """
+    Copy data without passing it through Python, trying in order a reflink (FICLONE), os.copy_file_range and
+    os.sendfile. Blocks start at MIN_KERNEL_COPY_BLOCK and double while they take less than PROGRESS_INTERVAL, so that
+    fast disks are copied with few syscalls while the progress bar still moves on slow ones.
+
+    A method which stops before total bytes (some file systems, e.g. FUSE, NFS or ecryptfs, report end of file
+    right away) is undone and the next one is tried. Returns False if none of these copied the whole file, in which
+    case nothing has been written.
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(outfd, FICLONE, infd)
+            callback(total, total=total)
+            return True
+        except OSError:
+            pass
+
+    copy_funcs = []
+    if hasattr(os, "copy_file_range"):
+        copy_funcs.append(lambda offset, block: os.copy_file_range(infd, outfd, block))
+    if hasattr(os, "sendfile"):
+        copy_funcs.append(lambda offset, block: os.sendfile(outfd, infd, offset, block))
+    for copy_func in copy_funcs:
+        copied = 0
+        block = MIN_KERNEL_COPY_BLOCK
+        try:
+            while True:
+                start = time.monotonic()
+                n = copy_func(copied, block)
+                if n == 0:
+                    break
+                copied += n
+                callback(copied, total=total)
+                if time.monotonic() - start < PROGRESS_INTERVAL:
+                    block = min(block * 2, MAX_KERNEL_COPY_BLOCK)
+        except OSError as e:
+            if copied == 0 and e.errno in KERNEL_COPY_UNSUPPORTED_ERRNOS:
+                continue
+            raise
+        if copied == total:
+            return True
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+    return False
+
+
+def copyfileobj(fsrc, fdst, callback, total, length=COPY_BUFSIZE, md5=None):
     copied = 0
-    while True:
-        buf = fsrc.read(length)
-        if not buf:
-            break
-        fdst.write(buf)
-        copied += len(buf)
-        callback(copied, total=total)
+    with memoryview(bytearray(length)) as buf:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            if md5 is not None:
+                md5.update(buf[:n])
+            fdst.write(buf[:n])
+            copied += n
+            callback(copied, total=total)
 
 
-def copy_with_progress(src, dst, *, follow_symlinks=True):
+def copy_with_progress(src, dst, *, follow_symlinks=True, md5=None):
     if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
 
-    copyfile(src, dst, follow_symlinks=follow_symlinks)
+    copyfile(src, dst, follow_symlinks=follow_symlinks, md5=md5)
     shutil.copymode(src, dst)
     return dst
 
 
-def custom_copy(src, dst):
+def custom_copy(src, dst, file_size=None, mode=None, md5=None):
     """
     Copy file from src to dst. If src is larger than 0.2 GB, it will be copied
     with a progress bar. Otherwise, shutil.copy is used.
@@ -120,19 +217,110 @@ def custom_copy(src, dst):
         Source file path
     dst : str
         Destination file path
+    file_size : int, optional
+        Size of src in bytes if already known (e.g. from a scanner.FileRecord),
+        src is then not stat'ed again
+    mode : int, optional
+        st_mode of src if already known, applied to dst instead of copying it
+        with shutil.copymode
+    md5 : hashlib object, optional
+        Updated with the contents of src while they are copied, which are then
+        read and written by Python instead of a kernel copy
     """
-    if not os.path.isfile(src):
-        raise FileNotFoundError(src)
+    if file_size is None:
+        if not os.path.isfile(src):
+            raise FileNotFoundError(src)
+        file_size = os.path.getsize(src)
 
-    file_size = get_file_size_mb(src)
-    if  file_size > 200:
-        print(f"Large File {src} - {file_size} MB is being copied, please wait...")
-        copy_with_progress(src, dst)
+    file_size_mb = file_size / (1 << 20)
+    if  file_size_mb > 200:
+        print(f"Large File {src} - {file_size_mb} MB is being copied, please wait...")
+        copy_with_progress(src, dst, md5=md5)
         print("\nCopied.")
 
-    else:
+    elif md5 is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            copyfileobj(fsrc, fdst, callback=lambda copied, total: None, total=file_size, md5=md5)
+        os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode if mode is None else mode))
+
+    elif mode is None:
         shutil.copy(src, dst)
 
+    else:
+        shutil.copyfile(src, dst)
+        os.chmod(dst, stat.S_IMODE(mode))
+
+class CopyJob(NamedTuple):
+    src: str
+    dst: str
+    file_size: int
+    mode: int
+
+
+def copy_files(copy_jobs, workers=1, hashes=None):
+    """
+    Copy every CopyJob with custom_copy using a pool of worker threads. All destination folders are created up front,
+    and a file that fails to copy doesn't stop the remaining ones from being copied.
+
+    Parameters
+    ----------
+    copy_jobs : list of CopyJob
+    workers : int
+        Number of files copied concurrently, 1 copies serially on the calling thread. Ignored inside shared_copy_pool,
+        whose pool is used instead.
+    hashes : dict, optional
+        If given, every file is hashed while it is copied and hashes[src] is
+        set to its md5 hex digest
+
+    Returns
+    -------
+    list of (src, OSError) for the files that could not be copied, in the order of copy_jobs
+    """
+    metrics = get_run_metrics()
+
+    def copy_job(job):
+        start = time.perf_counter()
+        md5 = hashlib.md5() if hashes is not None else None
+        try:
+            custom_copy(job.src, job.dst, job.file_size, job.mode, md5)
+        except OSError as e:
+            return e
+        if md5 is not None:
+            hashes[job.src] = md5.hexdigest()
+        elapsed = time.perf_counter() - start
+        metrics.add("copy", 1, job.file_size)
+        metrics.record_file("copy", job.src, elapsed, job.file_size)
+        metrics.record_dir("copy", os.path.dirname(job.src), elapsed)
+        return None
+
+    with metrics.phase("copy"):
+        for dst_dir in sorted({os.path.dirname(job.dst) for job in copy_jobs}):
+            os.makedirs(dst_dir, exist_ok=True)
+        if _shared_copy_executor is not None:
+            errors = list(_shared_copy_executor.map(copy_job, copy_jobs))
+        elif workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                errors = list(executor.map(copy_job, copy_jobs))
+        else:
+            errors = [copy_job(job) for job in copy_jobs]
+    return [(job.src, error) for job, error in zip(copy_jobs, errors) if error is not None]
+
+
+@contextmanager
+def shared_copy_pool(workers):
+    """
+    Makes every copy_files call, from any thread, use one pool of workers threads until exiting, so that several work
+    folders backed up at once never copy more than workers files at a time in total
+    """
+    global _shared_copy_executor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        _shared_copy_executor = executor
+        try:
+            yield executor
+        finally:
+            _shared_copy_executor = None
+
+
 def move_folder_with_sandwiched_timestamp(src_folder, dest_folder):
     src_folder = Path(src_folder)
     dest_folder = Path(dest_folder)
@@ -146,5 +334,6 @@ def get_file_size_mb(filepath):
     return os.path.getsize(filepath) / (1 << 20)
 
 
+
 if __name__ == "__main__":
     custom_copy(sys.argv[1], sys.argv[2])
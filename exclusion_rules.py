@@ -0,0 +1,207 @@
+import os
+import re
+from pathlib import Path
+
+RULES_FILENAME = ".backupignore"
+GLOB_CHARS = frozenset("*?[")
+
+
+def _translate_glob(pattern):
+    """
+    Translates a gitignore-style glob into a regex, "*" and "?" do not match "/" while "**" matches across directories
+    """
+    i, n = 0, len(pattern)
+    regex = []
+    while i < n:
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                regex.append(re.escape("["))
+                i += 1
+            else:
+                char_class = pattern[i + 1:j]
+                if char_class.startswith("!"):
+                    char_class = "^" + char_class[1:]
+                regex.append("[" + char_class.replace("\\", "\\\\") + "]")
+                i = j + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(regex)
+
+
+def read_rules_file(filepath):
+    """
+    Returns the patterns in a gitignore-style rules file, skipping blank lines and comments
+    """
+    if not os.path.isfile(filepath):
+        return []
+    with open(filepath) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def recursive_file_size_check(path, file_size_limit, delimiter, dir_sizes):
+    """
+    If the total size of all files recursively in the git dir is greater than the normal individual file_size_limit,
+    return True to tell the caller that the folder should be skipped
+
+    Parameters
+    ----------
+    path: Full path to be checked, part of this path contains the delimiter
+    file_size_limit: Normal individual file size limit
+    delimiter: .git or venv (virtualenv folder name defiled in .env, fetched by caller)
+    dir_sizes: Index returned by build_dir_size_index, directories missing from it (e.g. outside the work folder) are
+               globbed once and then added to it
+    """
+    if delimiter in path:
+        path_upto_git = path.partition(delimiter)[0]
+        key = path_upto_git.rstrip(os.sep) or os.sep
+        if key not in dir_sizes:
+            dir_sizes[key] = sum(f.stat().st_size for f in Path(path_upto_git).glob('**/*') if f.is_file())
+        if dir_sizes[key] / (1 << 20) > file_size_limit:
+            return True
+    return False
+
+
+class ExclusionRules:
+    """
+    Exclusion rules compiled once per run, so that every check made while walking the work folder is a set lookup or a
+    single regex match.
+
+    1. Ignore patterns (gitignore-style, negation is not supported) are matched against the basename of a file or dir,
+       or against its path relative to the work folder if the pattern contains a "/". A trailing "/" only matches
+       directories. Ignored files are neither backed up online nor offline, and ignored directories are pruned from
+       the walk so they are never descended into.
+    2. Directories under excluded_dirs whose repo is larger than file_size_limit are decided once per directory, and
+       the decision is inherited by all subdirectories through a lookup of the parent's decision.
+    3. Restricted extensions are matched as suffixes of the filename (e.g. ".h5" or ".tar.gz") with a set lookup per
+       "." in the filename.
+    """
+
+    def __init__(self, root, excluded_dirs, restricted_extensions, restricted_max_file_size_mb, ignore_patterns=()):
+        self.root = os.path.abspath(root)
+        self.excluded_dirs = list(excluded_dirs)
+        self.restricted_extensions = frozenset(restricted_extensions)
+        self.restricted_max_file_size_mb = restricted_max_file_size_mb
+        self._excluded_dir_decisions = {}  # dir -> whether files under it are excluded from online backup
+
+        # exact patterns are looked up in sets, globs are combined into one regex per kind of match
+        name_set, dir_name_set, path_set, dir_path_set = set(), set(), set(), set()
+        name_globs, dir_name_globs, path_globs, dir_path_globs = [], [], [], []
+        for pattern in ignore_patterns:
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            if pattern.startswith("!"):
+                print(f"Negated ignore pattern {pattern} is not supported, skipping it")
+                continue
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            if GLOB_CHARS.isdisjoint(pattern):
+                target = ((dir_path_set if dir_only else path_set) if anchored
+                          else (dir_name_set if dir_only else name_set))
+                target.add(pattern)
+            else:
+                target = ((dir_path_globs if dir_only else path_globs) if anchored
+                          else (dir_name_globs if dir_only else name_globs))
+                target.append(_translate_glob(pattern))
+        self._name_set, self._dir_name_set = frozenset(name_set), frozenset(dir_name_set)
+        self._path_set, self._dir_path_set = frozenset(path_set), frozenset(dir_path_set)
+        self._name_regex, self._dir_name_regex, self._path_regex, self._dir_path_regex = (
+            re.compile("(?:" + "|".join(globs) + r")\Z") if globs else None
+            for globs in (name_globs, dir_name_globs, path_globs, dir_path_globs))
+        self.has_ignore_patterns = any((name_set, dir_name_set, path_set, dir_path_set, name_globs, dir_name_globs,
+                                        path_globs, dir_path_globs))
+
+    @classmethod
+    def load(cls, root):
+        """
+        Reads rules from secret_constants.py (excluded_dirs, restricted_extensions, restricted_max_file_size_mb and
+        the optional excluded_patterns) and ignore patterns from a .backupignore file in the root of the work folder
+        """
+        try:
+            from secret_constants import excluded_dirs, restricted_extensions, restricted_max_file_size_mb
+        except ImportError:
+            # default values if secret_constants.py isn't in the project's root dir
+            excluded_dirs = [".git"]
+            restricted_extensions = [".mp4", ".mkv", ".h5", ".weights"]
+            restricted_max_file_size_mb = 20
+        try:
+            from secret_constants import excluded_patterns
+        except ImportError:
+            excluded_patterns = []
+        ignore_patterns = list(excluded_patterns) + read_rules_file(os.path.join(root, RULES_FILENAME))
+        return cls(root, excluded_dirs, restricted_extensions, restricted_max_file_size_mb, ignore_patterns)
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """
+        rel_path: Path relative to the work folder
+        """
+        rel_path = rel_path.replace(os.sep, "/")
+        name = rel_path.rpartition("/")[2]
+        if name in self._name_set or rel_path in self._path_set:
+            return True
+        if (self._name_regex and self._name_regex.match(name)) or (
+                self._path_regex and self._path_regex.match(rel_path)):
+            return True
+        if is_dir:
+            if name in self._dir_name_set or rel_path in self._dir_path_set:
+                return True
+            if (self._dir_name_regex and self._dir_name_regex.match(name)) or (
+                    self._dir_path_regex and self._dir_path_regex.match(rel_path)):
+                return True
+        return False
+
+    def prune_dirnames(self, path, dirnames):
+        """
+        Removes ignored directories from dirnames in place, so that os.walk doesn't descend into them
+        """
+        if not self.has_ignore_patterns:
+            return
+        rel_path = os.path.relpath(path, self.root)
+        rel_path = "" if rel_path == os.curdir else rel_path + os.sep
+        dirnames[:] = [d for d in dirnames if not self.is_ignored(rel_path + d, is_dir=True)]
+
+    def is_excluded_dir(self, path, file_size_limit, dir_sizes):
+        """
+        Returns True if files under path should be excluded from online backup because path belongs to a git or
+        virtualenv folder whose repo exceeds file_size_limit. Must be called for a directory after its parent, as in a
+        top-down os.walk.
+        """
+        if self._excluded_dir_decisions.get(os.path.dirname(path)):
+            is_excluded = True
+        else:
+            is_excluded = any(recursive_file_size_check(path, file_size_limit, excluded_dir, dir_sizes)
+                              for excluded_dir in self.excluded_dirs)
+            if is_excluded:
+                print(f"Files under {path} excluded from online backup")
+        self._excluded_dir_decisions[path] = is_excluded
+        return is_excluded
+
+    def has_restricted_extension(self, filename):
+        i = filename.find(".")
+        while i != -1:
+            if filename[i:] in self.restricted_extensions:
+                return True
+            i = filename.find(".", i + 1)
+        return False
+
+    def is_restricted_file(self, filename, file_size_mb):
+        """
+        Files ending in restricted_extensions are subject to the lower restricted_max_file_size_mb limit, instead of
+        file_size_limit
+        """
+        return file_size_mb > self.restricted_max_file_size_mb and self.has_restricted_extension(filename)
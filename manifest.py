@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+DELETIONS_FILENAME = "deleted_files_since_last_backup.txt"
+PENDING_SUFFIX = ".pending"  # manifest of a run whose upload hasn't completed yet
+
+
+def get_manifest_path(folder):
+    """
+    Manifest of a work folder is stored in the project's root dir (gitignored), next to its offline file list
+    """
+    return os.path.join(Path(__file__).resolve().parent, f"{os.path.basename(folder)}_backup_manifest.json")
+
+
+def load_manifest(manifest_path, folder):
+    """
+    Returns the manifest entries saved by the previous incremental run, as a dict whose keys are paths relative to
+    folder and values are [size, mtime_ns, md5 hash or None]. An empty dict is returned if no manifest exists or if it
+    was written for a different folder, so that the next run becomes a full backup.
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("root") != os.path.abspath(folder):
+        print(f"Manifest {manifest_path} does not belong to {folder}, performing a full backup")
+        return {}
+    return manifest["files"]
+
+
+def save_manifest(manifest_path, folder, entries):
+    """
+    Atomically replaces the manifest so that an interrupted run never leaves a truncated manifest behind
+    """
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "root": os.path.abspath(folder), "files": entries}, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def commit_pending_manifest(manifest_path):
+    """
+    Replaces the manifest with the pending one saved before the upload started, once that upload has completed
+    """
+    pending_path = manifest_path + PENDING_SUFFIX
+    if os.path.isfile(pending_path):
+        os.replace(pending_path, manifest_path)
+
+
+def compute_file_hash(filepath, length=1 << 20):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        while True:
+            buf = f.read(length)
+            if not buf:
+                break
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def has_file_changed(rel_filepath, file_record, previous_entries, current_entries, use_hash):
+    """
+    Records the file in current_entries and returns True if it is new or modified since the previous run.
+
+    Parameters
+    ----------
+    rel_filepath: Path of the file relative to the work folder, used as the manifest key
+    file_record: scanner.FileRecord of the file, its contents are only read if use_hash is set and size or mtime
+                 have changed
+    previous_entries: Manifest entries of the previous run
+    current_entries: Manifest entries of the current run, updated in place
+    use_hash: If set, files whose size or mtime changed are compared by content, so that files that were merely
+              touched (e.g. by a git checkout) are not backed up again
+    """
+    size, mtime_ns = file_record.size, file_record.mtime_ns
+    previous = previous_entries.get(rel_filepath)
+    if previous is not None and previous[0] == size and previous[1] == mtime_ns:
+        current_entries[rel_filepath] = previous
+        return False
+
+    file_hash = None
+    if use_hash:
+        file_hash = compute_file_hash(file_record.path)
+    current_entries[rel_filepath] = [size, mtime_ns, file_hash]
+    if previous is not None and file_hash is not None and previous[0] == size and previous[2] == file_hash:
+        return False
+    return True
+
+
+def get_deleted_files(previous_entries, current_entries):
+    return sorted(set(previous_entries) - set(current_entries))
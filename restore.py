@@ -0,0 +1,554 @@
+"""
+Restores a subset of the files of a work folder from its backups, without downloading whole zips. The index uploaded
+next to every online zip (or, for older zips, their central directory) tells where each file is stored, so only the
+byte ranges of the requested files are downloaded, with adjacent files fetched together by a single ranged request.
+Also restores from chunk store snapshots (-cs) and from the offline backups under WORK_BACKUP.
+
+    python restore.py -n work -l                                   # lists the backups of work folder "work"
+    python restore.py -n work -p project/src notes.txt -o restored  # restores these from the latest backup
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import stat
+import struct
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from googleapiclient import errors
+
+from archive import ZIP_INDEX_SUFFIX, load_zip_index, read_zip_index
+from backup_work_folder import DT_FORMAT, LEGACY_DT_FORMAT, get_zip_index_path
+from chunk_store import SNAPSHOT_SUFFIX
+from common_utils import CopyJob, copy_files
+from manifest import DELETIONS_FILENAME
+from snapshots import SNAPSHOT_TIMESTAMP_FORMAT, list_snapshots
+from upload_drive import VOLUME_MANIFEST_SUFFIX, check_and_fetch_env_vars, download_file, download_range, \
+    list_folder
+
+MAX_RANGE_SIZE = 8 << 20  # members are downloaded with ranged requests of up to this size
+MAX_RANGE_GAP = 64 << 10  # members separated by fewer bytes of unrequested members are still fetched together
+LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")  # same as zipfile.structFileHeader
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\003\004"
+MAX_LOCAL_HEADER_SIZE = LOCAL_FILE_HEADER.size + 2 * 0xFFFF  # with the longest name and extra field
+SOURCES = ("drive", "offline")
+
+
+class Backup(NamedTuple):
+    dt: datetime
+    dt_string: str
+    kind: str  # "zip", "chunk_store" or "offline"
+    incremental: bool
+    name: str  # zip name, snapshot name or offline snapshot folder
+    size: Optional[int]
+    files: dict  # Drive files of the backup: "zip" or "volumes", "index", "snapshot"
+
+
+class DriveSource:
+    """
+    Ranged reads of a file on Drive
+    """
+
+    def __init__(self, file_id, size):
+        self.file_id = file_id
+        self.size = size
+
+    def read_range(self, start, length):
+        return download_range(self.file_id, start, length)
+
+
+class VolumeSource:
+    """
+    Ranged reads of a file uploaded as volumes (upload_drive.upload_volumes), a range spanning several volumes is
+    read from each of them
+    """
+
+    def __init__(self, manifest):
+        self.volumes = manifest["volumes"]
+        self.size = manifest["size"]
+
+    def read_range(self, start, length):
+        data = []
+        end = start + length
+        for volume in self.volumes:
+            volume_end = volume["offset"] + volume["size"]
+            if volume_end <= start or volume["offset"] >= end:
+                continue
+            range_start = max(start, volume["offset"])
+            range_end = min(end, volume_end)
+            data.append(download_range(volume["id"], range_start - volume["offset"], range_end - range_start))
+        return b"".join(data)
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Seekable, read-only file object over a DriveSource or VolumeSource, so that zipfile can read the central
+    directory of a zip without an index by downloading only its end
+    """
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.source.size
+        self._pos = max(pos, 0)
+        return self._pos
+
+    def read(self, size=-1):
+        end = self.source.size if size is None or size < 0 else min(self._pos + size, self.source.size)
+        if end <= self._pos:
+            return b""
+        data = self.source.read_range(self._pos, end - self._pos)
+        self._pos = end
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _MemberWriter:
+    """
+    Extracts a zip member from consecutive pieces of its bytes starting at its local header, checking its CRC-32 and,
+    if the index recorded it, its md5
+    """
+
+    def __init__(self, member, output_folder):
+        (self.name, _, self.compress_type, self.compress_size, self.file_size, self.crc, self.date_time,
+         self.md5) = member
+        if self.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f"{self.name} uses an unsupported compression method {self.compress_type}")
+        self.filepath = get_output_path(output_folder, self.name)
+        self._header = b""
+        self._remaining = None  # compressed bytes of the member still to be fed, once the header is parsed
+        self._decompressor = zlib.decompressobj(-15) if self.compress_type == zipfile.ZIP_DEFLATED else None
+        self._crc = 0
+        self._md5 = hashlib.md5() if self.md5 else None
+        self._size = 0
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        self._file = open(self.filepath + ".partial", 'wb')
+
+    def _write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        if self._md5 is not None:
+            self._md5.update(data)
+        self._size += len(data)
+        self._file.write(data)
+
+    def feed(self, data):
+        if self._remaining is None:
+            self._header += data
+            if len(self._header) < LOCAL_FILE_HEADER.size:
+                return
+            fields = LOCAL_FILE_HEADER.unpack_from(self._header)
+            if fields[0] != LOCAL_FILE_HEADER_SIGNATURE:
+                raise ValueError(f"Bad local file header for {self.name}")
+            data_start = LOCAL_FILE_HEADER.size + fields[10] + fields[11]
+            if len(self._header) < data_start:
+                return
+            data = self._header[data_start:]
+            self._header = None
+            self._remaining = self.compress_size
+        # bytes after the compressed data (data descriptor, next members) are ignored
+        data = data[:self._remaining]
+        self._remaining -= len(data)
+        self._write(self._decompressor.decompress(data) if self._decompressor else data)
+
+    def close(self):
+        if self._decompressor:
+            self._write(self._decompressor.flush())
+        self._file.close()
+        if (self._remaining != 0 or self._size != self.file_size or self._crc != self.crc
+                or self._md5 is not None and self._md5.hexdigest() != self.md5):
+            os.remove(self._file.name)
+            raise ValueError(f"{self.name} is corrupt in the backup, it was not restored")
+        os.replace(self._file.name, self.filepath)
+        mtime = time.mktime(tuple(self.date_time) + (0, 0, -1))
+        os.utime(self.filepath, (mtime, mtime))
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._file.name)
+
+
+def get_output_path(output_folder, rel_filepath):
+    """
+    Path of a backed up file inside output_folder, refusing names which would end up outside of it
+    """
+    parts = [part for part in rel_filepath.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(rel_filepath):
+        raise ValueError(f"Refusing to restore {rel_filepath} outside of {output_folder}")
+    return os.path.join(output_folder, *parts)
+
+
+def is_selected(rel_filepath, paths):
+    """
+    Whether rel_filepath is one of paths or inside one of them, every file is selected if paths is empty
+    """
+    return not paths or any(rel_filepath == p or rel_filepath.startswith(p + "/") for p in paths)
+
+
+def list_drive_backups(name, drive_folder_id):
+    """
+    Returns the online backups of work folder name in the drive folder, oldest first. Raises an error if several
+    files of the drive folder have the same name, since which of them belong together would be unknown.
+    """
+    dt_pattern = r"(\d\d_\d\d_\d{4}_\d\d_\d\d(?:_\d\d)?)"
+    zip_pattern = re.compile(rf"{dt_pattern}_{re.escape(name)}_online_backup(_incremental)?\.zip"
+                             rf"({re.escape(VOLUME_MANIFEST_SUFFIX)}|{re.escape(ZIP_INDEX_SUFFIX)})?")
+    snapshot_pattern = re.compile(rf"{dt_pattern}_{re.escape(name)}{re.escape(SNAPSHOT_SUFFIX)}")
+    backups = {}
+    duplicates = set()
+    for drive_file in list_folder(drive_folder_id):
+        match = zip_pattern.fullmatch(drive_file["name"])
+        if match:
+            dt_string, incremental, suffix = match.groups()
+            zip_name = drive_file["name"][:len(drive_file["name"]) - len(suffix or "")]
+            key = {None: "zip", VOLUME_MANIFEST_SUFFIX: "volumes", ZIP_INDEX_SUFFIX: "index"}[suffix]
+            backup = backups.setdefault(zip_name, dict(dt_string=dt_string, kind="zip",
+                                                       incremental=bool(incremental), files={}))
+            if key in backup["files"]:
+                duplicates.add(drive_file["name"])
+            backup["files"][key] = drive_file
+            continue
+        match = snapshot_pattern.fullmatch(drive_file["name"])
+        if match:
+            if drive_file["name"] in backups:
+                duplicates.add(drive_file["name"])
+            backups[drive_file["name"]] = dict(dt_string=match.group(1), kind="chunk_store", incremental=False,
+                                               files={"snapshot": drive_file})
+    if duplicates:
+        raise ValueError(f"Several files are named {', '.join(sorted(duplicates))} in the drive folder, rename or "
+                         f"delete all but one of each to restore")
+    result = []
+    for backup_name, backup in backups.items():
+        files = backup["files"]
+        if backup["kind"] == "zip" and not ("zip" in files or "volumes" in files):
+            # only the index is left, e.g. the zip was deleted from the drive folder
+            continue
+        main_file = files.get("zip") or files.get("volumes") or files.get("snapshot")
+        size = int(main_file["size"]) if "size" in main_file and "volumes" not in files else None
+        dt_format = DT_FORMAT if backup["dt_string"].count("_") == 5 else LEGACY_DT_FORMAT
+        result.append(Backup(datetime.strptime(backup["dt_string"], dt_format), backup["dt_string"],
+                             backup["kind"], backup["incremental"], backup_name, size, files))
+    return sorted(result, key=lambda b: (b.dt, b.name))
+
+
+def list_offline_backups(name, offline_backup_dst_folder):
+    """
+    Returns the offline backups (snapshot folders) of work folder name under WORK_BACKUP, oldest first
+    """
+    result = []
+    for snapshot in list_snapshots(offline_backup_dst_folder, f"{name}_offline_backup"):
+        timestamp = os.path.basename(os.path.dirname(snapshot))
+        result.append(Backup(datetime.strptime(timestamp, SNAPSHOT_TIMESTAMP_FORMAT), timestamp, "offline", False,
+                             snapshot, None, {}))
+    return result
+
+
+def get_zip_source(backup):
+    if "volumes" in backup.files:
+        return VolumeSource(json.loads(download_file(backup.files["volumes"]["id"])))
+    return DriveSource(backup.files["zip"]["id"], int(backup.files["zip"]["size"]))
+
+
+def get_zip_index(backup, source):
+    """
+    Returns the archive.zip_index of an online zip: the one saved locally when it was uploaded, else the one uploaded
+    next to it, else read from the central directory of the zip itself
+    """
+    index_path = get_zip_index_path(backup.name)
+    if os.path.isfile(index_path):
+        return load_zip_index(index_path)
+    if "index" in backup.files:
+        return load_zip_index(io.BytesIO(download_file(backup.files["index"]["id"])))
+    print(f"No index found for {backup.name}, reading its central directory")
+    index = read_zip_index(RangeReader(source))
+    index["full"] = not backup.incremental
+    return index
+
+
+def get_incremental_chain(backups, selected):
+    """
+    Returns (backup, source, zip index) of the zips to restore from, oldest first, to get the state of the work folder
+    at the selected backup. For an incremental backup, that is every incremental zip back to the first of its chain,
+    which contains every file.
+    """
+    candidates = [selected]
+    if selected.incremental:
+        # incremental zips are relative to the previous incremental run, never to a full backup
+        candidates += [b for b in reversed(backups) if b.kind == "zip" and b.incremental and b.dt <= selected.dt
+                       and b is not selected]
+    chain = []
+    for backup in candidates:
+        source = get_zip_source(backup)
+        index = get_zip_index(backup, source)
+        chain.append((backup, source, index))
+        if index.get("full"):
+            break
+    return chain[::-1]
+
+
+def get_member_spans(index):
+    """
+    Returns {member name: (member, start offset, end offset)}, a member's bytes ending where the next one starts
+    """
+    members = sorted(index["members"], key=lambda m: m[1])
+    ends = [m[1] for m in members[1:]] + [index["central_directory_offset"]]
+    return {m[0]: (m, m[1], end) for m, end in zip(members, ends)}
+
+
+def group_ranges(spans):
+    """
+    Groups (member, start, end) spans, sorted by start, into ranges fetched by a single request
+    """
+    groups = []
+    for span in spans:
+        if groups:
+            group = groups[-1]
+            group_start, group_end = group[0][1], group[-1][2]
+            if span[1] - group_end <= MAX_RANGE_GAP and span[2] - group_start <= MAX_RANGE_SIZE:
+                group.append(span)
+                continue
+        groups.append([span])
+    return groups
+
+
+def _extract_member(member, output_folder, pieces):
+    writer = _MemberWriter(member, output_folder)
+    try:
+        for piece in pieces:
+            writer.feed(piece)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def extract_group(source, group, output_folder):
+    """
+    Downloads a group of members and extracts them, a member larger than MAX_RANGE_SIZE is streamed in pieces of
+    that size. Returns the number of bytes downloaded and (name, error) of the members that failed.
+    """
+    start, end = group[0][1], group[-1][2]
+    if len(group) == 1 and end - start > MAX_RANGE_SIZE:
+        # the compressed data may be followed by a data descriptor, which isn't needed
+        end = min(end, start + MAX_LOCAL_HEADER_SIZE + group[0][0][3])
+        pieces = (source.read_range(offset, min(MAX_RANGE_SIZE, end - offset))
+                  for offset in range(start, end, MAX_RANGE_SIZE))
+        _extract_member(group[0][0], output_folder, pieces)
+        return end - start, []
+    data = source.read_range(start, end - start)
+    failed = []
+    for member, member_start, member_end in group:
+        try:
+            _extract_member(member, output_folder, [data[member_start - start:member_end - start]])
+        except (OSError, ValueError, zlib.error) as e:
+            failed.append((member[0], e))
+    return end - start, failed
+
+
+def read_member(source, spans, name):
+    """
+    Returns the content of a small member, e.g. the deletions list of an incremental zip
+    """
+    member, start, end = spans[name]
+    data = source.read_range(start, end - start)
+    fields = LOCAL_FILE_HEADER.unpack_from(data)
+    data_start = LOCAL_FILE_HEADER.size + fields[10] + fields[11]
+    content = data[data_start:data_start + member[3]]
+    return zlib.decompress(content, -15) if member[2] == zipfile.ZIP_DEFLATED else content
+
+
+def restore_zips(chain, paths, output_folder, workers):
+    """
+    Restores the selected files from a chain of (backup, source, index) of online zips, later zips overriding the
+    files of earlier ones and removing the files their deletions list
+    """
+    selected = {}  # rel path -> (source, span)
+    for backup, source, index in chain:
+        spans = get_member_spans(index)
+        if backup.incremental and DELETIONS_FILENAME in spans:
+            for deleted in read_member(source, spans, DELETIONS_FILENAME).decode().splitlines():
+                selected.pop(deleted.replace(os.sep, "/"), None)
+        for name, span in spans.items():
+            if name != DELETIONS_FILENAME and not name.endswith("/") and is_selected(name, paths):
+                selected[name] = (source, span)
+
+    # members are fetched in the order they are stored, so that adjacent ones share a request
+    tasks = []
+    for _, source, _ in chain:
+        spans = sorted((span for s, span in selected.values() if s is source), key=lambda span: span[1])
+        tasks.extend((source, group) for group in group_ranges(spans))
+    print(f"Restoring {len(selected)} files with {len(tasks)} ranged downloads from {len(chain)} zip(s)...")
+    failed = []
+
+    def run_task(task):
+        try:
+            downloaded, group_failed = extract_group(task[0], task[1], output_folder)
+        except (OSError, ValueError, zlib.error, errors.HttpError) as e:
+            failed.extend((span[0][0], e) for span in task[1])
+            return 0
+        failed.extend(group_failed)
+        return downloaded
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        downloaded = sum(executor.map(run_task, tasks))
+    return len(selected) - len(failed), downloaded, failed
+
+
+def restore_chunk_store(backup, paths, output_folder, workers):
+    """
+    Restores the selected files of a chunk store snapshot, downloading each of their chunks from its pack
+    """
+    snapshot = json.loads(gzip.decompress(download_file(backup.files["snapshot"]["id"])))
+    files = [f for f in snapshot["files"] if is_selected(f[0].replace(os.sep, "/"), paths)]
+    print(f"Restoring {len(files)} files from chunk store snapshot {backup.name}...")
+    failed = []
+
+    def restore_file(file_entry):
+        downloaded = 0
+        rel_filepath, size, mtime_ns, mode, chunk_hashes = file_entry
+        filepath = get_output_path(output_folder, rel_filepath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        try:
+            with open(filepath + ".partial", 'wb') as f:
+                for chunk_hash in chunk_hashes:
+                    pack, offset, length, compressed = snapshot["chunks"][chunk_hash]
+                    data = download_range(snapshot["packs"][pack], offset, length)
+                    downloaded += length
+                    if compressed:
+                        data = zlib.decompress(data)
+                    if hashlib.sha256(data).hexdigest() != chunk_hash:
+                        raise ValueError(f"Chunk {chunk_hash} of {rel_filepath} is corrupt")
+                    f.write(data)
+            if os.path.getsize(filepath + ".partial") != size:
+                raise ValueError(f"{rel_filepath} has the wrong size")
+            os.chmod(filepath + ".partial", stat.S_IMODE(mode))
+            os.utime(filepath + ".partial", ns=(mtime_ns, mtime_ns))
+            os.replace(filepath + ".partial", filepath)
+        except (OSError, ValueError, zlib.error, errors.HttpError) as e:
+            if os.path.exists(filepath + ".partial"):
+                os.remove(filepath + ".partial")
+            failed.append((rel_filepath, e))
+        return downloaded
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        downloaded = sum(executor.map(restore_file, files))
+    return len(files) - len(failed), downloaded, failed
+
+
+def restore_offline(backup, paths, output_folder, workers):
+    """
+    Copies the selected files of an offline backup snapshot, which only holds the files that went to the offline
+    backup in that run
+    """
+    copy_jobs = []
+    for path, _, filenames in os.walk(backup.name):
+        for filename in filenames:
+            src = os.path.join(path, filename)
+            rel_filepath = os.path.relpath(src, backup.name).replace(os.sep, "/")
+            if is_selected(rel_filepath, paths):
+                st = os.stat(src)
+                copy_jobs.append(CopyJob(src, get_output_path(output_folder, rel_filepath), st.st_size, st.st_mode))
+    print(f"Restoring {len(copy_jobs)} files from offline backup {backup.name}...")
+    failed = copy_files(copy_jobs, workers)
+    return len(copy_jobs) - len(failed), 0, failed
+
+
+def select_backup(backups, dt_string):
+    if not backups:
+        raise FileNotFoundError("No backups found")
+    if dt_string is None:
+        return backups[-1]
+    matching = [b for b in backups if b.dt_string == dt_string]
+    if not matching:
+        raise FileNotFoundError(f"No backup taken at {dt_string}, run with -l to list the backups")
+    return matching[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    _, drive_folder_id, offline_backup_dst_folder = check_and_fetch_env_vars()
+    parser.add_argument("-n", required=True,
+                        help="Name of the backed up work folder, i.e. the last component of its path given to "
+                             "backup_work_folder.py -d")
+    parser.add_argument("-s", choices=SOURCES, default="drive",
+                        help="Restore from the online backups in the drive folder or the offline backups in "
+                             "WORK_BACKUP, default:%(default)s")
+    parser.add_argument("-b", default=None,
+                        help="Backup to restore from, as shown by -l (dd_mm_YYYY_HH_MM_SS online, YYYYmmdd_HHMMSS "
+                             "offline), default: latest. An incremental backup is restored along with the earlier "
+                             "incremental backups it builds on.")
+    parser.add_argument("-p", nargs="+", default=[],
+                        help="Files or folders to restore, relative to the work folder, default: everything")
+    parser.add_argument("-o", help="Folder to restore into, the backed up folder structure is recreated inside it")
+    parser.add_argument("-w", type=int, default=8, help="Number of concurrent downloads or copies, "
+                                                        "default:%(default)s")
+    parser.add_argument("-l", action="store_true", help="List the backups and exit")
+    args = vars(parser.parse_args())
+    if args["w"] < 1:
+        parser.error("-w must be at least 1")
+
+    if args["s"] == "offline":
+        if offline_backup_dst_folder is None:
+            parser.error("WORK_BACKUP is not defined")
+        backups = list_offline_backups(args["n"], offline_backup_dst_folder)
+    else:
+        backups = list_drive_backups(args["n"], drive_folder_id)
+    if args["l"]:
+        for backup in backups:
+            size = "" if backup.size is None else f"{round(backup.size / (1 << 20), 2)} MB"
+            kind = backup.kind + (" (incremental)" if backup.incremental else "")
+            print(f"{backup.dt_string:<21}{kind:<20}{size:>12}  {backup.name}")
+        return
+    if not args["o"]:
+        parser.error("-o is required to restore")
+
+    start_time = time.time()
+    paths = [p.replace(os.sep, "/").strip("/") for p in args["p"]]
+    backup = select_backup(backups, args["b"])
+    output_folder = os.path.abspath(args["o"])
+    os.makedirs(output_folder, exist_ok=True)
+    if backup.kind == "offline":
+        restored, downloaded, failed = restore_offline(backup, paths, output_folder, args["w"])
+    elif backup.kind == "chunk_store":
+        restored, downloaded, failed = restore_chunk_store(backup, paths, output_folder, args["w"])
+    else:
+        chain = get_incremental_chain(backups, backup)
+        restored, downloaded, failed = restore_zips(chain, paths, output_folder, args["w"])
+    for name, error in failed:
+        print(f"{name} could not be restored: {error}")
+    print(f"Restored {restored} files into {output_folder}"
+          + (f", downloaded {round(downloaded / (1 << 20), 2)} MB" if backup.kind != "offline" else ""))
+    minutes, seconds = divmod(time.time() - start_time, 60)
+    print(f"Execution time: {minutes:.0f} minutes and {seconds:.2f} seconds")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
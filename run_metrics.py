@@ -0,0 +1,153 @@
+import heapq
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_VERSION = 1
+# Phases in the order they are reported, a run only records the ones it goes through
+PHASES = ("scan", "exclusion_check", "copy", "zip", "upload", "delete")
+SLOWEST_COUNT = 20  # number of slowest files and directories kept per phase
+
+
+class PhaseMetrics:
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.slowest_files = []  # min-heap of (seconds, path, size), the fastest of the kept ones is popped first
+        self.dir_seconds = {}
+        self.active = 0  # number of threads currently inside the phase
+        self.started = None
+
+
+class RunMetrics:
+    """
+    Wall time, file count and bytes of every phase of a backup run, along with its slowest files and directories.
+
+    Phases can be entered by several threads at once (e.g. concurrent copies or volume uploads) and nested, their
+    wall time is the time during which at least one thread was inside them, so it is never counted twice. Different
+    phases can overlap when the offline and online backups run concurrently, so their times may add up to more than
+    the total time of the run. Every method is thread safe.
+    """
+
+    def __init__(self, slowest_count=SLOWEST_COUNT):
+        self.slowest_count = slowest_count
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def _get(self, phase):
+        phase_metrics = self._phases.get(phase)
+        if phase_metrics is None:
+            phase_metrics = self._phases[phase] = PhaseMetrics()
+        return phase_metrics
+
+    @contextmanager
+    def phase(self, phase):
+        with self._lock:
+            phase_metrics = self._get(phase)
+            if phase_metrics.active == 0:
+                phase_metrics.started = time.perf_counter()
+            phase_metrics.active += 1
+        try:
+            yield phase_metrics
+        finally:
+            with self._lock:
+                phase_metrics.active -= 1
+                if phase_metrics.active == 0:
+                    phase_metrics.seconds += time.perf_counter() - phase_metrics.started
+
+    def add(self, phase, files=0, size=0):
+        with self._lock:
+            phase_metrics = self._get(phase)
+            phase_metrics.files += files
+            phase_metrics.bytes += size
+
+    def record_file(self, phase, path, seconds, size=None):
+        """
+        Records how long phase took for a single file, only the slowest_count slowest ones are kept. Doesn't add to
+        the file count and bytes of the phase.
+        """
+        with self._lock:
+            slowest_files = self._get(phase).slowest_files
+            if len(slowest_files) < self.slowest_count:
+                heapq.heappush(slowest_files, (seconds, path, size))
+            elif seconds > slowest_files[0][0]:
+                heapq.heapreplace(slowest_files, (seconds, path, size))
+
+    def record_dir(self, phase, path, seconds):
+        """
+        Adds to the time phase spent on the files directly inside directory path
+        """
+        with self._lock:
+            dir_seconds = self._get(phase).dir_seconds
+            dir_seconds[path] = dir_seconds.get(path, 0.0) + seconds
+
+    def to_dict(self):
+        with self._lock:
+            total_seconds = time.perf_counter() - self._start
+            phases = {}
+            for phase in sorted(self._phases, key=lambda p: PHASES.index(p) if p in PHASES else len(PHASES)):
+                phase_metrics = self._phases[phase]
+                seconds = phase_metrics.seconds
+                if phase_metrics.active:
+                    seconds += time.perf_counter() - phase_metrics.started
+                slowest_dirs = heapq.nlargest(self.slowest_count, phase_metrics.dir_seconds.items(),
+                                              key=lambda item: item[1])
+                phases[phase] = {
+                    "seconds": round(seconds, 3),
+                    "files": phase_metrics.files,
+                    "bytes": phase_metrics.bytes,
+                    "mb_per_s": round(phase_metrics.bytes / (1 << 20) / seconds, 2) if seconds else None,
+                    "slowest_files": [{"path": path, "seconds": round(file_seconds, 3), "bytes": size}
+                                      for file_seconds, path, size in sorted(phase_metrics.slowest_files,
+                                                                              reverse=True)],
+                    "slowest_dirs": [{"path": path, "seconds": round(dir_seconds, 3)}
+                                     for path, dir_seconds in slowest_dirs],
+                }
+        return {"version": METRICS_VERSION, "started_at": self.started_at.isoformat(timespec="seconds"),
+                "total_seconds": round(total_seconds, 3), "phases": phases}
+
+    def save(self, filepath, **run_info):
+        """
+        Atomically writes the metrics as JSON to filepath, along with run_info (e.g. the folder and options of the run)
+        """
+        metrics = self.to_dict()
+        metrics.update(run_info)
+        tmp_path = filepath + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics, f, indent=2)
+        os.replace(tmp_path, filepath)
+        return metrics
+
+    def print_summary(self):
+        phases = self.to_dict()["phases"]
+        if not phases:
+            return
+        print(f"{'phase':<16}{'seconds':>10}{'files':>9}{'MB':>11}{'MB/s':>9}")
+        for phase, phase_metrics in phases.items():
+            print(f"{phase:<16}{phase_metrics['seconds']:>10}{phase_metrics['files']:>9}"
+                  f"{round(phase_metrics['bytes'] / (1 << 20), 2):>11}{phase_metrics['mb_per_s'] or '':>9}")
+
+
+_run_metrics = RunMetrics()
+
+
+def get_run_metrics():
+    """
+    Metrics of the current run, recorded into by every module
+    """
+    return _run_metrics
+
+
+def reset_run_metrics():
+    """
+    Starts recording the metrics of a new run and returns them
+    """
+    global _run_metrics
+    _run_metrics = RunMetrics()
+    return _run_metrics
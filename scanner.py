@@ -0,0 +1,88 @@
+import os
+import stat
+import time
+from typing import List, NamedTuple
+
+from run_metrics import get_run_metrics
+
+
+class FileRecord(NamedTuple):
+    path: str
+    name: str
+    size: int
+    mtime_ns: int
+    mode: int
+
+
+class DirRecord(NamedTuple):
+    path: str
+    entry_count: int  # number of files and folders directly inside path, i.e. len(os.listdir(path))
+    subdirs: List[str]  # full paths of subdirectories that were descended into
+    files: List[FileRecord]  # regular files directly inside path, symlinks to files are followed like os.path.isfile
+
+
+def scan_tree(root, prune_dirnames=None):
+    """
+    Walks root with os.scandir, in the same top-down order as os.walk, and returns a list of DirRecord. Every file is
+    stat'ed exactly once, directory entries are counted as a by-product and symlinks to directories are not followed.
+
+    Parameters
+    ----------
+    root: Folder to be scanned
+    prune_dirnames: Optional callable(path, dirnames) that removes entries from dirnames in place, these
+                    subdirectories are never scanned
+    """
+    dir_records = []
+    stack = [root]
+    while stack:
+        dir_record = scan_dir(stack.pop(), prune_dirnames)
+        if dir_record is not None:
+            dir_records.append(dir_record)
+            stack.extend(reversed(dir_record.subdirs))
+    return dir_records
+
+
+def scan_dir(path, prune_dirnames=None):
+    """
+    Returns the DirRecord of path alone, without descending into its subdirectories, or None if it can't be read
+    (e.g. it was deleted)
+    """
+    start = time.perf_counter()
+    dirnames = []
+    files = []
+    entry_count = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_count += 1
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirnames.append(entry.name)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    # Broken symlink or entry deleted during the scan
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files.append(FileRecord(entry.path, entry.name, st.st_size, st.st_mtime_ns, st.st_mode))
+    except OSError:
+        # Unreadable directory, skipped like os.walk does
+        return None
+
+    if prune_dirnames is not None:
+        prune_dirnames(path, dirnames)
+    get_run_metrics().record_dir("scan", path, time.perf_counter() - start)
+    return DirRecord(path, entry_count, [os.path.join(path, d) for d in dirnames], files)
+
+
+def build_dir_size_index(dir_records):
+    """
+    Returns a dict mapping every scanned directory to the total size in bytes of all files recursively inside it, so
+    that each size is only summed once no matter how many of its ancestors are looked up later
+    """
+    dir_sizes = {}
+    # Children are always scanned after their parent, so summing in reverse order is a bottom-up pass
+    for dir_record in reversed(dir_records):
+        dir_sizes[dir_record.path] = sum(f.size for f in dir_record.files) + sum(
+            dir_sizes.get(subdir, 0) for subdir in dir_record.subdirs)
+    return dir_sizes
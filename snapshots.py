@@ -0,0 +1,120 @@
+import errno
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime
+
+from common_utils import CopyJob, copy_files
+
+SNAPSHOT_TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"  # same as the folders created by move_folder_with_sandwiched_timestamp
+SNAPSHOT_TIMESTAMP_PATTERN = re.compile(r"\d{8}_\d{6}\Z")
+PARTIAL_SUFFIX = ".partial"
+# errors meaning a hard link can't be created, so the file is copied instead
+LINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def list_snapshots(dest_folder, backup_name):
+    """
+    Returns the paths of complete snapshots of backup_name under dest_folder (i.e. dest_folder/<timestamp>/backup_name),
+    oldest first. Snapshots that are still being written are in a .partial folder and are never listed.
+    """
+    if not os.path.isdir(dest_folder):
+        return []
+    return [os.path.join(dest_folder, timestamp, backup_name) for timestamp in sorted(os.listdir(dest_folder))
+            if SNAPSHOT_TIMESTAMP_PATTERN.match(timestamp)
+            and os.path.isdir(os.path.join(dest_folder, timestamp, backup_name))]
+
+
+def _is_unchanged(previous_filepath, file_record):
+    try:
+        st = os.stat(previous_filepath)
+    except OSError:
+        return False
+    return st.st_size == file_record.size and st.st_mtime_ns == file_record.mtime_ns
+
+
+def create_link_snapshot(planned_files, dest_folder, backup_name, workers=1, hashes=None):
+    """
+    Writes planned_files into a new dest_folder/<timestamp>/backup_name snapshot, like rsync --link-dest. Files whose
+    size and mtime match the same file in the most recent snapshot are hard-linked to it, only the others are
+    physically copied (keeping their mtime, so that they can be linked by the next snapshot). The snapshot is written
+    into a .partial folder of its own and moved into its timestamp folder once complete, so that snapshots of other
+    folders started within the same second (e.g. several work folders backed up at once) never share it.
+
+    Parameters
+    ----------
+    planned_files: List of backup_work_folder.PlannedFile
+    dest_folder: Folder containing the timestamped snapshots (WORK_BACKUP)
+    backup_name: Name of the snapshot folder inside each timestamp folder, e.g. work_offline_backup
+    workers: Number of files copied concurrently
+    hashes: If given, the files that are copied are hashed on the way and hashes[src] is set to their md5, see
+            common_utils.copy_files. Hard-linked files aren't read, so they aren't hashed.
+
+    Returns
+    -------
+    list of (src, OSError) for the files that could not be copied or linked
+    """
+    snapshots = list_snapshots(dest_folder, backup_name)
+    previous_snapshot = snapshots[-1] if snapshots else None
+    timestamp = datetime.now().strftime(SNAPSHOT_TIMESTAMP_FORMAT)
+    os.makedirs(dest_folder, exist_ok=True)
+    partial_folder = tempfile.mkdtemp(prefix=timestamp + ".", suffix=PARTIAL_SUFFIX, dir=dest_folder)
+    snapshot_root = os.path.join(partial_folder, backup_name)
+
+    copy_jobs = []
+    mtimes_ns = {}
+    linked = 0
+    for dst_dir in sorted({os.path.dirname(os.path.join(snapshot_root, f.rel_filepath)) for f in planned_files}):
+        os.makedirs(dst_dir, exist_ok=True)
+    for f in planned_files:
+        dst = os.path.join(snapshot_root, f.rel_filepath)
+        if previous_snapshot is not None:
+            previous_filepath = os.path.join(previous_snapshot, f.rel_filepath)
+            if _is_unchanged(previous_filepath, f.record):
+                try:
+                    os.link(previous_filepath, dst)
+                    linked += 1
+                    continue
+                except OSError as e:
+                    if e.errno not in LINK_UNSUPPORTED_ERRNOS:
+                        raise
+        copy_jobs.append(CopyJob(f.record.path, dst, f.record.size, f.record.mode))
+        mtimes_ns[dst] = f.record.mtime_ns
+
+    print(f"Snapshot {timestamp}: {linked} unchanged files hard-linked to "
+          f"{previous_snapshot or 'no previous snapshot'}, copying {len(copy_jobs)} files...")
+    failed_copies = copy_files(copy_jobs, workers, hashes)
+    failed_filepaths = {src for src, _ in failed_copies}
+    for job in copy_jobs:
+        if job.src not in failed_filepaths:
+            os.utime(job.dst, ns=(mtimes_ns[job.dst], mtimes_ns[job.dst]))
+
+    # another folder may have been backed up within the same second
+    final_folder = os.path.join(dest_folder, timestamp)
+    os.makedirs(final_folder, exist_ok=True)
+    final_snapshot = os.path.join(final_folder, backup_name)
+    if os.path.isdir(final_snapshot):
+        # an earlier snapshot of the same folder taken within the same second, which this one supersedes (files
+        # hard-linked to it stay in this one)
+        shutil.rmtree(final_snapshot)
+    os.rename(snapshot_root, final_snapshot)
+    os.rmdir(partial_folder)
+    return failed_copies
+
+
+def prune_snapshots(dest_folder, backup_name, keep):
+    """
+    Deletes all but the keep most recent complete snapshots of backup_name. Only backup_name folders inside timestamp
+    folders are deleted (and then their timestamp folder, if nothing else is left in it), so backups of other folders
+    and unrelated files in dest_folder are never touched. Files hard-linked into newer snapshots are kept by the file
+    system.
+    """
+    if keep < 1:
+        raise ValueError("At least one snapshot must be kept")
+    for snapshot in list_snapshots(dest_folder, backup_name)[:-keep]:
+        print(f"Pruning old snapshot {snapshot}")
+        shutil.rmtree(snapshot)
+        timestamp_folder = os.path.dirname(snapshot)
+        if not os.listdir(timestamp_folder):
+            os.rmdir(timestamp_folder)
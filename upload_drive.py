@@ -1,24 +1,317 @@
 from __future__ import print_function
 
 import argparse
+import hashlib
+import io
+import json
 import mimetypes
 import os
 import pickle
-
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import httplib2
 from apiclient import errors
 from dotenv import load_dotenv
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload, MediaUpload
 
 from common_utils import get_file_size_mb
+from run_metrics import get_run_metrics
+from upload_scheduler import INITIAL_CHUNK_SIZE, BandwidthLimiter, BandwidthSchedule, ChunkSizer, UploadQueue
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/drive']
 WORK_BACKUP = ""
 WORK_DIR = ""
 DEFAULT_DRIVE_FOLDER_ID = ""
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024  # must be a multiple of 256 KB
+VOLUME_MANIFEST_SUFFIX = ".manifest.json"
+UPLOAD_STATE_FILENAME = "upload_state.json"
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+MAX_UPLOAD_RETRIES = 8  # consecutive failed attempts before an upload is abandoned
+MAX_RETRY_DELAY = 64  # seconds
+_upload_state_lock = threading.Lock()
+BATCH_SIZE = 100  # maximum number of calls Drive accepts in one batch request
+_credentials = None
+_credentials_lock = threading.Lock()
+_thread_local = threading.local()
+_upload_queue = None  # set by shared_upload_queue
+_bandwidth_limiter = None  # set by set_bandwidth_limit
+_initial_chunk_size = INITIAL_CHUNK_SIZE  # chunk size reached by the previous upload, where the next one starts
+
+
+class FileSlice:
+    """
+    Seekable, read-only view of length bytes of a file starting at offset, so that a volume of a large file can be
+    uploaded without being written to disk separately. The md5 of the slice is computed from the bytes as they are
+    read for the first time, so chunks that are sent again after an error aren't hashed twice.
+    """
+
+    def __init__(self, filepath, offset, length):
+        self._file = open(filepath, 'rb')
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        self._md5 = hashlib.md5()
+        self._hashed = 0  # bytes of the slice already added to _md5
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._length
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._length - self._pos:
+            size = self._length - self._pos
+        self._file.seek(self._offset + self._pos)
+        data = self._file.read(size)
+        if self._pos <= self._hashed < self._pos + len(data):
+            self._md5.update(data[self._hashed - self._pos:])
+            self._hashed = self._pos + len(data)
+        self._pos += len(data)
+        return data
+
+    def hexdigest(self):
+        if self._hashed < self._length:
+            position = self._pos
+            self.seek(self._hashed)
+            while self.read(1 << 20):
+                pass
+            self.seek(position)
+        return self._md5.hexdigest()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MediaStreamUpload(MediaUpload):
+    """
+    Resumable upload of a non-seekable stream whose size isn't known in advance, e.g. archive.ZipStream.
+    Bytes that Drive hasn't acknowledged yet are kept in memory, so at most about two chunks are buffered. Every byte
+    is read from the stream once, and hashed as it is read.
+    """
+
+    def __init__(self, stream, mimetype, chunksize=STREAM_CHUNK_SIZE, max_size_mb=None):
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._max_size_mb = max_size_mb
+        self._buffer = bytearray()
+        self._buffer_start = 0  # offset in the stream of the first byte in _buffer
+        self._served_end = 0  # offset up to which bytes have been handed out by getbytes
+        self._total_size = None
+        self._md5 = hashlib.md5()
+        self.error = None  # set once reading the stream fails, such an upload must not be retried
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def _read_until(self, offset):
+        if self.error is not None:
+            raise self.error
+        while self._total_size is None and self._buffer_start + len(self._buffer) < offset:
+            try:
+                data = self._stream.read(offset - self._buffer_start - len(self._buffer))
+            except Exception as e:
+                self.error = e
+                raise
+            if not data:
+                self._total_size = self._buffer_start + len(self._buffer)
+                break
+            self._md5.update(data)
+            self._buffer += data
+            if self._max_size_mb is not None and (self._buffer_start + len(self._buffer)) / (
+                    1 << 20) > self._max_size_mb:
+                raise ValueError(f"Uploaded stream exceeds {self._max_size_mb} MB")
+
+    def size(self):
+        # The size is reported before each chunk is requested, so read ahead by a chunk to find out whether the next
+        # one is the last. Otherwise a stream ending exactly on a chunk boundary could never be finalised.
+        self._read_until(self._served_end + self._chunksize + 1)
+        return self._total_size
+
+    def getbytes(self, begin, length):
+        # Drive never asks for bytes before an acknowledged offset again
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._read_until(begin + length)
+        data = bytes(self._buffer[:length])
+        self._served_end = begin + len(data)
+        return data
+
+    def has_stream(self):
+        return False
+
+    def hexdigest(self):
+        """
+        md5 of the stream, once it has been read completely
+        """
+        return self._md5.hexdigest()
+
+
+@contextmanager
+def shared_upload_queue(workers):
+    """Make every upload, from any thread, go through one UploadQueue of workers slots until exiting.
+
+    No more than workers files or volumes are then uploaded at a time in total, no matter how many of them each work
+    folder uploads concurrently, and smaller files waiting for a slot go before larger ones.
+
+    Args:
+        workers: Maximum number of uploads running at once
+    """
+    global _upload_queue
+    _upload_queue = UploadQueue(workers)
+    try:
+        yield _upload_queue
+    finally:
+        _upload_queue = None
+
+
+def set_bandwidth_limit(spec):
+    """Limit the combined rate of every upload of the run.
+
+    Args:
+        spec: Limit in MB/s, or limits by time of day like "09:00-18:00=1.5,5" (see BandwidthSchedule), None or an
+            empty string removes the limit
+    """
+    global _bandwidth_limiter
+    _bandwidth_limiter = BandwidthLimiter(BandwidthSchedule.parse(spec)) if spec else None
+
+
+def get_upload_state_path():
+    """
+    State of interrupted uploads is stored in the project's root dir (gitignored), so that a rerun can resume them
+    """
+    return os.path.join(Path(__file__).resolve().parent, UPLOAD_STATE_FILENAME)
+
+
+def _load_upload_state():
+    state_path = get_upload_state_path()
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def _update_upload_state(key, entry):
+    """
+    Atomically sets the entry of an upload in the state file, or removes it if entry is None
+    """
+    with _upload_state_lock:
+        state = _load_upload_state()
+        if entry is None:
+            if state.pop(key, None) is None:
+                return
+        else:
+            state[key] = entry
+        state_path = get_upload_state_path()
+        if not state:
+            Path(state_path).unlink(missing_ok=True)
+            return
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, state_path)
+
+
+def _upload_identity(filepath, offset, length, filename, destination_drive_folder_id):
+    """
+    Returns the state file key of uploading length bytes of filepath from offset, and the identity of the file that
+    has to match for an interrupted upload of it to be resumed
+    """
+    st = os.stat(filepath)
+    key = f"{filepath}:{offset}:{length}"
+    identity = {'filepath': filepath, 'name': filename, 'folder_id': destination_drive_folder_id,
+                'file_size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return key, identity
+
+
+def _get_pending_upload(key, identity):
+    entry = _load_upload_state().get(key)
+    if entry is None:
+        return None
+    if any(entry.get(k) != v for k, v in identity.items()):
+        print(f"{identity['filepath']} changed since its upload was interrupted, uploading it from the start")
+        _update_upload_state(key, None)
+        return None
+    return entry
+
+
+def get_pending_uploads():
+    """
+    Returns the paths of files whose upload was interrupted and can still be resumed, i.e. they haven't been modified
+    since. Entries of files that no longer exist or were modified are dropped from the state file.
+    """
+    filepaths = []
+    for key, entry in _load_upload_state().items():
+        try:
+            st = os.stat(entry['filepath'])
+        except OSError:
+            _update_upload_state(key, None)
+            continue
+        if st.st_size != entry['file_size'] or st.st_mtime_ns != entry['mtime_ns']:
+            _update_upload_state(key, None)
+        elif entry['filepath'] not in filepaths:
+            filepaths.append(entry['filepath'])
+    return filepaths
+
+
+def _query_upload_session(request, session_uri):
+    """
+    Asks Drive how many bytes of an interrupted resumable upload it has committed, and sets up request to continue
+    from there. Returns the created file if the upload had actually completed, None otherwise. If the session has
+    expired, request starts a new upload from byte zero.
+    """
+    size = request.resumable.size()
+    headers = {'Content-Range': f"bytes */{'*' if size is None else size}", 'Content-Length': '0'}
+    resp, content = request.http.request(session_uri, 'PUT', headers=headers)
+    if resp.status in (200, 201):
+        return request.postproc(resp, content)
+    if resp.status in (404, 410):
+        print("Upload session has expired, uploading from the start")
+        request.resumable_uri = None
+        request.resumable_progress = 0
+        return None
+    if resp.status != 308:
+        raise errors.HttpError(resp, content, uri=session_uri)
+    request.resumable_uri = session_uri
+    # Range is absent if Drive hasn't committed any byte yet
+    request.resumable_progress = int(resp['range'].rpartition('-')[2]) + 1 if 'range' in resp else 0
+    return None
+
+
+def _is_transient_error(error, media):
+    if getattr(media, 'error', None) is not None:
+        # the data being uploaded can't be read, sending it again won't help
+        return False
+    if isinstance(error, errors.HttpError):
+        return error.resp.status in RETRYABLE_STATUS_CODES
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
 
 
 def trash_file(service, file_id):
@@ -41,6 +334,35 @@ def trash_file(service, file_id):
     return None
 
 
+def trash_files(service, file_ids):
+    """Move files in Google Drive to the trash, with one batch request per BATCH_SIZE files.
+
+    Args:
+      service: Drive API service instance.
+      file_ids: IDs of the files to trash.
+
+    Returns:
+      list: IDs of the files that were trashed.
+    """
+    trashed_ids = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print('An error occurred: %s' % exception)
+        else:
+            trashed_ids.append(response['id'])
+
+    metrics = get_run_metrics()
+    with metrics.phase("delete"):
+        for i in range(0, len(file_ids), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for file_id in file_ids[i:i + BATCH_SIZE]:
+                batch.add(service.files().update(fileId=file_id, body={'trashed': True}, fields='id'))
+            batch.execute()
+    metrics.add("delete", len(trashed_ids))
+    return trashed_ids
+
+
 def delete_by_filename(service, filename: str):
     """Delete all files matching filename on Google Drive.
 
@@ -50,10 +372,12 @@ def delete_by_filename(service, filename: str):
     """
     page_token = None
     delete_file_ids = []
+    escaped_filename = filename.replace('\\', '\\\\').replace("'", "\\'")
     while True:
-        response = service.files().list(q="name='{}'".format(filename),
+        response = service.files().list(q="name='{}' and trashed=false".format(escaped_filename),
                                         spaces='drive',
                                         fields='nextPageToken, files(id, name)',
+                                        pageSize=1000,
                                         pageToken=page_token).execute()
         for file in response.get('files', []):
             # Process change
@@ -62,35 +386,295 @@ def delete_by_filename(service, filename: str):
         page_token = response.get('nextPageToken', None)
         if page_token is None:
             break
-    for file_id in delete_file_ids:
-        trash_file(service, file_id)
-        print("Deleted")
+    if delete_file_ids:
+        print(f"Deleted {len(trash_files(service, delete_file_ids))} files")
 
 
 def upload_file(filepath_argument: str, delete_existing, destination_drive_folder_id, report_free_space=False):
-    check_and_fetch_env_vars()
     filepath = os.path.abspath(filepath_argument)
     _print_file_size(filepath)
+    service = get_drive_service()
+
+    filename = os.path.basename(filepath)
+    state_key, identity = _upload_identity(filepath, 0, os.path.getsize(filepath), filename,
+                                           destination_drive_folder_id)
+    # pre-existing files were already deleted when the interrupted upload was started
+    if delete_existing and _get_pending_upload(state_key, identity) is None:
+        delete_by_filename(service, filename)
+
+    mime_type = get_mime_type(filepath)
+    # hashed while it is read for the upload, instead of reading the file once more
+    with FileSlice(filepath, 0, os.path.getsize(filepath)) as file_slice:
+        media = MediaIoBaseUpload(file_slice, mimetype=mime_type, resumable=True)
+        response = _execute_upload(service, media, filename, destination_drive_folder_id, state_key=state_key,
+                                   identity=identity)
+        verify_md5(service, response, file_slice.hexdigest(), filename)
 
-    creds = get_credentials()
-    service = build('drive', 'v3', credentials=creds)
+    if report_free_space:
+        print_free_space(service)
+    return response
+
+
+def upload_stream(stream, filename: str, delete_existing, destination_drive_folder_id, max_size_mb=None,
+                  report_free_space=False):
+    """Upload a readable stream of unknown size to Google Drive without storing it in a local file first.
+
+    Args:
+        stream: Object with a read(size) method, e.g. archive.ZipStream
+        filename (str): Name of the file created on Google Drive
+        delete_existing: Whether pre-existing files of the same name should be deleted
+        destination_drive_folder_id: Parent drive folder's ID
+        max_size_mb (optional): The upload is abandoned with a ValueError once the stream exceeds this size. Drive
+            discards resumable uploads that are never finalised, so nothing partial is left behind.
+        report_free_space (bool, optional): Whether drive free space should be printed
+    """
+    service = get_drive_service()
 
     if delete_existing:
-        delete_by_filename(service, os.path.basename(filepath))
+        delete_by_filename(service, filename)
 
-    mime_type = get_mime_type(filepath)
-    media = MediaFileUpload(filepath, mimetype=mime_type, resumable=True)
-    file_metadata = {'name': os.path.basename(filepath), 'parents': [destination_drive_folder_id]}
-    request = service.files().create(media_body=media, body=file_metadata)
+    media = MediaStreamUpload(stream, get_mime_type(filename), max_size_mb=max_size_mb)
+    response = _execute_upload(service, media, filename, destination_drive_folder_id)
+    verify_md5(service, response, media.hexdigest(), filename)
+
+    if report_free_space:
+        print_free_space(service)
+
+
+def upload_volumes(filepath_argument: str, volume_size_mb, destination_drive_folder_id, workers=4,
+                   report_free_space=False):
+    """Upload a large file as consecutive volumes of volume_size_mb, several at a time, followed by a manifest.
+
+    Volumes are named <filename>.001, <filename>.002, etc. and concatenating them in order gives back the file. The
+    manifest, <filename>.manifest.json, records the offset, size, md5 and Drive file ID of every volume, in order.
+    If the upload is interrupted, rerunning it for the same file skips the volumes that were completed and resumes
+    the others.
+
+    Args:
+        filepath_argument (str): Absolute or relative path of the file to be uploaded
+        volume_size_mb: Size of each volume in MB, the last one may be smaller
+        destination_drive_folder_id: Parent drive folder's ID
+        workers (optional): Number of volumes uploaded concurrently
+        report_free_space (bool, optional): Whether drive free space should be printed
+    Returns:
+        dict: The manifest
+    """
+    filepath = os.path.abspath(filepath_argument)
+    filename = os.path.basename(filepath)
+    _print_file_size(filepath)
+    file_size = os.path.getsize(filepath)
+    volume_size = volume_size_mb << 20
+    volumes = [(i, offset, min(volume_size, file_size - offset))
+               for i, offset in enumerate(range(0, max(file_size, 1), volume_size))]
+    print(f"Uploading {filename} as {len(volumes)} volumes of up to {volume_size_mb} MB using {workers} worker(s)")
+
+    def upload_volume(volume):
+        i, offset, length = volume
+        volume_name = f"{filename}.{i + 1:03d}"
+        state_key, identity = _upload_identity(filepath, offset, length, volume_name, destination_drive_folder_id)
+        state_keys.append(state_key)
+        return _upload_volume(filepath, offset, length, volume_name, offset, destination_drive_folder_id,
+                              state_key, identity)
+
+    state_keys = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        uploaded_volumes = list(executor.map(upload_volume, volumes))
+
+    manifest = _upload_volume_manifest(filename, file_size, volume_size, uploaded_volumes,
+                                       destination_drive_folder_id, report_free_space)
+    # completed volumes are remembered until the manifest is uploaded, so that a rerun only uploads the missing ones
+    for state_key in state_keys:
+        _update_upload_state(state_key, None)
+    return manifest
+
+
+def upload_segments(segments, filename: str, segment_size, destination_drive_folder_id, workers=4,
+                    report_free_space=False):
+    """Upload the volumes of a file that is still being written, as each of them is completed, followed by a manifest.
+
+    The volumes and manifest are the same as with upload_volumes. Each volume file is deleted once uploaded, and the
+    next one is only taken from segments once one of the workers is free, so that a producer blocking on a bounded
+    queue (e.g. archive.ZipSegments) never gets too far ahead of the uploads. If anything fails, the volumes that
+    were already uploaded are trashed.
+
+    Args:
+        segments: Iterable of (volume filepath, offset in the file, length) of consecutive volumes
+        filename (str): Name of the file the volumes make up
+        segment_size: Size in bytes of every volume but the last
+        destination_drive_folder_id: Parent drive folder's ID
+        workers (optional): Number of volumes uploaded concurrently
+        report_free_space (bool, optional): Whether drive free space should be printed
+    Returns:
+        dict: The manifest
+    """
+    free_workers = threading.Semaphore(workers)
+
+    def upload_segment(i, segment_filepath, offset, length):
+        try:
+            return _upload_volume(segment_filepath, 0, length, f"{filename}.{i + 1:03d}", offset,
+                                  destination_drive_folder_id)
+        finally:
+            os.remove(segment_filepath)
+            free_workers.release()
+
+    futures = []
+    print(f"Uploading {filename} as volumes of up to {segment_size >> 20} MB while it is being written, using "
+          f"{workers} worker(s)")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for i, (segment_filepath, offset, length) in enumerate(segments):
+                free_workers.acquire()
+                futures.append(executor.submit(upload_segment, i, segment_filepath, offset, length))
+            uploaded_volumes = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            uploaded_ids = [future.result()['id'] for future in futures
+                            if future.done() and not future.cancelled() and future.exception() is None]
+            if uploaded_ids:
+                print(f"Trashing the {len(uploaded_ids)} volumes of {filename} uploaded so far")
+                trash_files(get_drive_service(), uploaded_ids)
+            raise
+
+    file_size = sum(volume['size'] for volume in uploaded_volumes)
+    return _upload_volume_manifest(filename, file_size, segment_size, uploaded_volumes, destination_drive_folder_id,
+                                   report_free_space)
+
+
+def _upload_volume(filepath, file_offset, length, volume_name, offset, destination_drive_folder_id, state_key=None,
+                   identity=None):
+    """
+    Uploads length bytes of filepath from file_offset as volume_name, returns its manifest entry where offset is the
+    volume's offset in the complete file
+    """
+    with FileSlice(filepath, file_offset, length) as volume_slice:
+        media = MediaIoBaseUpload(volume_slice, mimetype='application/octet-stream', resumable=True)
+        response = _execute_upload(get_drive_service(), media, volume_name, destination_drive_folder_id,
+                                   label=volume_name, state_key=state_key, identity=identity,
+                                   keep_completed=state_key is not None)
+        md5 = volume_slice.hexdigest()
+    verify_md5(get_drive_service(), response, md5, volume_name)
+    return {'name': volume_name, 'offset': offset, 'size': length, 'md5': md5, 'id': response.get('id')}
+
+
+def _upload_volume_manifest(filename, file_size, volume_size, uploaded_volumes, destination_drive_folder_id,
+                            report_free_space):
+    manifest = {'name': filename, 'size': file_size, 'volume_size': volume_size, 'volumes': uploaded_volumes}
+    service = get_drive_service()
+    data = json.dumps(manifest, indent=2).encode()
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype='application/json', resumable=True)
+    response = _execute_upload(service, media, filename + VOLUME_MANIFEST_SUFFIX, destination_drive_folder_id)
+    verify_md5(service, response, hashlib.md5(data).hexdigest(), filename + VOLUME_MANIFEST_SUFFIX)
+    if report_free_space:
+        print_free_space(service)
+    return manifest
+
+
+def _execute_upload(service, media, filename, destination_drive_folder_id, label=None, state_key=None,
+                    identity=None, keep_completed=False):
+    """
+    Uploads media chunk by chunk. Transient HTTP and connection errors are retried with exponential backoff, up to
+    MAX_UPLOAD_RETRIES times in a row. Inside shared_upload_queue, the upload first waits for a free slot. The chunk
+    size adapts to the throughput of each chunk (see upload_scheduler.ChunkSizer) and chunks wait for the bandwidth
+    limit, if any.
+
+    If state_key is given, the session URI and the number of bytes acknowledged by Drive are saved to the upload state
+    file after every chunk, so that a rerun continues an interrupted upload of the same file (as long as it still
+    matches identity) from the last committed offset. The entry is removed once the upload completes, unless
+    keep_completed is set, in which case the created file is recorded in it so that a rerun doesn't upload it again.
+    """
+    metrics = get_run_metrics()
+    # the size of a stream is unknown until it has been read, it waits behind every file
+    size = None if isinstance(media, MediaStreamUpload) else media.size()
+    with _upload_queue.slot(size) if _upload_queue is not None else nullcontext(), metrics.phase("upload"):
+        start = time.perf_counter()
+        response, uploaded_bytes = _execute_resumable_upload(service, media, filename, destination_drive_folder_id,
+                                                             label, state_key, identity, keep_completed)
+        if uploaded_bytes is not None:
+            metrics.add("upload", 1, uploaded_bytes)
+            metrics.record_file("upload", filename, time.perf_counter() - start, uploaded_bytes)
+    return response
+
+
+def _execute_resumable_upload(service, media, filename, destination_drive_folder_id, label, state_key, identity,
+                              keep_completed):
+    """
+    Does the work of _execute_upload, returns (response, number of bytes sent by this call or None if the file had
+    already been uploaded by a previous run)
+    """
+    file_metadata = {'name': filename, 'parents': [destination_drive_folder_id]}
+    request = service.files().create(media_body=media, body=file_metadata, fields='id, name, md5Checksum')
+    prefix = f"{label}: " if label else ""
     response = None
+    entry = _get_pending_upload(state_key, identity) if state_key else None
+    if entry is not None:
+        if 'response' in entry:
+            print(prefix + "Already uploaded by a previous run")
+            return entry['response'], None
+        response = _query_upload_session(request, entry['session_uri'])
+        if response is None and request.resumable_uri is not None:
+            print(prefix + f"Resuming interrupted upload from {round(request.resumable_progress / (1 << 20), 2)} MB")
+    resumed_from = request.resumable_progress if response is None else media.size()
+
+    global _initial_chunk_size
+    chunk_sizer = ChunkSizer(_initial_chunk_size)
+    retries = 0
     while response is None:
-        status, response = request.next_chunk()
+        chunk_size = chunk_sizer.chunk_size
+        if _bandwidth_limiter is not None:
+            chunk_size = min(chunk_size, _bandwidth_limiter.max_chunk_size() or chunk_size)
+        # the library reads the chunk size of the media before every chunk
+        media._chunksize = chunk_size
+        if _bandwidth_limiter is not None:
+            # a stream's size is only known once it has been read, its last chunk may reserve a little too much
+            remaining = None if media.size() is None else media.size() - request.resumable_progress
+            _bandwidth_limiter.acquire(chunk_size if remaining is None else min(chunk_size, remaining))
+        progress = request.resumable_progress
+        start = time.perf_counter()
+        try:
+            status, response = request.next_chunk()
+        except Exception as e:
+            if not _is_transient_error(e, media) or retries >= MAX_UPLOAD_RETRIES:
+                raise
+            chunk_sizer.failed()
+            retries += 1
+            delay = min(2 ** retries, MAX_RETRY_DELAY) * random.uniform(0.5, 1)
+            print(prefix + f"Upload failed ({e}), retrying in {round(delay, 1)} seconds "
+                           f"(attempt {retries} of {MAX_UPLOAD_RETRIES})")
+            time.sleep(delay)
+            continue
+        retries = 0
+        if response is None and request.resumable_progress - progress == chunk_size:
+            chunk_sizer.update(chunk_size, time.perf_counter() - start)
+            _initial_chunk_size = chunk_sizer.chunk_size
+        if state_key and response is None and request.resumable_uri is not None:
+            _update_upload_state(state_key, dict(identity, session_uri=request.resumable_uri,
+                                                 acknowledged=request.resumable_progress))
         if status:
-            print("Uploaded %d%%." % int(status.progress() * 100))
-    print("Upload Complete!")
+            if status.total_size:
+                print(prefix + "Uploaded %d%%." % int(status.progress() * 100))
+            else:
+                print(prefix + f"Uploaded {round(status.resumable_progress / (1 << 20), 2)} MB.")
+    if state_key:
+        _update_upload_state(state_key, dict(identity, response=response) if keep_completed else None)
+    print(prefix + "Upload Complete!")
+    return response, media.size() - resumed_from
 
-    if report_free_space:
-        print_free_space(service)
+
+def verify_md5(service, response, md5, filename):
+    """Check the md5Checksum Drive computed for an uploaded file against the md5 hashed locally from the bytes that
+    were sent. On a mismatch, the corrupted file is trashed and an IOError is raised.
+
+    Files uploaded by runs which didn't request md5Checksum aren't checked.
+    """
+    drive_md5 = (response or {}).get('md5Checksum')
+    if drive_md5 is None or drive_md5 == md5:
+        return
+    if response.get('id'):
+        trash_file(service, response['id'])
+    raise IOError(f"{filename} was corrupted during upload, its md5 on Drive is {drive_md5} instead of {md5}. "
+                  f"The corrupted file was trashed.")
 
 
 def _print_file_size(filepath: str):
@@ -98,6 +682,23 @@ def _print_file_size(filepath: str):
     print(f"File Size is : {round(file_size, 2)} MB")
 
 
+def get_drive_service():
+    """
+    Returns the Drive API service of the calling thread. Credentials are loaded once per run and every thread builds
+    its service once, since httplib2 connections can't be shared between threads. Reusing the service keeps its
+    connection to Drive open across all the uploads and metadata calls of a run.
+    """
+    global _credentials
+    service = getattr(_thread_local, "service", None)
+    if service is None:
+        with _credentials_lock:
+            if _credentials is None:
+                check_and_fetch_env_vars()
+                _credentials = get_credentials()
+        service = _thread_local.service = build('drive', 'v3', credentials=_credentials)
+    return service
+
+
 def get_credentials():
     """
     Reads credentials.json stored in directory defined in .env, throws an error if not found
@@ -138,8 +739,56 @@ def get_mime_type(filepath):
     return mt[0]
 
 
+def list_folder(destination_drive_folder_id):
+    """List the files in a Google Drive folder, excluding trashed ones.
+
+    Args:
+        destination_drive_folder_id: Drive folder's ID
+    Returns:
+        list: A dict with the 'id', 'name' and 'size' of every file
+    """
+    service = get_drive_service()
+    files = []
+    page_token = None
+    while True:
+        response = service.files().list(q="'{}' in parents and trashed=false".format(destination_drive_folder_id),
+                                        spaces='drive',
+                                        fields='nextPageToken, files(id, name, size)',
+                                        pageSize=1000,
+                                        pageToken=page_token).execute(num_retries=MAX_UPLOAD_RETRIES)
+        files.extend(response.get('files', []))
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            return files
+
+
+def download_range(file_id, start, length):
+    """Download length bytes of a Google Drive file starting at offset start, with a single ranged request.
+
+    Transient errors are retried with exponential backoff, like uploads.
+
+    Args:
+        file_id: Drive file's ID
+        start: Offset of the first byte
+        length: Number of bytes, the file must contain them all
+    Returns:
+        bytes: The downloaded bytes
+    """
+    request = get_drive_service().files().get_media(fileId=file_id)
+    request.headers['Range'] = f'bytes={start}-{start + length - 1}'
+    data = request.execute(num_retries=MAX_UPLOAD_RETRIES)
+    if len(data) != length:
+        raise IOError(f"Expected {length} bytes of {file_id} from offset {start}, got {len(data)}")
+    return data
+
+
+def download_file(file_id):
+    """Download a whole (small) Google Drive file into memory."""
+    return get_drive_service().files().get_media(fileId=file_id).execute(num_retries=MAX_UPLOAD_RETRIES)
+
+
 def print_free_space(service):
-    result = service.about().get(fields="*").execute()
+    result = service.about().get(fields="storageQuota(usageInDrive)").execute()
     result = result.get("storageQuota", {})
     print(round(float(result['usageInDrive']) / (1 << 20), 2), "MB remaining in drive")
 
@@ -184,9 +833,27 @@ def main():
     parser.add_argument("-s", required=False, type=int, choices=[0, 1],
                         help="Specifies whether drive free space should be printed (default: %(default)s)", default=0)
 
-    args = vars(parser.parse_args())
+    parser.add_argument("-v", required=False, type=int, default=0,
+                        help="Size in MB of the volumes the file is split into and uploaded concurrently, 0 uploads "
+                             "it as a single file (default: %(default)s)")
+
+    parser.add_argument("-w", required=False, type=int, default=4,
+                        help="Number of volumes uploaded concurrently (default: %(default)s)")
 
-    upload_file(args["f"], args["d"], args["p"], args["s"])
+    parser.add_argument("-bw", required=False, default=None,
+                        help="Upload bandwidth limit in MB/s, or limits by time of day like \"09:00-18:00=1.5,5\" "
+                             "(default: unlimited)")
+
+    args = vars(parser.parse_args())
+    try:
+        set_bandwidth_limit(args["bw"])
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args["v"]:
+        upload_volumes(args["f"], args["v"], args["p"], args["w"], args["s"])
+    else:
+        upload_file(args["f"], args["d"], args["p"], args["s"])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+import heapq
+import itertools
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+CHUNK_ALIGNMENT = 256 << 10  # Drive requires every chunk but the last to be a multiple of 256 KB
+MIN_CHUNK_SIZE = CHUNK_ALIGNMENT
+INITIAL_CHUNK_SIZE = 8 << 20
+MAX_CHUNK_SIZE = 128 << 20  # a chunk is held in memory while it is sent
+# Chunks are sized to take about this long: long enough for the per-request overhead to be negligible, short enough
+# that a failed chunk doesn't cost much to send again and that progress is saved often
+TARGET_CHUNK_SECONDS = 5
+WINDOW_PATTERN = re.compile(r"(\d{1,2}):(\d\d)-(\d{1,2}):(\d\d)=([\d.]+)")
+
+
+def align_chunk_size(size):
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT))
+
+
+class ChunkSizer:
+    """
+    Chunk size of a resumable upload, adapted to the throughput achieved by each chunk so that chunks take about
+    TARGET_CHUNK_SECONDS. The size at most doubles or halves after each chunk, so a single slow or fast chunk doesn't
+    swing it too far, and it halves after a failed chunk.
+    """
+
+    def __init__(self, chunk_size=INITIAL_CHUNK_SIZE):
+        self.chunk_size = align_chunk_size(chunk_size)
+        self.throughput = None  # bytes per second of the last chunk
+
+    def update(self, sent_bytes, seconds):
+        """
+        Adapts the chunk size to a full chunk of sent_bytes which took seconds to send. The last chunk of a file,
+        shorter than the chunk size, says little about the link and shouldn't be passed.
+        """
+        if seconds <= 0:
+            return
+        self.throughput = sent_bytes / seconds
+        target = self.throughput * TARGET_CHUNK_SECONDS
+        self.chunk_size = align_chunk_size(int(min(max(target, self.chunk_size / 2), self.chunk_size * 2)))
+
+    def failed(self):
+        self.chunk_size = align_chunk_size(self.chunk_size // 2)
+
+
+class BandwidthSchedule:
+    """
+    Upload rate limit in bytes per second depending on the time of day, None meaning unlimited. Parsed from a spec
+    like "09:00-18:00=1.5,22:00-06:00=20,5": windows (which may wrap around midnight) with their limit in MB/s, and
+    an optional limit for the rest of the day. A limit of 0 means unlimited.
+    """
+
+    def __init__(self, windows=(), default_rate=None):
+        self.windows = list(windows)  # (start minute of the day, end minute of the day, bytes per second or None)
+        self.default_rate = default_rate
+
+    @classmethod
+    def parse(cls, spec):
+        windows = []
+        default_rate = None
+        for item in filter(None, (item.strip() for item in spec.split(","))):
+            match = WINDOW_PATTERN.fullmatch(item)
+            try:
+                if match:
+                    start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+                    start, end = int(start_hour) * 60 + int(start_minute), int(end_hour) * 60 + int(end_minute)
+                    if max(start, end) > 24 * 60 or max(int(start_minute), int(end_minute)) > 59:
+                        raise ValueError
+                    windows.append((start, end, cls._rate(rate)))
+                else:
+                    default_rate = cls._rate(item)
+            except ValueError:
+                raise ValueError(f"Invalid bandwidth limit {item!r}, expected MB/s or HH:MM-HH:MM=MB/s") from None
+        return cls(windows, default_rate)
+
+    @staticmethod
+    def _rate(mb_per_s):
+        rate = float(mb_per_s)
+        if rate < 0:
+            raise ValueError
+        return int(rate * (1 << 20)) or None
+
+    def rate_at(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            if start <= minute < end or end < start and (minute >= start or minute < end):
+                return rate
+        return self.default_rate
+
+
+class BandwidthLimiter:
+    """
+    Keeps the combined rate of every upload under the limit of a BandwidthSchedule. Each chunk reserves its bytes
+    before being sent and waits until the limit allows them, so chunks are spread out instead of sent in bursts.
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self._lock = threading.Lock()
+        self._next = 0.0  # time.monotonic() at which the reserved bytes will all have been allowed
+
+    def max_chunk_size(self):
+        """
+        Largest chunk worth sending at the current limit, so that a chunk doesn't wait much longer than it takes
+        """
+        rate = self.schedule.rate_at()
+        return None if rate is None else align_chunk_size(rate * TARGET_CHUNK_SECONDS)
+
+    def acquire(self, nbytes):
+        """
+        Waits until nbytes can be sent without exceeding the limit, returns the number of seconds waited
+        """
+        rate = self.schedule.rate_at()
+        with self._lock:
+            now = time.monotonic()
+            if rate is None:
+                self._next = now
+                return 0
+            start = max(now, self._next)
+            self._next = start + nbytes / rate
+        if start > now:
+            time.sleep(start - now)
+        return start - now
+
+
+class UploadQueue:
+    """
+    Uploads from every thread wait in line for one of workers slots. Smaller uploads go first, e.g. an offline file
+    list isn't held up behind the volumes of a large zip, and uploads of the same size start in the order they were
+    queued.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = []  # heap of (size, queue position)
+        self._positions = itertools.count()
+
+    @contextmanager
+    def slot(self, size=None):
+        """
+        Waits for a free slot for an upload of size bytes, None being an upload of unknown size which goes last
+        """
+        with self._condition:
+            ticket = (float("inf") if size is None else size, next(self._positions))
+            heapq.heappush(self._waiting, ticket)
+            self._condition.wait_for(lambda: self._waiting[0] == ticket and self._running < self.workers)
+            heapq.heappop(self._waiting)
+            self._running += 1
+            # the next upload in line may start too if there is another free slot
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
@@ -0,0 +1,298 @@
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import FrozenSet, NamedTuple
+
+from scanner import scan_tree
+
+JOURNAL_SUFFIX = "_change_journal.txt"
+PROCESSING_SUFFIX = ".processing"  # journal taken by a backup which hasn't completed yet
+RESCAN_MARKER = "!rescan"
+MAX_JOURNAL_ENTRIES = 10000  # changed folders journaled before giving up and rescanning the whole work folder
+POLL_INTERVAL = 60  # seconds between scans of the polling watcher
+
+# inotify constants from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len of struct inotify_event
+READ_SIZE = 64 << 10
+
+
+def get_journal_path(folder):
+    """
+    The journal of a work folder is stored in the project's root dir (gitignored), next to its manifest
+    """
+    return os.path.join(Path(__file__).resolve().parent,
+                        f"{os.path.basename(os.path.abspath(folder))}{JOURNAL_SUFFIX}")
+
+
+class JournalChanges(NamedTuple):
+    dirs: FrozenSet[str]  # folders, relative to the work folder, in which files were created, changed or deleted
+    rescan: bool  # the changes are unknown, the whole work folder has to be scanned
+
+
+class ChangeJournal:
+    """
+    Append-only file listing the folders of the work folder in which something changed, one JSON string of its path
+    relative to the work folder per line. Every folder is only written once until the journal is taken by a backup,
+    and once more than max_entries folders are journaled the journal overflows: it is marked for a full rescan and
+    nothing more is written to it.
+
+    A new journal always starts with a rescan marker, since changes made while nothing was watching are unknown.
+    take() hands the journal over to a backup, while changes keep being recorded in a new journal. Until that backup
+    calls commit(), the journal it took is kept and merged into the next one taken, so a failed backup loses nothing.
+    """
+
+    def __init__(self, journal_path, max_entries=MAX_JOURNAL_ENTRIES):
+        self.journal_path = journal_path
+        self.processing_path = journal_path + PROCESSING_SUFFIX
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = set()
+        self._overflowed = True
+        self._file = open(journal_path, 'w', buffering=1)
+        self._file.write(RESCAN_MARKER + '\n')
+
+    def mark_dir(self, rel_dir):
+        with self._lock:
+            if self._overflowed or rel_dir in self._entries:
+                return
+            if len(self._entries) >= self.max_entries:
+                self._overflow()
+                return
+            self._entries.add(rel_dir)
+            self._file.write(json.dumps(rel_dir) + '\n')
+
+    def mark_overflow(self):
+        with self._lock:
+            self._overflow()
+
+    def _overflow(self):
+        if not self._overflowed:
+            self._overflowed = True
+            self._file.write(RESCAN_MARKER + '\n')
+
+    def take(self):
+        """
+        Returns the JournalChanges recorded since the last committed backup and starts a new journal
+        """
+        with self._lock:
+            self._file.close()
+            with open(self.journal_path) as f:
+                journal = f.read()
+            with open(self.processing_path, 'a') as f:
+                f.write(journal)
+            self._entries = set()
+            self._overflowed = False
+            self._file = open(self.journal_path, 'w', buffering=1)
+        dirs = set()
+        rescan = False
+        with open(self.processing_path) as f:
+            for line in f:
+                if line.strip() == RESCAN_MARKER:
+                    rescan = True
+                elif line.strip():
+                    dirs.add(json.loads(line))
+        return JournalChanges(frozenset(dirs), rescan)
+
+    def commit(self):
+        """
+        Forgets the changes returned by take(), once they have been backed up
+        """
+        Path(self.processing_path).unlink(missing_ok=True)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class InotifyWatcher(threading.Thread):
+    """
+    Journals the folders of the work folder in which files change, using one inotify watch per folder. Folders
+    created or moved into the work folder are watched as soon as they appear. Ignored folders are never watched.
+    Raises OSError if inotify isn't available or there are more folders than the inotify watch limit
+    (/proc/sys/fs/inotify/max_user_watches).
+    """
+
+    def __init__(self, root, rules, journal):
+        super().__init__(daemon=True)
+        self.root = os.path.abspath(root)
+        self.rules = rules
+        self.journal = journal
+        self._stop_event = threading.Event()
+        self._watches = {}  # wd -> folder path
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self._watch_tree(self.root, mark=False)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _rel_dir(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _watch_tree(self, path, mark=True):
+        """
+        Watches path and all of its subfolders, which are journaled if mark is set
+        """
+        for dir_record in scan_tree(path, self.rules.prune_dirnames):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_record.path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                    # deleted in the meantime or unreadable, like scan_tree skips it
+                    continue
+                raise OSError(error, f"inotify_add_watch failed for {dir_record.path}")
+            self._watches[wd] = dir_record.path
+            if mark:
+                self.journal.mark_dir(self._rel_dir(dir_record.path))
+
+    def _unwatch_tree(self, path):
+        """
+        Journals path and its watched subfolders, which were deleted or moved away, and removes their watches
+        """
+        prefix = os.path.join(path, "")
+        for wd, watched_path in list(self._watches.items()):
+            if watched_path == path or watched_path.startswith(prefix):
+                self.journal.mark_dir(self._rel_dir(watched_path))
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            print("Too many changes at once for inotify, the next backup scans the whole work folder")
+            self.journal.mark_overflow()
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        path = self._watches.get(wd)
+        if path is None:
+            return
+        if not name:
+            if path == self.root and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                print(f"{self.root} was deleted or moved, the next backup scans the whole work folder")
+                self.journal.mark_overflow()
+            return
+        child = os.path.join(path, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+                # the number of entries of path changed, which decides whether its files are backed up online
+                self.journal.mark_dir(self._rel_dir(path))
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(child)
+            elif mask & (IN_CREATE | IN_MOVED_TO) and not self.rules.is_ignored(self._rel_dir(child), is_dir=True):
+                self._watch_tree(child)
+        elif not (self.rules.has_ignore_patterns and self.rules.is_ignored(self._rel_dir(child))):
+            self.journal.mark_dir(self._rel_dir(path))
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                if not select.select([self._fd], [], [], 1)[0]:
+                    continue
+                data = os.read(self._fd, READ_SIZE)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                    offset += EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+                    offset += name_length
+                    self._handle_event(wd, mask, name)
+        except Exception as e:
+            # nothing is journaled anymore, the owner of the watcher notices it has stopped and replaces it
+            print(f"Watching {self.root} failed: {e}")
+            self.journal.mark_overflow()
+        finally:
+            os.close(self._fd)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class PollingWatcher(threading.Thread):
+    """
+    Fallback for InotifyWatcher, which scans the work folder every poll_interval seconds and journals the folders
+    whose files, sizes or modification times changed since the previous scan
+    """
+
+    def __init__(self, root, rules, journal, poll_interval=POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.root = os.path.abspath(root)
+        self.rules = rules
+        self.journal = journal
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._signatures = self._scan()
+
+    def _scan(self):
+        """
+        Returns {folder path: checksum of its entry count, subfolders and the name, size and mtime of its files}
+        """
+        signatures = {}
+        for dir_record in scan_tree(self.root, self.rules.prune_dirnames):
+            signature = zlib.crc32(repr((dir_record.entry_count, dir_record.subdirs)).encode())
+            for f in dir_record.files:
+                signature = zlib.crc32(f"{f.name}\0{f.size}\0{f.mtime_ns}".encode(), signature)
+            signatures[dir_record.path] = signature
+        return signatures
+
+    def run(self):
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                signatures = self._scan()
+            except Exception as e:
+                print(f"Watching {self.root} failed: {e}")
+                self.journal.mark_overflow()
+                return
+            # new, changed and deleted folders
+            for path in signatures.keys() | self._signatures.keys():
+                if signatures.get(path) != self._signatures.get(path):
+                    self.journal.mark_dir(os.path.relpath(path, self.root))
+            self._signatures = signatures
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def start_watcher(root, rules, journal):
+    """
+    Starts journaling the changes in root with inotify, or with a PollingWatcher if inotify can't be used
+    """
+    try:
+        watcher = InotifyWatcher(root, rules, journal)
+    except (OSError, AttributeError, TypeError) as e:
+        print(f"Can't watch {root} with inotify ({e}), scanning it every {POLL_INTERVAL} seconds instead")
+        watcher = PollingWatcher(root, rules, journal)
+    watcher.start()
+    return watcher